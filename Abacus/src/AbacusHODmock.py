@@ -3,21 +3,36 @@
 """
 Generate AbacusHOD mock. If path to CONFIG is provided, it will be used, else CONFIG in this file is used.
 
+Batch mode: with --batch TABLE (.yaml/.csv/.npy, one HOD parameter set per row), the
+halo catalogs are loaded once and every row is evaluated; the clustering vectors and
+number densities are written to one .npz file.
+
 Usage
 -----
 $ python ./AbacusHODmock.py --help
+$ python ./AbacusHODmock.py -c config.yaml --batch hod_table.csv -n 64 --nworkers 4
     
 Author: Siyi Zhao
 """
 import argparse
+import contextlib
+import copy
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import sys, os
 sys.path.insert(0, os.path.expanduser('~/lib/'))
-from abacusnbody.hod.abacus_hod import AbacusHOD
-import abacusnbody.hod.abacus_hod as ah
-print(ah.__file__)
 # sys.path.insert(0, os.path.abspath('src'))
-from config_helper import config_Abacus, save_config
+try:
+    from perftrace import span, traced
+except ImportError:  # EZmock/src not on PYTHONPATH: no tracing
+    def span(name, **attrs):
+        return contextlib.nullcontext()
+
+    def traced(name=None):
+        return lambda func: func
+from config_helper import config_Abacus, save_config, load_param_table, AbacusConfig, RunIndex, run_is_done
+from mock_io import write_mock
 
 # Example HOD parameters for QSO at z~2.5
 logM_cut, logM1, sigma, alpha, kappa, alpha_c, alpha_s = [11.7209282, 11.1767657, 0.04491125, 0.90375827, 3.85540798, 1.81135532, 1.90593657]
@@ -58,6 +73,15 @@ CONFIG = {
         }
 }
 
+def load_AbacusHOD():
+    """
+    AbacusHOD class, imported on first use: abacusnbody is slow to import, and
+    --template or a run that is already finished do not need it.
+    """
+    import abacusnbody.hod.abacus_hod as ah
+    print(f"Using AbacusHOD from {ah.__file__}")
+    return ah.AbacusHOD
+
 def find_path(Ball):
     if Ball.want_rsd:
         rsd_string = '_rsd'
@@ -68,10 +92,14 @@ def find_path(Ball):
     path = (Ball.mock_dir) / ('galaxies' + rsd_string)
     return path
 
-def compute_all(Ball, out=False, cfg=None, want_rsd=None, want_dv=None, want_clustering=False, nthread=1, verbose=False):
+@traced('compute_all')
+def compute_all(Ball, out=False, cfg=None, want_rsd=None, want_dv=None, want_clustering=False, nthread=1, verbose=False, text=False):
     """
     Generate the mock, and compute both wp and multipoles.
     If out=True, write the mock (and clustering) to disk, please provide cfg.
+    The mock is written in the columnar binary layout of mock_io ({tracer}s.cols/ with
+    the config in its manifest); text=True also writes the AbacusHOD text files.
+    config.yaml is written last and marks the run as finished (config_helper.run_is_done).
     """
     re = {}
     if want_rsd is not None:
@@ -88,7 +116,8 @@ def compute_all(Ball, out=False, cfg=None, want_rsd=None, want_dv=None, want_clu
         fn_ext = '_dv'
     else:
         fn_ext = ''
-    mock_dict = Ball.run_hod(tracers=Ball.tracers, want_rsd=want_rsd, Nthread = nthread, verbose = verbose, write_to_disk=out, fn_ext=fn_ext)
+    with span('run_hod', nthread=nthread):
+        mock_dict = Ball.run_hod(tracers=Ball.tracers, want_rsd=want_rsd, Nthread = nthread, verbose = verbose, write_to_disk=out and text, fn_ext=fn_ext)
     re['mock_dict'] = mock_dict
     ## write config to disk
     if out:
@@ -103,33 +132,197 @@ def compute_all(Ball, out=False, cfg=None, want_rsd=None, want_dv=None, want_clu
         cfg['HOD_params']['want_dv'] = want_dv
         path2dir = find_path(Ball)
         path2cfg = (path2dir) / ('config.yaml')
-        save_config(cfg, path2cfg)
+        if os.path.islink(path2dir):
+            raise RuntimeError(f"{path2dir} links to the outputs of another run, remove the link before writing this one.")
+        # outputs of an earlier run in this directory no longer match until this run has finished
+        for stale in (path2cfg, (path2dir) / ('clustering.npy')):
+            if stale.exists():
+                stale.unlink()
+        with span('write_mock'):
+            write_mock(mock_dict, path2dir, config=cfg)
     if want_clustering:
         print("Computing clustering...")
-        clustering = Ball.compute_multipole(mock_dict, rpbins=Ball.rpbins, pimax=Ball.pimax, sbins=Ball.rpbins[5:], nbins_mu=40, Nthread = nthread) 
+        with span('compute_multipole', nthread=nthread):
+            clustering = Ball.compute_multipole(mock_dict, rpbins=Ball.rpbins, pimax=Ball.pimax, sbins=Ball.rpbins[5:], nbins_mu=40, Nthread = nthread) 
         re['clustering'] = clustering
         if out:
             print("Saving clustering to disk...")     
             path2cluster = (path2dir) / ('clustering.npy')
             np.save(path2cluster, clustering)
             print("Save clustering to:", path2cluster)
+    if out:
+        save_config(cfg, path2cfg)
 
     return re
 
-def main(nthread, path2config, config_by_file=False):
+def reuse_run(config, index, want_clustering=True):
+    """
+    Find a finished run of `config`, without loading any halos.
+
+    A finished run in the mock directory of `config` is reused as it is. One
+    recorded in `index` under another output_dir is linked into place when the
+    mock directory is free, and otherwise reported.
+
+    Parameters:
+        config (AbacusConfig): Configuration, with the want_rsd/want_dv overrides applied.
+        index (RunIndex): Finished runs shared between output directories.
+        want_clustering (bool): Whether clustering.npy is required.
+
+    Returns:
+        Path or None: Directory holding the outputs, None if the run has to be done.
+    """
+    fingerprint = config.fingerprint()
+    tracers = config.hod.tracers
+    path2dir = config.mock_dir()
+    if run_is_done(path2dir, fingerprint, tracers, want_clustering):
+        print(f"Found finished run {fingerprint[:12]} in {path2dir}, skipping.")
+        index.add(fingerprint, path2dir)
+        return path2dir
+    if os.path.islink(path2dir):
+        # a link to the outputs of another configuration: this run writes its own directory
+        os.unlink(path2dir)
+    other = index.get(fingerprint)
+    if other is None or not run_is_done(other, fingerprint, tracers, want_clustering):
+        return None
+    if not os.path.lexists(path2dir):
+        os.makedirs(path2dir.parent, exist_ok=True)
+        os.symlink(os.path.abspath(other), path2dir)
+        print(f"Found finished run {fingerprint[:12]} in {other}, linked to {path2dir}.")
+        return path2dir
+    print(f"Found finished run {fingerprint[:12]} in {other} ({path2dir} is taken by another run), skipping.")
+    return other
+
+@traced('evaluate_hod')
+def evaluate_hod(Ball, names, values, tracer='QSO', nthread=1):
+    """
+    Populate one HOD parameter set on the loaded halos and compute its clustering.
+
+    Parameters:
+        Ball (AbacusHOD): Instance with the halo and subsample catalogs loaded.
+        names (list): HOD parameter names (keys of Ball.tracers[tracer]).
+        values (array_like): Values of these parameters; the others keep their configured values.
+        tracer (str): Tracer whose parameters are set.
+        nthread (int): Threads for run_hod and compute_multipole.
+
+    Returns:
+        clustering (ndarray): Flattened clustering vector of the {tracer}_{tracer} auto-correlation.
+        density (float): Number density of the mock.
+    """
+    tracers = copy.deepcopy(Ball.tracers)
+    for name, value in zip(names, values):
+        tracers[tracer][name] = float(value)
+    with span('run_hod', nthread=nthread):
+        mock_dict = Ball.run_hod(tracers=tracers, want_rsd=Ball.want_rsd, Nthread=nthread, verbose=False, write_to_disk=False)
+    with span('compute_multipole', nthread=nthread):
+        clustering = Ball.compute_multipole(mock_dict, rpbins=Ball.rpbins, pimax=Ball.pimax, sbins=Ball.rpbins[5:], nbins_mu=40, Nthread=nthread)
+    density = mock_dict[tracer]['x'].size / Ball.params['Lbox'] ** 3
+    return np.ravel(clustering[f'{tracer}_{tracer}']), density
+
+_batch_ball = None
+
+def _batch_worker(names, values, tracer, nthread):
+    return evaluate_hod(_batch_ball, names, values, tracer=tracer, nthread=nthread)
+
+def run_batch(Ball, names, table, tracer=None, nthread=1, nworkers=1, path2out=None):
+    """
+    Evaluate a table of HOD parameter sets with one loaded AbacusHOD instance.
+
+    Parameters:
+        Ball (AbacusHOD): Instance with the halo and subsample catalogs loaded.
+        names (list): HOD parameter names, one per column of `table`.
+        table (ndarray): Parameter values, shape (n_sets, len(names)).
+        tracer (str): Tracer whose parameters are varied (default: the first active tracer).
+        nthread (int): Total thread budget.
+        nworkers (int): Number of evaluations running at once; each gets nthread // nworkers
+            threads. Workers are forked and share the loaded catalogs copy-on-write.
+        path2out (str, optional): Where to save the results (.npz).
+
+    Returns:
+        dict: 'names', 'params' (n_sets, n_params), 'clustering' (n_sets, n_bins) and
+            'density' (n_sets,); rows that failed are NaN.
+    """
+    global _batch_ball
+    if tracer is None:
+        tracer = list(Ball.tracers.keys())[0]
+    unknown = [n for n in names if n not in Ball.tracers[tracer]]
+    if unknown:
+        raise ValueError(f"Unknown {tracer} HOD parameters in the table: {unknown}")
+    table = np.atleast_2d(np.asarray(table, dtype=float))
+    nworkers = max(1, min(nworkers, len(table)))
+    nthread_each = max(1, nthread // nworkers)
+    results = [None] * len(table)
+    print(f"Evaluating {len(table)} {tracer} HOD parameter sets, {nworkers} at a time with {nthread_each} threads each.")
+    if nworkers == 1:
+        for i, values in enumerate(table):
+            try:
+                results[i] = evaluate_hod(Ball, names, values, tracer=tracer, nthread=nthread_each)
+            except Exception as e:
+                print(f"Warning: HOD parameter set {i} failed: {e}")
+    else:
+        _batch_ball = Ball
+        try:
+            with ProcessPoolExecutor(max_workers=nworkers, mp_context=mp.get_context('fork')) as pool:
+                futures = {pool.submit(_batch_worker, names, values, tracer, nthread_each): i for i, values in enumerate(table)}
+                for fut in as_completed(futures):
+                    i = futures[fut]
+                    try:
+                        results[i] = fut.result()
+                    except Exception as e:
+                        print(f"Warning: HOD parameter set {i} failed: {e}")
+        finally:
+            _batch_ball = None
+    done = [r for r in results if r is not None]
+    if not done:
+        raise RuntimeError("All HOD parameter sets failed.")
+    nbins = done[0][0].size
+    clustering = np.full((len(table), nbins), np.nan)
+    density = np.full(len(table), np.nan)
+    for i, r in enumerate(results):
+        if r is not None:
+            clustering[i], density[i] = r
+    out = {'names': np.array(names), 'params': table, 'clustering': clustering, 'density': density}
+    if path2out is not None:
+        np.savez(path2out, tracer=tracer, **out)
+        print("Save batch results to:", path2out)
+    return out
+
+def main(nthread, path2config, config_by_file=False, batch=None, nworkers=1, path2out=None, text=False, path2index=None, force=False):
     ## configure AbacusHOD
     if config_by_file:
         config = None
     else:
         config = CONFIG
     sim_params, HOD_params, clustering_params = config_Abacus(config=config,config_path=path2config)
+    cfg = AbacusConfig.from_dict({'sim_params': sim_params, 'HOD_params': HOD_params, 'clustering_params': clustering_params})
+
+    ## skip a mock that was already made with the same settings, before loading the halos
+    if batch is None:
+        if path2index is None:
+            path2index = os.path.join(sim_params['output_dir'], 'runs.yaml')
+        index = RunIndex(path2index)
+        if not force and reuse_run(cfg, index) is not None:
+            return
+        path2dir = cfg.mock_dir()
+        if os.path.islink(path2dir):
+            # a link to the outputs of another run (see reuse_run): write a directory of our own
+            os.unlink(path2dir)
     
     ## generate AbacusHOD object
-    ball_profiles = AbacusHOD(sim_params, HOD_params, clustering_params)
+    AbacusHOD = load_AbacusHOD()
+    with span('AbacusHOD_init', sim=sim_params.get('sim_name')):
+        ball_profiles = AbacusHOD(sim_params, HOD_params, clustering_params)
     
+    if batch is not None:
+        names, table = load_param_table(batch)
+        if path2out is None:
+            path2out = os.path.join(sim_params['output_dir'], os.path.splitext(os.path.basename(batch))[0] + '_results.npz')
+        run_batch(ball_profiles, names, table, nthread=nthread, nworkers=nworkers, path2out=path2out)
+        print("Finished batch HOD evaluation.")
+        return
+
     ## compute mock and clustering
-    cfg = {'sim_params': sim_params, 'HOD_params': HOD_params, 'clustering_params': clustering_params}
-    results=compute_all(ball_profiles, out=True, cfg=cfg, want_clustering=True, nthread=nthread, verbose=True)
+    results=compute_all(ball_profiles, out=True, cfg=cfg.to_dict(), want_clustering=True, nthread=nthread, verbose=True, text=text)
+    index.add(cfg.fingerprint(), find_path(ball_profiles))
     
     print("Finished generating AbacusHOD mock and computing clustering.")
 
@@ -146,6 +339,12 @@ def parse_args():
     parser.add_argument('-n', '--nthread', type=int, default=16, help='number of threads')
     parser.add_argument('-c', '--config', type=str, default=None, help='config path')
     parser.add_argument('-t', '--template', action='store_true', help='print template config and exit')
+    parser.add_argument('--text', action='store_true', help='also write the mock as text (galaxies*/<tracer>s.dat) besides the binary columns')
+    parser.add_argument('-b', '--batch', type=str, default=None, help='table of HOD parameter sets (.yaml/.csv/.npy) to evaluate in batch mode')
+    parser.add_argument('--nworkers', type=int, default=1, help='batch mode: number of concurrent evaluations sharing the thread budget')
+    parser.add_argument('-o', '--out', type=str, default=None, help='batch mode: results file (default: <output_dir>/<table>_results.npz)')
+    parser.add_argument('--index', type=str, default=None, help='table of finished runs by config fingerprint, shared between output directories (default: <output_dir>/runs.yaml)')
+    parser.add_argument('-f', '--force', action='store_true', help='rerun even if a run with the same config fingerprint is finished')
     args = parser.parse_args()
     return args
 
@@ -162,4 +361,4 @@ if __name__ == "__main__":
     else:
         config_by_file = False
 
-    main(nthread, path2config, config_by_file=config_by_file)
+    main(nthread, path2config, config_by_file=config_by_file, batch=args.batch, nworkers=args.nworkers, path2out=args.out, text=args.text, path2index=args.index, force=args.force)
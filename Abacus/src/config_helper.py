@@ -1,5 +1,12 @@
+import copy
+import csv
+import dataclasses
+import hashlib
+import json
 import yaml
 import os
+from pathlib import Path
+import numpy as np
 
 def load_config(config_path):
     """
@@ -88,10 +95,262 @@ _DEFAULT_CONFIG = {
         }
 }
 
+def _coerce(section, name, value, typ):
+    """Check and convert one config entry to its declared type."""
+    try:
+        if typ is bool:
+            if not isinstance(value, (bool, np.bool_)):
+                raise TypeError
+            return bool(value)
+        if typ is float:
+            if isinstance(value, (bool, np.bool_)):
+                raise TypeError
+            return float(value)
+        if typ is int:
+            if isinstance(value, (bool, np.bool_)) or int(value) != value:
+                raise TypeError
+            return int(value)
+        if typ is str:
+            if not isinstance(value, (str, os.PathLike)):
+                raise TypeError
+            return os.fspath(value)
+        if typ is dict:
+            if not isinstance(value, dict):
+                raise TypeError
+            return copy.deepcopy(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{section}.{name} must be {typ.__name__}, got {value!r}") from None
+    raise TypeError(f"unsupported field type {typ}")
+
+
+class _Section:
+    """
+    Base of the typed config sections: declared fields are checked and converted,
+    entries not declared are kept as they are in `extra`.
+    """
+    _name = ''
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Build the section from its dict in the YAML config.
+
+        Raises:
+            ValueError: A required entry is missing or has the wrong type.
+        """
+        d = dict(d or {})
+        kwargs = {}
+        for f in dataclasses.fields(cls):
+            if f.name == 'extra':
+                continue
+            if f.name in d:
+                kwargs[f.name] = _coerce(cls._name, f.name, d.pop(f.name), f.type)
+            elif f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING:
+                raise ValueError(f"{cls._name}.{f.name} is required")
+        return cls(extra=copy.deepcopy(d), **kwargs)
+
+    def to_dict(self):
+        """Plain dict in the layout AbacusHOD and the YAML config use."""
+        out = {f.name: copy.deepcopy(getattr(self, f.name)) for f in dataclasses.fields(self) if f.name != 'extra'}
+        out.update(copy.deepcopy(self.extra))
+        return out
+
+
+@dataclasses.dataclass
+class SimParams(_Section):
+    _name = 'sim_params'
+    sim_name: str
+    sim_dir: str
+    subsample_dir: str
+    output_dir: str
+    z_mock: float
+    cleaned_halos: bool = True
+    force_mt: bool = False
+    extra: dict = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class HODParams(_Section):
+    _name = 'HOD_params'
+    tracer_flags: dict
+    use_particles: bool = False
+    use_profiles: bool = False
+    want_AB: bool = False
+    want_rsd: bool = True
+    want_dv: bool = False
+    write_to_disk: bool = False
+    extra: dict = dataclasses.field(default_factory=dict)
+
+    def __post_init__(self):
+        for tracer, on in self.tracer_flags.items():
+            self.tracer_flags[tracer] = _coerce(self._name, f'tracer_flags.{tracer}', on, bool)
+            if not self.tracer_flags[tracer]:
+                continue
+            key = f'{tracer}_params'
+            if not isinstance(self.extra.get(key), dict):
+                raise ValueError(f"{self._name}.{key} is required for the enabled tracer {tracer}")
+            for name, value in self.extra[key].items():
+                _coerce(self._name, f'{key}.{name}', value, float)  # numeric, kept as given (e.g. int profile_code)
+
+    @property
+    def tracers(self):
+        """Enabled tracers."""
+        return [t for t, on in self.tracer_flags.items() if on]
+
+
+@dataclasses.dataclass
+class ClusteringParams(_Section):
+    _name = 'clustering_params'
+    bin_params: dict
+    clustering_type: str = 'all'
+    pi_bin_size: int = 40
+    pimax: int = 40
+    extra: dict = dataclasses.field(default_factory=dict)
+
+    def __post_init__(self):
+        for name in ('logmin', 'logmax', 'nbins'):
+            if name not in self.bin_params:
+                raise ValueError(f"{self._name}.bin_params.{name} is required")
+        self.bin_params['logmin'] = _coerce(self._name, 'bin_params.logmin', self.bin_params['logmin'], float)
+        self.bin_params['logmax'] = _coerce(self._name, 'bin_params.logmax', self.bin_params['logmax'], float)
+        self.bin_params['nbins'] = _coerce(self._name, 'bin_params.nbins', self.bin_params['nbins'], int)
+
+
+def _canonical(obj):
+    """Numbers as floats (1 and 1.0 are the same setting), containers recursively."""
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, (bool, np.bool_)):
+        return bool(obj)
+    if isinstance(obj, (int, float, np.integer, np.floating)):
+        return float(obj)
+    return obj
+
+
+# entries that do not change the mock or its clustering (where it is written, extra text output)
+_NOT_FINGERPRINTED = {'sim_params': ('output_dir',), 'HOD_params': ('write_to_disk',)}
+
+
+@dataclasses.dataclass
+class AbacusConfig:
+    """
+    Validated AbacusHOD configuration (sim_params, HOD_params, clustering_params).
+
+    `fingerprint` identifies the mock and clustering the configuration produces:
+    a SHA-1 of the canonical JSON of the three sections, without the output
+    location (output_dir) and write_to_disk.
+    """
+    sim: SimParams
+    hod: HODParams
+    clustering: ClusteringParams
+
+    @classmethod
+    def from_dict(cls, config):
+        return cls(SimParams.from_dict(config.get('sim_params')),
+                   HODParams.from_dict(config.get('HOD_params')),
+                   ClusteringParams.from_dict(config.get('clustering_params')))
+
+    @classmethod
+    def from_yaml(cls, config_path):
+        return cls.from_dict(load_config(config_path) or {})
+
+    def to_dict(self):
+        return {'sim_params': self.sim.to_dict(), 'HOD_params': self.hod.to_dict(),
+                'clustering_params': self.clustering.to_dict()}
+
+    def sections(self):
+        """sim_params, HOD_params, clustering_params as dicts (the return value of config_Abacus)."""
+        d = self.to_dict()
+        return d['sim_params'], d['HOD_params'], d['clustering_params']
+
+    def with_overrides(self, want_rsd=None, want_dv=None):
+        """Copy with the want_rsd/want_dv overrides compute_all applies."""
+        hod = copy.deepcopy(self.hod)
+        if want_rsd is not None:
+            hod.want_rsd = bool(want_rsd)
+        if want_dv is not None:
+            hod.want_dv = bool(want_dv)
+        return dataclasses.replace(self, hod=hod)
+
+    def fingerprint(self):
+        """SHA-1 of the settings that determine the mock and its clustering."""
+        d = self.to_dict()
+        for section, names in _NOT_FINGERPRINTED.items():
+            for name in names:
+                d[section].pop(name, None)
+        return hashlib.sha1(json.dumps(_canonical(d), sort_keys=True, default=str).encode()).hexdigest()
+
+    def mock_dir(self):
+        """
+        Directory of the mock (as find_path in AbacusHODmock, without loading the halos):
+        <output_dir>/<sim_name>/z<z_mock>/galaxies[_rsd[_dv]].
+        """
+        ext = ('_rsd' + ('_dv' if self.hod.want_dv else '')) if self.hod.want_rsd else ''
+        return Path(self.sim.output_dir) / self.sim.sim_name / ('z%4.3f' % self.sim.z_mock) / ('galaxies' + ext)
+
+
+def run_is_done(path2dir, fingerprint, tracers=(), want_clustering=True):
+    """
+    Whether a mock directory holds a finished run of the configuration with `fingerprint`.
+
+    compute_all writes config.yaml last, so a config.yaml with the same
+    fingerprint, the tracer column directories and (if wanted) clustering.npy
+    mean the run completed.
+    """
+    path2dir = Path(path2dir)
+    try:
+        if AbacusConfig.from_yaml(path2dir / 'config.yaml').fingerprint() != fingerprint:
+            return False
+    except (OSError, RuntimeError, ValueError):
+        return False
+    if any(not (path2dir / f'{t}s.cols' / 'manifest.yaml').is_file() for t in tracers):
+        return False
+    return not want_clustering or (path2dir / 'clustering.npy').is_file()
+
+
+class RunIndex:
+    """
+    YAML table fingerprint -> mock directory of finished runs.
+
+    Several output directories (or users) pointing to the same index share
+    their outputs: a configuration already run elsewhere is linked, not rerun.
+
+    Parameters:
+        path (str): Index file, created on the first `add`.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        return load_config(self.path) or {}
+
+    def get(self, fingerprint):
+        """Mock directory recorded for `fingerprint`, or None."""
+        path = self._load().get(fingerprint)
+        return None if path is None else Path(path)
+
+    def add(self, fingerprint, path2dir):
+        """Record a finished run (the file is replaced atomically)."""
+        runs = self._load()
+        runs[fingerprint] = os.path.abspath(str(path2dir))
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.tmp{os.getpid()}'
+        save_config(runs, tmp)
+        os.replace(tmp, self.path)
+
+
 def config_Abacus(config=None, config_path=None):
     """
     Load or save AbacusHOD configuration.
 
+    The configuration is validated (see AbacusConfig); a provided config is
+    saved and returned as it is, not read back from the file.
+
     Parameters:
         config (dict, optional): Configuration data to be saved. If None, load from file.
         config_path (str): Path to the YAML configuration file.
@@ -109,11 +368,61 @@ def config_Abacus(config=None, config_path=None):
                 os.makedirs(output_dir, exist_ok=True)
                 print(f"Created output directory: {output_dir}")
             config_path = output_dir + 'config.yaml'
+        cfg = AbacusConfig.from_dict(config)
         print('config provided, saving to:', config_path)
         save_config(config, config_path)
-    else: # config is None
-        if config_path is None:
-            config_path = 'example.yaml'
-            print("No config or file provided. Using an example configuration and saving it to:", config_path)
-            save_config(_DEFAULT_CONFIG, config_path)
-    return load_AbacusHOD_config(config_path)
+        return cfg.sections()
+    if config_path is None:
+        config_path = 'example.yaml'
+        print("No config or file provided. Using an example configuration and saving it to:", config_path)
+        save_config(_DEFAULT_CONFIG, config_path)
+        return AbacusConfig.from_dict(_DEFAULT_CONFIG).sections()
+    return AbacusConfig.from_yaml(config_path).sections()
+
+
+def load_param_table(path):
+    """
+    Load a table of parameter sets, one set per row.
+
+    Supported formats:
+        .yaml/.yml: a list of {name: value} mappings, or a mapping {name: [values]}.
+        .csv: a header line with the parameter names, then one row per set.
+        .npy: a structured array whose field names are the parameter names.
+
+    Parameters:
+        path (str): Path to the table.
+
+    Returns:
+        names (list): Parameter names.
+        values (ndarray): Parameter values, shape (n_sets, len(names)).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        table = load_config(path)
+        if isinstance(table, list):
+            names = list(table[0].keys())
+            rows = []
+            for i, row in enumerate(table):
+                if set(row.keys()) != set(names):
+                    raise ValueError(f"Row {i} of '{path}' has parameters {sorted(row)}, expected {sorted(names)}.")
+                rows.append([row[n] for n in names])
+            values = np.array(rows, dtype=float)
+        elif isinstance(table, dict):
+            names = list(table.keys())
+            values = np.column_stack([np.asarray(table[n], dtype=float) for n in names])
+        else:
+            raise ValueError(f"Unsupported table layout in '{path}'.")
+    elif ext == '.csv':
+        with open(path, 'r', newline='') as f:
+            reader = csv.reader(row for row in f if not row.lstrip().startswith('#'))
+            names = [n.strip() for n in next(reader)]
+            values = np.array([[float(v) for v in row] for row in reader if row], dtype=float)
+    elif ext == '.npy':
+        arr = np.load(path)
+        if arr.dtype.names is None:
+            raise ValueError(f"'{path}' must hold a structured array with the parameter names as fields.")
+        names = list(arr.dtype.names)
+        values = np.column_stack([arr[n].astype(float) for n in names])
+    else:
+        raise ValueError(f"Unsupported table format '{ext}', use .yaml, .csv or .npy.")
+    return names, values.reshape(-1, len(names))
@@ -2,9 +2,10 @@
 # Credit: https://github.com/ahnyu/hod-variation/
 
 import numpy as np
+from obs_bundle import bundle_settings, bundle_is_valid, load_bundle, write_bundle
 
 class data_object:
-    def __init__(self, data_params, hod_params, clustering_params):
+    def __init__(self, data_params, hod_params, clustering_params, bundle=None):
         """
         Initializes the data_object by reading data files specified in the parameters.
         
@@ -16,12 +17,17 @@ class data_object:
               - "tracer_density_std": mapping tracer (e.g., "LRG") to density standard deviation.
           hod_params (dict): Contains a "tracer_flags" dictionary indicating which tracers are active.
           clustering_params (dict): Contains at least the key "clustering_type" (either 'wp' or 'all').
+          bundle (str, optional): Path of a compiled observation bundle (see obs_bundle.py). If it
+              matches the parameters and its source files are unchanged, everything is read from it
+              as read-only memory maps; otherwise the text files are read and the bundle is (re)written.
         
         Attributes:
           - self.wp: Dictionary with composite keys → loaded wp arrays (using column 1).
           - self.xi02: Dictionary with composite keys → loaded xi02 arrays (using columns 1 and 3; only if clustering_type=='all').
           - self.cov: Dictionary with composite keys → loaded covariance arrays.
           - self.invcov: Dictionary with composite keys → inverse covariance matrices.
+          - self.whiten: Dictionary with composite keys → whitening matrices W = L^-1, where
+            cov = L L^T is the Cholesky factorisation, so that chi2 = |W (observed - theory)|².
           - self.density_mean: Dictionary keyed by tracer → observed mean densities.
           - self.density_std: Dictionary keyed by tracer → observed density standard deviations.
           - self.clustering: Dictionary with composite keys → flattened clustering data.
@@ -32,10 +38,17 @@ class data_object:
         self.xi02 = {}
         self.cov = {}
         self.invcov = {}
+        self.whiten = {}
         self.density_mean = {}
         self.density_std = {}
         self.clustering = {}
 
+        if bundle is not None:
+            settings = bundle_settings(data_params, hod_params, clustering_params)
+            if bundle_is_valid(bundle, settings):
+                self._load_bundle(bundle)
+                return
+
         tracer_flags = hod_params.get("tracer_flags", {})
         active_tracers = [tr for tr, flag in tracer_flags.items() if flag]
         cluster_type = clustering_params.get("clustering_type", "wp").lower()
@@ -57,7 +70,7 @@ class data_object:
             if cluster_type == "wp":
                 nwpbins = len(self.wp[composite_key])
                 self.cov[composite_key] = self.cov[composite_key][:nwpbins,:nwpbins]
-            self.invcov[composite_key] = np.linalg.inv(self.cov[composite_key])
+            self._factorize(composite_key)
             if tracer in density_mean_all:
                 self.density_mean[tracer] = density_mean_all[tracer]
             else:
@@ -76,6 +89,46 @@ class data_object:
             else:
                 self.clustering[composite_key] = np.ravel(self.wp[composite_key])
 
+        if bundle is not None:
+            self._save_bundle(bundle, settings)
+
+    _BUNDLED = ("wp", "xi02", "cov", "invcov", "whiten", "clustering")
+
+    def _save_bundle(self, path, settings):
+        """Compile the loaded data into a bundle at `path`."""
+        arrays = {f"{name}/{key}": arr for name in self._BUNDLED for key, arr in getattr(self, name).items()}
+        try:
+            write_bundle(path, arrays, settings)
+            print(f"Observation bundle written to {path}")
+        except OSError as e:
+            print(f"Warning: could not write observation bundle {path}: {e}")
+
+    def _load_bundle(self, path):
+        """Fill the attributes from the bundle at `path`."""
+        header, arrays = load_bundle(path)
+        for name, arr in arrays.items():
+            attr, key = name.split("/", 1)
+            getattr(self, attr)[key] = arr
+        settings = header["settings"]
+        self.density_mean = {tr: v for tr, v in settings["density_mean"].items() if v is not None}
+        self.density_std = {tr: v for tr, v in settings["density_std"].items() if v is not None}
+
+    def _factorize(self, composite_key):
+        """
+        Precompute the whitening matrix of a covariance from its Cholesky factor.
+        Covariances that are not positive definite keep only the explicit inverse.
+        """
+        cov = self.cov[composite_key]
+        try:
+            chol = np.linalg.cholesky(cov)
+        except np.linalg.LinAlgError:
+            print(f"Warning: covariance of {composite_key} is not positive definite, using its inverse.")
+            self.invcov[composite_key] = np.linalg.inv(cov)
+            return
+        whiten = np.linalg.solve(chol, np.eye(len(cov)))
+        self.whiten[composite_key] = whiten
+        self.invcov[composite_key] = whiten.T.dot(whiten)
+
     def compute_loglike(self, theory_clustering, theory_density):
         """
         Compute the total log-likelihood from clustering and density parts.
@@ -112,3 +165,42 @@ class data_object:
             std = self.density_std[tracer]
             loglike_density += -0.5 * (diff ** 2 / (std ** 2))
         return loglike_cluster + loglike_density
+
+    def compute_loglike_batch(self, theory_clustering, theory_density):
+        """
+        Compute the total log-likelihood of many theory predictions at once.
+        
+        Same likelihood as `compute_loglike`, with the chi2 of each composite key
+        evaluated for the whole stack as |(observed - theory) W^T|² using the
+        precomputed whitening matrix.
+        
+        Parameters:
+          theory_clustering (dict): Dictionary with composite keys → theoretical clustering data,
+              arrays of shape (n_samples, n_bins).
+          theory_density (dict): Dictionary with tracer keys → theoretical number densities,
+              arrays of shape (n_samples,).
+        
+        Returns:
+          ndarray: Total log-likelihood of each sample, shape (n_samples,).
+        """
+        loglike = 0.0
+        for comp_key, observed in self.clustering.items():
+            if comp_key not in theory_clustering:
+                print(f"Warning: No theory clustering for {comp_key}.")
+                continue
+            diff = observed[None, :] - np.atleast_2d(theory_clustering[comp_key])
+            if comp_key in self.whiten:
+                res = diff.dot(self.whiten[comp_key].T)
+                chi2 = np.einsum('ij,ij->i', res, res)
+            else:
+                chi2 = np.einsum('ij,jk,ik->i', diff, self.invcov[comp_key], diff)
+            loglike = loglike - 0.5 * chi2
+
+        for tracer, obs_density in self.density_mean.items():
+            if tracer not in theory_density:
+                print(f"Warning: No theory density for tracer {tracer}.")
+                continue
+            diff = obs_density - np.asarray(theory_density[tracer], dtype=float)
+            std = self.density_std[tracer]
+            loglike = loglike - 0.5 * (diff ** 2 / (std ** 2))
+        return np.atleast_1d(loglike)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resident HOD evaluation server: the halo and subsample catalogs are loaded once and
+shared by every sampler that connects to it.
+
+One AbacusHOD instance is built per config (-c, one per sim_name/z_mock). The server
+then forks --max-concurrent worker processes, which share the loaded catalogs
+copy-on-write, and listens on a unix socket (or host:port) for HOD parameter sets.
+Each evaluation runs evaluate_hod with --nthread // --max-concurrent threads; requests
+of all clients queue for the workers in the order they arrive. Replies hold the
+clustering vector and number density of the mock and, when the config has a
+data_params section (as for data_object, `bundle` there is passed on as its bundle),
+the log-likelihood.
+
+Requests are pickled, so every connection is authenticated. The key is --authkey or
+$HOD_SERVER_AUTHKEY; without one, a unix-socket server generates a random key and writes
+it to <socket>.key (mode 0600), where clients of the same user read it. A host:port
+address needs an explicit key.
+
+Usage
+-----
+$ python ./hod_server.py -c QSO_c302.yaml -c QSO_c300.yaml --address hod.sock -n 64 --max-concurrent 4
+
+>>> from hod_server import HODClient
+>>> with HODClient('hod.sock') as client:
+...     res = client.evaluate(['logM_cut', 'logM1'], [12.0, 13.1])         # clustering, density, loglike
+...     loglikes = client.loglike(['logM_cut', 'logM1'], walkers)         # one row per parameter set
+"""
+import argparse
+import os
+import secrets
+import sys
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from AbacusHODmock import load_AbacusHOD, evaluate_hod, span
+from config_helper import AbacusConfig, load_config
+from data_object import data_object
+
+AUTHKEY_ENV = 'HOD_SERVER_AUTHKEY'
+
+
+def parse_address(address):
+    """'host:port' -> (host, port); anything else is the path of a unix socket."""
+    host, sep, port = str(address).rpartition(':')
+    if sep and port.isdigit() and '/' not in host:
+        return (host or 'localhost', int(port))
+    return str(address)
+
+
+def key_path(address):
+    """File of the generated key of a unix-socket server."""
+    return f'{address}.key'
+
+
+def get_authkey(authkey=None, address=None):
+    """
+    Authentication key as bytes: `authkey`, else $HOD_SERVER_AUTHKEY, else the key file of the
+    unix socket `address` (see key_path).
+
+    Raises:
+        ValueError: No key found.
+    """
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if authkey is None and isinstance(address, str) and os.path.isfile(key_path(address)):
+        with open(key_path(address), 'r') as f:
+            authkey = f.read().strip()
+    if not authkey:
+        raise ValueError(f"no authentication key for {address}: give authkey or set ${AUTHKEY_ENV}")
+    return authkey if isinstance(authkey, bytes) else authkey.encode()
+
+
+def write_key(path, key):
+    """Write `key` to a new file readable by the owner only."""
+    if os.path.lexists(path):
+        os.unlink(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key.decode())
+
+
+_server_balls = {}
+
+def _server_worker(key, names, values, tracer, nthread):
+    return evaluate_hod(_server_balls[key], names, values, tracer=tracer, nthread=nthread)
+
+
+class HODServer:
+    """
+    AbacusHOD instances kept in memory and evaluated for clients.
+
+    Parameters:
+        configs (list): Paths of AbacusHOD config files, one per sim_name/z_mock.
+        nthread (int): Total thread budget of the evaluations.
+        max_concurrent (int): Number of evaluations running at once; each gets
+            nthread // max_concurrent threads.
+        address (str or tuple): Unix socket path, or (host, port).
+        authkey (bytes, optional): Key clients must present, default $HOD_SERVER_AUTHKEY. Without
+            either, a unix-socket server generates one and writes it to key_path(address) while
+            it serves; a (host, port) address raises ValueError.
+    """
+
+    def __init__(self, configs, nthread=16, max_concurrent=1, address='hod_server.sock', authkey=None):
+        self.address = parse_address(address)
+        if authkey is None:
+            authkey = os.environ.get(AUTHKEY_ENV)
+        self.keyfile = None
+        if not authkey:
+            if not isinstance(self.address, str):
+                raise ValueError(f"serving on {self.address} needs an authentication key: give authkey or set ${AUTHKEY_ENV}")
+            authkey = secrets.token_hex(32)
+            self.keyfile = key_path(self.address)
+        self.authkey = authkey if isinstance(authkey, bytes) else authkey.encode()
+        self.nthread = int(nthread)
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.nthread_each = max(1, self.nthread // self.max_concurrent)
+        self.balls = {}
+        self.data = {}
+        self.pool = None
+        self._stop = threading.Event()
+        for path in configs:
+            self.load(path)
+
+    def load(self, config_path):
+        """Build the AbacusHOD instance (and data_object, if data_params is given) of one config."""
+        cfg = AbacusConfig.from_yaml(config_path)
+        key = (cfg.sim.sim_name, float(cfg.sim.z_mock))
+        if key in self.balls:
+            raise ValueError(f"{config_path}: {key[0]} at z={key[1]} is loaded already")
+        sim_params, HOD_params, clustering_params = cfg.sections()
+        AbacusHOD = load_AbacusHOD()
+        with span('AbacusHOD_init', sim=key[0]):
+            self.balls[key] = AbacusHOD(sim_params, HOD_params, clustering_params)
+        data_params = (load_config(config_path) or {}).get('data_params')
+        if data_params:
+            self.data[key] = data_object(data_params, HOD_params, clustering_params, bundle=data_params.get('bundle'))
+        print(f"Loaded {key[0]} at z={key[1]} from {config_path}" + (" with data" if data_params else ""))
+
+    def sim_key(self, sim=None):
+        """
+        Key (sim_name, z_mock) of a loaded instance.
+
+        Parameters:
+            sim (tuple or str, optional): (sim_name, z_mock), or sim_name if it is loaded at one
+                redshift only; may be omitted when a single instance is loaded.
+        """
+        if sim is None:
+            if len(self.balls) != 1:
+                raise ValueError(f"{len(self.balls)} simulations are loaded, give sim=(sim_name, z_mock) of {list(self.balls)}")
+            return next(iter(self.balls))
+        if isinstance(sim, str):
+            keys = [k for k in self.balls if k[0] == sim]
+        else:
+            keys = [k for k in self.balls if k == (sim[0], float(sim[1]))]
+        if len(keys) != 1:
+            raise ValueError(f"sim={sim} matches {len(keys)} of the loaded simulations {list(self.balls)}")
+        return keys[0]
+
+    def info(self):
+        """Loaded simulations with their configured HOD parameters, and the thread budget."""
+        sims = [{'sim_name': k[0], 'z_mock': k[1], 'tracers': ball.tracers, 'data': k in self.data}
+                for k, ball in self.balls.items()]
+        return {'sims': sims, 'nthread': self.nthread, 'max_concurrent': self.max_concurrent,
+                'nthread_each': self.nthread_each}
+
+    def evaluate(self, names, values, tracer=None, sim=None):
+        """
+        Evaluate one HOD parameter set, or a stack of them, on the worker processes.
+
+        Parameters:
+            names (list): HOD parameter names of `tracer`.
+            values (array_like): Their values, shape (len(names),) or (n_sets, len(names)).
+            tracer (str, optional): Tracer whose parameters are set (default: the first active tracer).
+            sim (tuple or str, optional): Instance to use, see sim_key.
+
+        Returns:
+            dict: 'clustering', 'density' and, with data, 'loglike'; one row per parameter set
+                for a stack (rows that failed are NaN, their errors are in 'errors').
+        """
+        key = self.sim_key(sim)
+        ball = self.balls[key]
+        if tracer is None:
+            tracer = list(ball.tracers.keys())[0]
+        unknown = [n for n in names if n not in ball.tracers[tracer]]
+        if unknown:
+            raise ValueError(f"Unknown {tracer} HOD parameters: {unknown}")
+        values = np.asarray(values, dtype=float)
+        table = np.atleast_2d(values)
+        pending = [self.pool.apply_async(_server_worker, (key, list(names), row, tracer, self.nthread_each))
+                   for row in table]
+        results, errors = [], {}
+        for i, res in enumerate(pending):
+            try:
+                results.append(res.get())
+            except Exception as e:
+                results.append(None)
+                errors[i] = f"{type(e).__name__}: {e}"
+        done = [r for r in results if r is not None]
+        if not done:
+            raise RuntimeError(f"All HOD parameter sets failed: {errors[0]}")
+        clustering = np.full((len(table), done[0][0].size), np.nan)
+        density = np.full(len(table), np.nan)
+        for i, r in enumerate(results):
+            if r is not None:
+                clustering[i], density[i] = r
+        out = {'clustering': clustering, 'density': density}
+        if key in self.data:
+            loglike = self.data[key].compute_loglike_batch({f'{tracer}_{tracer}': clustering}, {tracer: density})
+            out['loglike'] = np.where(np.isnan(density), np.nan, loglike)
+        if values.ndim == 1:
+            return {k: v[0] for k, v in out.items()}
+        if errors:
+            out['errors'] = errors
+        return out
+
+    def handle(self, conn):
+        """Serve the requests of one client until it disconnects."""
+        with conn:
+            while not self._stop.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                cmd = request.get('cmd')
+                try:
+                    if cmd == 'evaluate':
+                        reply = {'ok': True, 'result': self.evaluate(request['names'], request['values'],
+                                                                     tracer=request.get('tracer'),
+                                                                     sim=request.get('sim'))}
+                    elif cmd == 'info':
+                        reply = {'ok': True, 'result': self.info()}
+                    elif cmd == 'shutdown':
+                        reply = {'ok': True, 'result': None}
+                    else:
+                        raise ValueError(f"unknown command '{cmd}'")
+                except Exception as e:
+                    print(f"Warning: request '{cmd}' failed: {e}")
+                    reply = {'ok': False, 'error': f"{type(e).__name__}: {e}", 'traceback': traceback.format_exc()}
+                conn.send(reply)
+                if cmd == 'shutdown':
+                    self.shutdown()
+                    return
+
+    def shutdown(self):
+        """Stop accepting clients; serve_forever returns."""
+        if not self._stop.is_set():
+            self._stop.set()
+            try:
+                Client(self.address, authkey=self.authkey).close()  # wakes up accept()
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        """
+        Fork the workers and serve clients, one thread per connection, until a shutdown request.
+
+        The workers are forked before any client thread exists, and share the loaded
+        catalogs copy-on-write.
+        """
+        global _server_balls
+        _server_balls = self.balls
+        self.pool = mp.get_context('fork').Pool(self.max_concurrent)
+        # the socket and key file are created accessible to this user only
+        umask = os.umask(0o077)
+        try:
+            try:
+                if self.keyfile is not None:
+                    write_key(self.keyfile, self.authkey)
+                listener = Listener(self.address, authkey=self.authkey)
+            finally:
+                os.umask(umask)
+            with listener:
+                print(f"Serving {len(self.balls)} AbacusHOD instance(s) on {self.address}: "
+                      f"{self.max_concurrent} at a time with {self.nthread_each} threads each.")
+                while not self._stop.is_set():
+                    try:
+                        conn = listener.accept()
+                    except Exception as e:
+                        if not self._stop.is_set():
+                            print(f"Warning: connection refused: {e}")
+                        continue
+                    threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            _server_balls = {}
+            if self.keyfile is not None and os.path.exists(self.keyfile):
+                os.unlink(self.keyfile)
+        print("HOD server stopped.")
+
+
+class HODClient:
+    """
+    Connection to an HODServer; one per sampler process.
+
+    Parameters:
+        address (str or tuple): As given to the server ('host:port' or a unix socket path).
+        authkey (bytes, optional): See get_authkey; by default $HOD_SERVER_AUTHKEY or the key
+            file of a unix-socket server.
+    """
+
+    def __init__(self, address='hod_server.sock', authkey=None):
+        address = parse_address(address)
+        self.conn = Client(address, authkey=get_authkey(authkey, address))
+
+    def _call(self, **request):
+        self.conn.send(request)
+        reply = self.conn.recv()
+        if not reply['ok']:
+            raise RuntimeError(f"HOD server: {reply['error']}")
+        return reply['result']
+
+    def evaluate(self, names, values, tracer=None, sim=None):
+        """Clustering, density and (with data) log-likelihood, see HODServer.evaluate."""
+        return self._call(cmd='evaluate', names=list(names), values=np.asarray(values, dtype=float),
+                          tracer=tracer, sim=sim)
+
+    def loglike(self, names, values, tracer=None, sim=None):
+        """Log-likelihood of one parameter set (float) or of a stack of them (ndarray)."""
+        res = self.evaluate(names, values, tracer=tracer, sim=sim)
+        if 'loglike' not in res:
+            raise RuntimeError("HOD server: no data_params in the config of this simulation")
+        return res['loglike']
+
+    def info(self):
+        return self._call(cmd='info')
+
+    def shutdown(self):
+        """Stop the server (running evaluations of other clients are abandoned)."""
+        return self._call(cmd='shutdown')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArgParseFormatter(
+    argparse.RawDescriptionHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
+):
+    pass
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=ArgParseFormatter
+    )
+    parser.add_argument('-c', '--config', type=str, action='append', required=True, help='config path, repeat for each sim_name/z_mock')
+    parser.add_argument('-n', '--nthread', type=int, default=16, help='total number of threads')
+    parser.add_argument('--max-concurrent', type=int, default=1, help='number of evaluations running at once, sharing the thread budget')
+    parser.add_argument('-a', '--address', type=str, default='hod_server.sock', help='unix socket path, or host:port')
+    parser.add_argument('--authkey', type=str, default=None, help=f'authentication key (default: ${AUTHKEY_ENV}, else a generated key in <socket>.key; required for host:port)')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = HODServer(args.config, nthread=args.nthread, max_concurrent=args.max_concurrent,
+                       address=args.address, authkey=args.authkey)
+    server.serve_forever()
+    sys.exit(0)
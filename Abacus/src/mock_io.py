@@ -0,0 +1,168 @@
+# src/mock_io.py
+# Columnar binary output of AbacusHOD mocks.
+#
+# Each tracer of a mock_dict is written to a column directory
+#
+#     galaxies_rsd_dv/QSOs.cols/
+#         manifest.yaml   (nrows, column dtypes, scalar entries such as Ncent, the config)
+#         x.npy
+#         y.npy
+#         ...
+#
+# the native binary layout read by EZmock/src/catalog_io.py, so read_Abacus_mock and
+# the plotting scripts memory-map the columns instead of parsing QSOs.dat.
+
+import os
+import shutil
+import numpy as np
+import yaml
+
+MANIFEST = 'manifest.yaml'
+SUFFIX = '.cols'
+
+
+def mock_path(path2dir, tracer):
+    """
+    Column directory of a tracer in a mock directory.
+
+    Parameters:
+        path2dir (str): Mock directory, e.g. .../galaxies_rsd_dv.
+        tracer (str): Tracer name, e.g. 'QSO'.
+
+    Returns:
+        str: Path of {tracer}s.cols.
+    """
+    return os.path.join(str(path2dir), f"{tracer}s{SUFFIX}")
+
+
+def _to_builtin(obj):
+    """Plain Python types for yaml.safe_dump (numpy scalars, Paths, tuples)."""
+    if isinstance(obj, dict):
+        return {str(k): _to_builtin(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_builtin(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, os.PathLike):
+        return os.fspath(obj)
+    return obj
+
+
+def write_tracer(path, columns, config=None, meta=None):
+    """
+    Write the columns of one tracer to a column directory (atomically).
+
+    Parameters:
+        path (str): Output column directory.
+        columns (dict): Column name → 1-d array; all of the same length.
+        config (dict, optional): Configuration to store in the manifest (as written by save_config).
+        meta (dict, optional): Extra scalar entries for the manifest.
+
+    Returns:
+        str: The column directory.
+    """
+    path = str(path)
+    lengths = {len(v) for v in columns.values()}
+    if len(lengths) != 1:
+        raise ValueError(f"Columns of {path} have different lengths: {sorted(lengths)}")
+    tmpdir = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmpdir, exist_ok=True)
+    try:
+        dtypes = {}
+        for name, arr in columns.items():
+            arr = np.ascontiguousarray(arr)
+            np.save(os.path.join(tmpdir, f"{name}.npy"), arr)
+            dtypes[name] = arr.dtype.str
+        manifest = {'nrows': int(lengths.pop()), 'columns': dtypes}
+        if meta:
+            manifest['meta'] = _to_builtin(meta)
+        if config is not None:
+            manifest['config'] = _to_builtin(config)
+        with open(os.path.join(tmpdir, MANIFEST), 'w') as f:
+            yaml.safe_dump(manifest, f, sort_keys=False)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmpdir, path)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return path
+
+
+def write_mock(mock_dict, path2dir, config=None):
+    """
+    Write an AbacusHOD mock_dict in the columnar binary layout.
+
+    Array entries of each tracer become columns, scalar entries (e.g. Ncent) go to
+    the manifest together with `config`.
+
+    Parameters:
+        mock_dict (dict): Output of AbacusHOD.run_hod, tracer → {column: array}.
+        path2dir (str): Mock directory, e.g. .../galaxies_rsd_dv.
+        config (dict, optional): Configuration stored in each manifest.
+
+    Returns:
+        dict: tracer → column directory.
+    """
+    os.makedirs(str(path2dir), exist_ok=True)
+    paths = {}
+    for tracer, cat in mock_dict.items():
+        columns = {k: v for k, v in cat.items() if np.ndim(v) == 1}
+        meta = {k: v for k, v in cat.items() if np.ndim(v) == 0}
+        paths[tracer] = write_tracer(mock_path(path2dir, tracer), columns, config=config, meta=meta)
+        print(f"Save {tracer} mock ({len(next(iter(columns.values())))} galaxies) to: {paths[tracer]}")
+    return paths
+
+
+def read_manifest(path):
+    """
+    Manifest of a column directory.
+
+    Returns:
+        dict: nrows, columns (name → dtype), and meta/config if stored.
+    """
+    with open(os.path.join(str(path), MANIFEST), 'r') as f:
+        return yaml.safe_load(f)
+
+
+def read_mock(path, names=None, mmap=True):
+    """
+    Read columns of a mock written by write_mock.
+
+    Parameters:
+        path (str): Column directory (see mock_path).
+        names (list, optional): Columns to read, all by default.
+        mmap (bool): Return read-only memory maps instead of loading into memory.
+
+    Returns:
+        dict: Column name → array.
+    """
+    manifest = read_manifest(path)
+    names = list(manifest['columns']) if names is None else list(names)
+    out = {}
+    for name in names:
+        if name not in manifest['columns']:
+            raise KeyError(f"Column '{name}' not in {path}")
+        out[name] = np.load(os.path.join(str(path), f"{name}.npy"), mmap_mode='r' if mmap else None)
+    return out
+
+
+def export_text(path, path2txt=None, names=None):
+    """
+    Export a column directory to a whitespace-separated text file (opt-in).
+
+    Parameters:
+        path (str): Column directory.
+        path2txt (str, optional): Output file, default {tracer}s.dat next to the directory.
+        names (list, optional): Columns to write, all by default.
+
+    Returns:
+        str: The text file.
+    """
+    cols = read_mock(path, names)
+    if path2txt is None:
+        path2txt = str(path)[:-len(SUFFIX)] + '.dat'
+    header = ' '.join(cols)
+    fmt = ['%d' if np.issubdtype(c.dtype, np.integer) else '%.7g' for c in cols.values()]
+    np.savetxt(path2txt, np.column_stack(list(cols.values())), fmt=fmt, header=header)
+    return path2txt
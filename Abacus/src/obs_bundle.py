@@ -0,0 +1,147 @@
+# src/obs_bundle.py
+# Compiled observation bundle for data_object: data vectors, covariances and their
+# factorisations in one binary file, read back as read-only memory maps.
+
+import hashlib
+import json
+import os
+import numpy as np
+
+MAGIC = b'OBSBNDL1'
+ALIGN = 64
+
+
+def file_checksum(path):
+    """
+    SHA-1 of a file's contents.
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        str: Hex digest.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def bundle_settings(data_params, hod_params, clustering_params):
+    """
+    The part of the configuration a bundle depends on.
+
+    Parameters:
+        data_params (dict): As for data_object.
+        hod_params (dict): As for data_object (only "tracer_flags" is used).
+        clustering_params (dict): As for data_object (only "clustering_type" is used).
+
+    Returns:
+        dict: clustering_type, active tracers, their data paths and densities.
+    """
+    tracer_flags = hod_params.get("tracer_flags", {})
+    tracers = sorted(tr for tr, flag in tracer_flags.items() if flag)
+    combos = data_params.get("tracer_combos", {})
+    return {
+        'clustering_type': clustering_params.get("clustering_type", "wp").lower(),
+        'tracers': tracers,
+        'combos': {f"{tr}_{tr}": combos[f"{tr}_{tr}"] for tr in tracers if f"{tr}_{tr}" in combos},
+        'density_mean': {tr: data_params.get("tracer_density_mean", {}).get(tr) for tr in tracers},
+        'density_std': {tr: data_params.get("tracer_density_std", {}).get(tr) for tr in tracers},
+    }
+
+
+def source_files(settings):
+    """Data files read for `settings` (only the ones used by its clustering_type)."""
+    keys = ["path2wp", "path2cov"] + (["path2xi02"] if settings['clustering_type'] == "all" else [])
+    return sorted({os.path.abspath(paths[k]) for paths in settings['combos'].values() for k in keys if k in paths})
+
+
+def write_bundle(path, arrays, settings):
+    """
+    Write arrays into a bundle: MAGIC, header length (uint64), JSON header, then
+    the arrays at ALIGN-byte aligned offsets.
+
+    Parameters:
+        path (str): Bundle file.
+        arrays (dict): name → ndarray.
+        settings (dict): Output of bundle_settings; the checksums of its source files are recorded.
+    """
+    index = {}
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.asarray(arr)
+        index[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += -(-arr.nbytes // ALIGN) * ALIGN
+    header = {
+        'settings': settings,
+        'sources': {fn: file_checksum(fn) for fn in source_files(settings)},
+        'arrays': index,
+    }
+    blob = json.dumps(header).encode()
+    start = -(-(len(MAGIC) + 8 + len(blob)) // ALIGN) * ALIGN
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(start).tobytes())
+        f.write(blob)
+        for name, arr in arrays.items():
+            f.seek(start + index[name]['offset'])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, path)
+
+
+def read_header(path):
+    """
+    Header of a bundle, with the data offset under 'start'.
+
+    Returns:
+        dict or None: None if `path` is missing or not a bundle.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            start = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(start - len(MAGIC) - 8).rstrip(b'\0').decode())
+    except (FileNotFoundError, ValueError):
+        return None
+    header['start'] = start
+    return header
+
+
+def bundle_is_valid(path, settings):
+    """
+    Whether the bundle at `path` was compiled from `settings` and its source files are unchanged.
+    """
+    header = read_header(path)
+    if header is None or header['settings'] != json.loads(json.dumps(settings)):
+        return False
+    try:
+        return all(file_checksum(fn) == chk for fn, chk in header['sources'].items())
+    except FileNotFoundError:
+        return False
+
+
+def load_bundle(path):
+    """
+    Open a bundle; arrays are read-only memory maps, so pages are only read when
+    used and are shared between processes through the page cache.
+
+    Returns:
+        header (dict): Bundle header.
+        arrays (dict): name → np.memmap.
+    """
+    header = read_header(path)
+    if header is None:
+        raise ValueError(f"'{path}' is not an observation bundle")
+    arrays = {}
+    for name, desc in header['arrays'].items():
+        shape = tuple(desc['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=desc['dtype'])
+            continue
+        arrays[name] = np.memmap(path, dtype=desc['dtype'], mode='r', offset=header['start'] + desc['offset'], shape=shape)
+    return header, arrays
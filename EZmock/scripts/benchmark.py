@@ -0,0 +1,289 @@
+"""
+Benchmarks of the catalog I/O and measurement paths on synthetic periodic boxes.
+
+Catalogs (uniform Poisson or lognormal, see src/synthetic.py) are generated
+locally, so no external data is needed. Cases:
+
+    read     text parsing (np.loadtxt), conversion to the binary cache, memory-mapped read
+    pk       prep_ref.measure_pk   (settings of conf/fitEZ.yaml)
+    xi       prep_ref.measure_xi
+    bk       prep_ref.measure_bk
+    loglike  Abacus data_object.compute_loglike vs compute_loglike_batch
+
+With --backends, pk, xi and bk are timed with each of the listed backends of
+src/clus_backends.py that is installed (on the same catalogs), otherwise with
+the backend configured in fitEZ.yaml.
+
+Results are written as JSON together with machine information; `compare`
+reports the ratio of two result files and flags regressions.
+
+Usage
+-----
+$ python scripts/benchmark.py run --sizes 1e5,1e6 --lbox 1000 --cases read,pk,bk --ncpu 8
+$ python scripts/benchmark.py run --sizes 1e6 --lbox 2000 --cases pk,xi --backends native,catinbox,pyfcfc,pypower
+$ python scripts/benchmark.py compare bench/old.json bench/new.json --threshold 0.15
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+import numpy as np
+
+ezdir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+for d in (os.path.join(ezdir, "src"), os.path.join(ezdir, "..", "Abacus", "src")):
+    if d not in sys.path:
+        sys.path.insert(0, d)
+
+CASES = ('read', 'pk', 'xi', 'bk', 'loglike')
+
+
+def machine_info():
+    info = {
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'cpu_affinity': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None,
+        'omp_num_threads': os.environ.get('OMP_NUM_THREADS'),
+    }
+    try:
+        import scipy
+        info['scipy'] = scipy.__version__
+    except ImportError:
+        info['scipy'] = None
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            info['cpu'] = next((l.split(':', 1)[1].strip() for l in f if l.startswith('model name')), None)
+    except OSError:
+        info['cpu'] = platform.processor() or None
+    try:
+        info['git'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ezdir, capture_output=True, text=True,
+                                     check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['git'] = None
+    return info
+
+
+def peak_rss():
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def make_catalog(kind, n, lbox, seed):
+    import synthetic
+    if kind == 'poisson':
+        return synthetic.poisson_box(n, lbox, seed=seed)
+    if kind == 'lognormal':
+        return synthetic.lognormal_box(n, lbox, ngrid=128, seed=seed)
+    raise ValueError(f"unknown catalog kind '{kind}'")
+
+
+def bench_read(x, y, z, workdir, tag, repeat, loadtxt_max):
+    import catalog_io
+    import synthetic
+    path = os.path.join(workdir, f'{tag}.dat')
+    if not os.path.isfile(path):
+        synthetic.write_text(path, x, y, z)
+    out = {}
+    if len(x) <= loadtxt_max:
+        out['read_text'] = timeit(lambda: np.loadtxt(path, usecols=(0, 1, 2)), repeat)
+    cache = path + catalog_io.CACHE_SUFFIX
+    out['read_convert'] = timeit(lambda: catalog_io.convert_text(path, cache), repeat)
+
+    def read_binary():
+        cols = catalog_io.load_catalog(path, verbose=False)
+        # touch the pages
+        return sum(float(c.sum()) for c in cols.values())
+    out['read_binary'] = timeit(read_binary, repeat)
+    return out
+
+
+def bench_loglike(workdir, nsamples, repeat, seed):
+    from data_object import data_object
+    rng = np.random.default_rng(seed)
+    nwp, nxi = 15, 10
+    nbin = nwp + 2 * nxi
+    files = {k: os.path.join(workdir, f'loglike_{k}.txt') for k in ('wp', 'xi02', 'cov')}
+    np.savetxt(files['wp'], np.column_stack((np.arange(nwp), rng.random(nwp))))
+    np.savetxt(files['xi02'], np.column_stack((np.arange(nxi), rng.random(nxi), np.zeros(nxi), rng.random(nxi))))
+    a = rng.standard_normal((nbin, 2 * nbin))
+    np.savetxt(files['cov'], a @ a.T / (2 * nbin) + np.eye(nbin))
+    data_params = {'tracer_combos': {'QSO_QSO': {'path2wp': files['wp'], 'path2xi02': files['xi02'], 'path2cov': files['cov']}},
+                   'tracer_density_mean': {'QSO': 1e-4}, 'tracer_density_std': {'QSO': 1e-5}}
+    d = data_object(data_params, {'tracer_flags': {'QSO': True}}, {'clustering_type': 'all'})
+    theory = d.clustering['QSO_QSO'][None, :] + 0.1 * rng.standard_normal((nsamples, nbin))
+    dens = 1e-4 + 1e-5 * rng.standard_normal(nsamples)
+
+    def loop():
+        return [d.compute_loglike({'QSO_QSO': theory[i]}, {'QSO': dens[i]}) for i in range(nsamples)]
+    return {
+        'loglike': timeit(loop, repeat),
+        'loglike_batch': timeit(lambda: d.compute_loglike_batch({'QSO_QSO': theory}, {'QSO': dens}), repeat),
+    }
+
+
+def run(args):
+    workdir = os.path.abspath(args.workdir)
+    out_path = os.path.abspath(args.out) if args.out else None
+    os.chdir(ezdir)  # prep_ref reads conf/fitEZ.yaml relative to EZmock/
+    import prep_ref
+    import clus_backends
+    prep_ref.ncpu = args.ncpu
+    config = prep_ref.load_config()['clustering']
+    os.makedirs(workdir, exist_ok=True)
+    sizes = [int(float(s)) for s in args.sizes.split(',')]
+    lboxes = [float(l) for l in args.lbox.split(',')]
+    kinds = args.kinds.split(',')
+    cases = args.cases.split(',')
+    for c in cases:
+        if c not in CASES:
+            raise ValueError(f"unknown case '{c}', choose from {CASES}")
+
+    results = []
+
+    def backends(stat):
+        """Backends to time for `stat`: the requested ones that are installed, else None (the configured one)."""
+        if args.backends is None:
+            return [None]
+        names = []
+        for b in args.backends.split(','):
+            if b not in clus_backends.backends(stat):
+                continue
+            if not clus_backends.available(stat, b):
+                print(f"{stat:<14} backend {b} not installed, skipped")
+            elif b == 'external' and not config[stat].get('external'):
+                print(f"{stat:<14} backend external not configured in fitEZ.yaml, skipped")
+            else:
+                names.append(b)
+        return names
+
+    def record(case, kind, n, lbox, times, **extra):
+        extra = {k: v for k, v in extra.items() if v is not None}
+        rec = {'case': case, 'kind': kind, 'n': n, 'lbox': lbox, 'seconds': min(times), 'times': times,
+               'peak_rss': peak_rss(), **extra}
+        results.append(rec)
+        label = f"{case}:{extra['backend']}" if 'backend' in extra else case
+        print(f"{label:<14} {kind:<10} n={n:<9d} L={lbox:<7g} {min(times):10.3f} s")
+
+    for kind in kinds if any(c != 'loglike' for c in cases) else []:
+        for lbox in lboxes:
+            for n in sizes:
+                x, y, z = make_catalog(kind, n, lbox, args.seed)
+                ntrue = len(x)
+                tag = f'{kind}_n{n}_L{lbox:g}_s{args.seed}'
+                if 'read' in cases:
+                    for name, times in bench_read(x, y, z, workdir, tag, args.repeat, args.loadtxt_max).items():
+                        record(name, kind, ntrue, lbox, times)
+                if 'pk' in cases:
+                    for b in backends('pk'):
+                        times = timeit(lambda: prep_ref.measure_pk(x, y, z, lbox=lbox, ngrid=args.ngrid, backend=b), args.repeat)
+                        record('pk', kind, ntrue, lbox, times, ngrid=args.ngrid, settings=config['pk'], backend=b)
+                if 'xi' in cases:
+                    if ntrue <= args.xi_max:
+                        for b in backends('xi'):
+                            times = timeit(lambda: prep_ref.measure_xi(x, y, z, lbox=lbox, backend=b), args.repeat)
+                            record('xi', kind, ntrue, lbox, times, settings=config['xi'], backend=b)
+                    else:
+                        print(f"xi             {kind:<10} n={ntrue:<9d} skipped (above --xi-max)")
+                if 'bk' in cases:
+                    for b in backends('bk'):
+                        times = timeit(lambda: prep_ref.measure_bk(x, y, z, lbox=lbox, ngrid=args.ngrid, backend=b), args.repeat)
+                        record('bk', kind, ntrue, lbox, times, ngrid=args.ngrid, settings=config['bk'], backend=b)
+                del x, y, z
+    if 'loglike' in cases:
+        for name, times in bench_loglike(workdir, args.nsamples, args.repeat, args.seed).items():
+            record(name, '-', args.nsamples, 0.0, times)
+
+    out = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'args': vars(args),
+        'results': results,
+    }
+    path = out_path or os.path.join(workdir, f"bench_{platform.node()}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=1, default=str)
+    print('Save benchmark results to:', path)
+    return path
+
+
+def compare(args):
+    with open(args.old, 'r') as f:
+        old = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+    if old['machine'].get('cpu') != new['machine'].get('cpu'):
+        print(f"Warning: different machines ({old['machine'].get('cpu')} vs {new['machine'].get('cpu')})")
+
+    def key(r):
+        return (r['case'], r['kind'], r['n'], r['lbox'], r.get('ngrid'), r.get('backend'))
+    base = {key(r): r for r in old['results']}
+    nreg = 0
+    print(f"{'case':<14} {'kind':<10} {'n':>9} {'lbox':>7} {'old[s]':>10} {'new[s]':>10} {'ratio':>7}")
+    for r in new['results']:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        ratio = r['seconds'] / b['seconds'] if b['seconds'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  REGRESSION'
+            nreg += 1
+        elif ratio < 1 - args.threshold:
+            flag = '  faster'
+        case = f"{r['case']}:{r['backend']}" if 'backend' in r else r['case']
+        print(f"{case:<14} {r['kind']:<10} {r['n']:>9d} {r['lbox']:>7g} {b['seconds']:>10.3f} {r['seconds']:>10.3f} {ratio:>7.2f}{flag}")
+    print(f"{nreg} regression(s) beyond {args.threshold:.0%}.")
+    return nreg
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run', help='run the benchmarks')
+    p.add_argument('--sizes', type=str, default='1e5,1e6', help='Catalog sizes, comma separated (1e5 to 2e7)')
+    p.add_argument('--lbox', type=str, default='1000,2000', help='Box sizes, comma separated')
+    p.add_argument('--kinds', type=str, default='poisson,lognormal', help='Catalog kinds: poisson, lognormal')
+    p.add_argument('--cases', type=str, default=','.join(CASES), help=f'Cases, comma separated: {",".join(CASES)}')
+    p.add_argument('--ngrid', type=int, default=256, help='Mesh size for pk and bk')
+    p.add_argument('--ncpu', type=int, default=1, help='Threads of the measurements')
+    p.add_argument('--backends', type=str, default=None,
+                   help='Time pk/xi/bk with each of these backends (comma separated, see src/clus_backends.py); default: as configured')
+    p.add_argument('--repeat', type=int, default=3, help='Repetitions per case (the minimum is reported)')
+    p.add_argument('--seed', type=int, default=42, help='Seed of the synthetic catalogs')
+    p.add_argument('--xi-max', type=float, default=2e6, help='Skip xi for catalogs larger than this')
+    p.add_argument('--loadtxt-max', type=float, default=2e6, help='Skip np.loadtxt for catalogs larger than this')
+    p.add_argument('--nsamples', type=int, default=1000, help='Theory vectors for the loglike case')
+    p.add_argument('--workdir', type=str, default='bench', help='Directory for catalogs and results')
+    p.add_argument('--out', type=str, default=None, help='Results file (default: <workdir>/bench_<host>_<time>.json)')
+    p = sub.add_parser('compare', help='compare two result files')
+    p.add_argument('old', type=str, help='Baseline results')
+    p.add_argument('new', type=str, help='New results')
+    p.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown flagged as a regression')
+    p.add_argument('--fail', action='store_true', help='Exit with status 1 if there are regressions')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        nreg = compare(args)
+        if args.fail and nreg:
+            sys.exit(1)
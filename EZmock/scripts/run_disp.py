@@ -4,7 +4,8 @@ current_dir = os.getcwd()
 source_dir = os.path.join(current_dir, "src")
 if source_dir not in sys.path:
     sys.path.insert(0, source_dir)
-from disp2LPT_helper import run_disp_2lpt
+from disp2LPT_helper import run_disp_2lpt, run_disp_2lpt_batch, DISP_TEXT_DIR
+from disp_store import DISP_ROOT, DispStore
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run 2LPT displacement field generation")
@@ -13,7 +14,24 @@ def parse_args():
     parser.add_argument('--fnl', type=float, default=600, help='Non-Gaussianity parameter f_NL')
     parser.add_argument('--Lbox', type=int, default=2000, help='Box size in Mpc/h')
     parser.add_argument('--Ngrid', type=int, default=512, help='Grid size for the simulation')
+    parser.add_argument('--fix_amp', type=int, default=1, help='Fix the amplitude of the initial conditions (1 for calibration of EZmock)')
+    parser.add_argument('--seeds', type=str, default=None, help='Batch mode: seed range "first-last" (inclusive) or list "1,2,5"')
+    parser.add_argument('--njobs', type=int, default=None, help='Batch mode: number of concurrent 2LPT processes')
+    parser.add_argument('--ncores-per-job', type=int, default=1, help='Batch mode: OMP threads per 2LPT process')
+    parser.add_argument('--store', type=str, default=DISP_ROOT, help='Batch mode: root of the displacement store')
+    parser.add_argument('--exe', type=str, default=None, help='2LPTnonlocal executable')
+    parser.add_argument('--disp-dir', type=str, default=DISP_TEXT_DIR, help='Batch mode: directory where the executable writes disp{x,y,z}_{seed}.txt; "" for the job directory (executables that honour OutputDir)')
+    parser.add_argument('--native', action='store_true', help='Generate the fields in-process (src/disp_native.py) into <store>/native instead of running 2LPTnonlocal')
+    parser.add_argument('--order', type=int, default=2, help='Native mode: 1 for ZA, 2 for 2LPT')
+    parser.add_argument('--nthread', type=int, default=1, help='Native mode: FFT threads')
     return parser.parse_args()
+
+def parse_seeds(text):
+    if '-' in text:
+        first, last = text.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(s) for s in text.split(',')]
+
 args = parse_args()
 seed = args.seed
 redshift = args.redshift
@@ -21,4 +39,23 @@ fnl = args.fnl
 Lbox = args.Lbox
 Ngrid = args.Ngrid
 
-run_disp_2lpt(seed=seed, redshift=redshift, fnl=fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=1) # fixed amplitude for calibration of EZmock
+if args.native:
+    from disp_native import generate_disp
+    # native realisations differ from 2LPTnonlocal ones with the same seed, keep them apart
+    store = DispStore(os.path.join(args.store, 'native'))
+    for s in parse_seeds(args.seeds) if args.seeds is not None else [seed]:
+        if store.has(s, redshift, Lbox, Ngrid, fnl, args.fix_amp):
+            print(f"Seed {s} already in {store.root}, skipped.")
+            continue
+        dx, dy, dz = generate_disp(s, redshift, fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=args.fix_amp, order=args.order, nthread=args.nthread)
+        path = store.save(dx, dy, dz, seed=s, redshift=redshift, Lbox=Lbox, Ngrid=Ngrid, fnl=fnl, fix_amp=args.fix_amp,
+                          extra={'generator': 'disp_native', 'order': args.order})
+        print(f"Saved native displacement field of seed {s} to {path}")
+elif args.seeds is None:
+    run_disp_2lpt(seed=seed, redshift=redshift, fnl=fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=args.fix_amp, exe=args.exe)
+else:
+    status = run_disp_2lpt_batch(parse_seeds(args.seeds), redshift=redshift, fnl=fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=args.fix_amp,
+                                 ncores_per_job=args.ncores_per_job, njobs=args.njobs, store=args.store, exe=args.exe,
+                                 disp_dir=args.disp_dir or None)
+    if 'failed' in status.values():
+        sys.exit(1)
@@ -0,0 +1,26 @@
+import argparse
+import sys, os
+source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+if source_dir not in sys.path:
+    sys.path.insert(0, source_dir)
+from disp_store import DispStore, DISP_ROOT
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Move dispx/dispy/dispz text files of 2LPTnonlocal into the binary displacement store")
+    parser.add_argument('--src-dir', type=str, default=DISP_ROOT, help='Directory with dispx_{seed}.txt etc.')
+    parser.add_argument('--store', type=str, default=DISP_ROOT, help='Root of the displacement store')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for initial conditions')
+    parser.add_argument('--redshift', type=float, default=2.0, help='Redshift of the displacements')
+    parser.add_argument('--fnl', type=float, default=600, help='Non-Gaussianity parameter f_NL')
+    parser.add_argument('--Lbox', type=float, default=2000, help='Box size in Mpc/h')
+    parser.add_argument('--Ngrid', type=int, default=512, help='Grid size')
+    parser.add_argument('--fix_amp', type=int, default=1, help='Whether the amplitude was fixed (0/1)')
+    parser.add_argument('--keep-text', action='store_true', help='Keep the text files after conversion')
+    return parser.parse_args()
+
+args = parse_args()
+fns = [os.path.join(args.src_dir, f'disp{c}_{args.seed}.txt') for c in 'xyz']
+store = DispStore(args.store)
+path = store.import_text(*fns, seed=args.seed, redshift=args.redshift, Lbox=args.Lbox, Ngrid=args.Ngrid,
+                         fnl=args.fnl, fix_amp=args.fix_amp, remove=not args.keep_text)
+print('Displacement field stored in', path)
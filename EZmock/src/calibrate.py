@@ -0,0 +1,443 @@
+"""
+Surrogate-driven calibration of the EZmock parameters (rho_c, rho_exp, pdf_base, sigma_v).
+
+Every evaluated point is recorded, with its pk/xi/bk residuals against the
+reference measurements (``pkref.txt``, ``xiref.txt``, ``bkref.txt``), in a
+SQLite table (`ResultStore`), indexed by the mock setup (Lbox, Ngrid, ntracer,
+seed, fnl, rsd_fac and the residual definition of the config) and the loss. A cheap surrogate of log(loss) over the parameter box
+-- a Gaussian process or a quadratic response surface -- is fitted to the
+recorded points, and batches of new points are proposed by minimising its lower
+confidence bound (each pick enters the fit at its predicted value before the
+next one, so a batch spreads out). Batches are evaluated in parallel with
+`ez_sweep.run_sweep`.
+
+The fit ranges, loss weights and parameter bounds are read from the
+``calibration`` section of ``conf/fitEZ.yaml``.
+
+Example
+-------
+>>> store = ResultStore(f'{odir}/calibration.sqlite')
+>>> best = calibrate(ez, store, refs=load_refs(pk_ref, xi_ref, bk_ref), ntracer=ntracer, rsd_fac=rsd_fac,
+...                  seed=seed, Lbox=Lbox, Ngrid=Ngrid, fnl=fnl_ic, nbatch=4, nworkers=4, max_evals=60)
+>>> best['param'], best['loss']
+"""
+import hashlib
+import io
+import json
+import sqlite3
+import time
+import numpy as np
+from prep_ref import load_config
+from ez_sweep import run_sweep
+
+PARAMS = ('rho_c', 'rho_exp', 'pdf_base', 'sigma_v')
+STATS = ('pk', 'xi', 'bk')
+
+
+def load_calibration_config(path='conf/fitEZ.yaml'):
+    """The ``calibration`` section of the config: ranges, weights and bounds."""
+    return load_config(path)['calibration']
+
+
+def load_refs(pk_ref, xi_ref, bk_ref):
+    """Reference tables, stat -> array (columns as written by `prep_ref.save_ref_clus`)."""
+    return {'pk': np.loadtxt(pk_ref), 'xi': np.loadtxt(xi_ref), 'bk': np.loadtxt(bk_ref)}
+
+
+## residuals -------------------------------------------------------------------
+
+def _in_range(x, lo, hi):
+    return (x >= lo) & (x <= hi) & np.isfinite(x)
+
+
+def residuals(res, refs, cfg):
+    """
+    Normalised residuals of measured tables against the references.
+
+    pk: (P_l - P_l,ref) / P_0,ref for l = 0, 2 within [kmin, kmax];
+    xi: s^2 (xi_l - xi_l,ref) / rms(s^2 xi_0,ref) for l = 0, 2 within [smin, smax];
+    bk: (Q - Q_ref) / rms(Q_ref).
+
+    Returns
+    -------
+    dict
+        stat -> residual vector, for the stats present in both `res` and `cfg['weights']`.
+    """
+    out = {}
+    weights = cfg['weights']
+    if 'pk' in res and weights.get('pk', 0):
+        t, r = np.asarray(res['pk']), refs['pk']
+        sel = _in_range(r[:, 0], cfg['pk']['kmin'], cfg['pk']['kmax']) & np.isfinite(r[:, 5]) & np.isfinite(t[:, 5])
+        out['pk'] = np.concatenate([(t[sel, c] - r[sel, c]) / r[sel, 5] for c in (5, 6)])
+    if 'xi' in res and weights.get('xi', 0):
+        t, r = np.asarray(res['xi']), refs['xi']
+        sel = _in_range(r[:, 0], cfg['xi']['smin'], cfg['xi']['smax'])
+        s2 = r[sel, 0] ** 2
+        norm = np.sqrt(np.mean((s2 * r[sel, 3]) ** 2))
+        out['xi'] = np.concatenate([s2 * (t[sel, c] - r[sel, c]) / norm for c in (3, 4)])
+    if 'bk' in res and weights.get('bk', 0):
+        t, r = np.asarray(res['bk']), refs['bk']
+        sel = np.isfinite(r[:, 5]) & np.isfinite(t[:, 5])
+        out['bk'] = (t[sel, 5] - r[sel, 5]) / np.sqrt(np.mean(r[sel, 5] ** 2))
+    return out
+
+
+def loss_of(resid, cfg):
+    """Weighted sum of the mean squared residuals; also returns the per-stat terms."""
+    terms = {s: float(np.mean(v ** 2)) for s, v in resid.items()}
+    return sum(cfg['weights'][s] * t for s, t in terms.items()), terms
+
+
+## result store ----------------------------------------------------------------
+
+def setup_tag(Lbox, Ngrid, ntracer, seed, fnl, rsd_fac, cfg):
+    """
+    Canonical string of a mock setup, the grouping key of the result table.
+    Losses depend on `rsd_fac` and the residual definition of `cfg` (ranges
+    and weights), so both are part of it; the parameter bounds are not.
+    """
+    resid = {s: cfg[s] for s in ('pk', 'xi', 'weights')}
+    resid = hashlib.sha1(json.dumps(resid, sort_keys=True, default=float).encode()).hexdigest()
+    return json.dumps({'Lbox': float(Lbox), 'Ngrid': int(Ngrid), 'ntracer': int(ntracer), 'seed': str(seed),
+                       'fnl': float(fnl), 'rsd_fac': float(rsd_fac), 'residuals': resid}, sort_keys=True)
+
+
+def point_key(param, tag):
+    """Key of a parameter set of the setup `tag` in the result table."""
+    rec = {'param': [float(p) for p in param], 'setup': tag}
+    return hashlib.sha1(json.dumps(rec, sort_keys=True).encode()).hexdigest()
+
+
+class ResultStore:
+    """
+    Evaluated points in a SQLite table.
+
+    One row per (parameters, setup), keyed by `point_key`, with the
+    per-stat residual terms, the loss and the residual vectors (as ``.npz``
+    bytes).
+
+    Parameters
+    ----------
+    path : str
+        Database file (created if missing); ':memory:' for a temporary store.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        key TEXT UNIQUE NOT NULL,
+        setup TEXT NOT NULL,
+        rho_c REAL, rho_exp REAL, pdf_base REAL, sigma_v REAL,
+        res_pk REAL, res_xi REAL, res_bk REAL,
+        loss REAL,
+        resid BLOB,
+        created REAL,
+        level INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS runs_setup_loss ON runs (setup, loss);
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(self.SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(runs)")]
+        if 'level' not in columns:
+            # tables written before the fidelity levels (multifidelity.py)
+            self.db.execute("ALTER TABLE runs ADD COLUMN level INTEGER")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def has(self, key):
+        return self.db.execute("SELECT 1 FROM runs WHERE key = ?", (key,)).fetchone() is not None
+
+    def add(self, key, param, setup, loss, terms, resid=None, level=None):
+        blob = None
+        if resid is not None:
+            arrays = {s: np.asarray(v) for s, v in resid.items()}
+            buf = io.BytesIO()
+            np.savez(buf, **arrays)
+            blob = buf.getvalue()
+        self.db.execute(
+            "INSERT OR REPLACE INTO runs (key, setup, rho_c, rho_exp, pdf_base, sigma_v, res_pk, res_xi, res_bk,"
+            " loss, resid, created, level) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, setup, *[float(p) for p in param], terms.get('pk'), terms.get('xi'), terms.get('bk'),
+             float(loss), blob, time.time(), level))
+        self.db.commit()
+
+    def _rows(self, query, args):
+        cur = self.db.execute(query, args)
+        names = [d[0] for d in cur.description]
+        out = []
+        for row in cur.fetchall():
+            rec = dict(zip(names, row))
+            rec['param'] = [rec[p] for p in PARAMS]
+            out.append(rec)
+        return out
+
+    def get(self, key):
+        """The recorded point `key` as a dict, or None."""
+        rows = self._rows("SELECT key, setup, level, rho_c, rho_exp, pdf_base, sigma_v, res_pk, res_xi, res_bk, loss"
+                          " FROM runs WHERE key = ?", (key,))
+        return rows[0] if rows else None
+
+    def points(self, setup):
+        """Parameters (n, 4) and losses (n,) of all points of a setup."""
+        rows = self.db.execute(
+            f"SELECT {', '.join(PARAMS)}, loss FROM runs WHERE setup = ? AND loss IS NOT NULL", (setup,)).fetchall()
+        if not rows:
+            return np.zeros((0, len(PARAMS))), np.zeros(0)
+        arr = np.array(rows, dtype=np.float64)
+        return arr[:, :-1], arr[:, -1]
+
+    def best(self, setup, n=1):
+        """The `n` points of a setup with the lowest loss, as dicts."""
+        return self._rows("SELECT key, setup, rho_c, rho_exp, pdf_base, sigma_v, res_pk, res_xi, res_bk, loss"
+                          " FROM runs WHERE setup = ? ORDER BY loss LIMIT ?", (setup, int(n)))
+
+    def residual_vectors(self, key):
+        row = self.db.execute("SELECT resid FROM runs WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        with np.load(io.BytesIO(row[0])) as f:
+            return {s: f[s] for s in f.files}
+
+
+## surrogates ------------------------------------------------------------------
+
+class QuadraticSurrogate:
+    """Full quadratic response surface, least squares; the prediction error is the regression standard error."""
+
+    @staticmethod
+    def _features(u):
+        d = u.shape[1]
+        cols = [np.ones(len(u))] + [u[:, i] for i in range(d)]
+        cols += [u[:, i] * u[:, j] for i in range(d) for j in range(i, d)]
+        return np.column_stack(cols)
+
+    def fit(self, u, y):
+        phi = self._features(u)
+        self.coef, *_ = np.linalg.lstsq(phi, y, rcond=None)
+        dof = max(len(y) - phi.shape[1], 1)
+        self.s2 = float(np.sum((y - phi.dot(self.coef)) ** 2) / dof)
+        self.cov = np.linalg.pinv(phi.T.dot(phi))
+        return self
+
+    def predict(self, u):
+        phi = self._features(u)
+        lev = np.einsum('ij,jk,ik->i', phi, self.cov, phi)
+        return phi.dot(self.coef), np.sqrt(self.s2 * (1 + lev))
+
+
+class GPSurrogate:
+    """
+    Gaussian process with a squared-exponential kernel on the unit parameter box.
+
+    The length scale is chosen on a grid by the marginal likelihood; the mean is constant.
+    """
+
+    LENGTHS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.8, 1.2)
+
+    def __init__(self, noise=1e-4):
+        self.noise = noise
+
+    @staticmethod
+    def _kernel(a, b, ell):
+        d2 = np.sum((a[:, None, :] - b[None, :, :]) ** 2, axis=-1)
+        return np.exp(-0.5 * d2 / ell ** 2)
+
+    def fit(self, u, y):
+        self.u = u
+        self.mu = float(np.mean(y))
+        self.amp = float(np.var(y)) or 1.0
+        yc = (y - self.mu) / np.sqrt(self.amp)
+        best = None
+        for ell in self.LENGTHS:
+            k = self._kernel(u, u, ell) + self.noise * np.eye(len(u))
+            try:
+                chol = np.linalg.cholesky(k)
+            except np.linalg.LinAlgError:
+                continue
+            alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, yc))
+            lml = -0.5 * yc.dot(alpha) - np.sum(np.log(np.diag(chol)))
+            if best is None or lml > best[0]:
+                best = (lml, ell, chol, alpha)
+        _, self.ell, self.chol, self.alpha = best
+        return self
+
+    def predict(self, u):
+        ks = self._kernel(u, self.u, self.ell)
+        mean = self.mu + np.sqrt(self.amp) * ks.dot(self.alpha)
+        v = np.linalg.solve(self.chol, ks.T)
+        var = np.clip(1 + self.noise - np.sum(v ** 2, axis=0), 1e-12, None)
+        return mean, np.sqrt(self.amp * var)
+
+
+SURROGATES = {'gp': GPSurrogate, 'quadratic': QuadraticSurrogate}
+
+
+## proposals -------------------------------------------------------------------
+
+def _to_unit(x, bounds):
+    lo, hi = bounds[:, 0], bounds[:, 1]
+    return (np.asarray(x, dtype=np.float64) - lo) / (hi - lo)
+
+
+def _from_unit(u, bounds):
+    lo, hi = bounds[:, 0], bounds[:, 1]
+    return lo + np.asarray(u) * (hi - lo)
+
+
+def latin_hypercube(n, d, rng):
+    """`n` points in the unit cube, one per stratum along every axis."""
+    u = (rng.permuted(np.tile(np.arange(n), (d, 1)), axis=1).T + rng.random((n, d))) / n
+    return u
+
+
+def propose(X, loss, bounds, nbatch, surrogate='gp', kappa=2.0, ncand=4096, min_dist=0.02, seed=None):
+    """
+    Propose a batch of parameter sets.
+
+    Parameters
+    ----------
+    X, loss : ndarray
+        Evaluated parameters (n, 4) and their losses.
+    bounds : array_like
+        (4, 2) lower and upper bounds.
+    surrogate : str
+        'gp' or 'quadratic' (needs at least 15 points, otherwise the GP is used).
+    kappa : float
+        Exploration weight of the lower confidence bound mean - kappa * std.
+    min_dist : float
+        Minimum distance, in units of the box, between the proposals and all other points.
+
+    Returns
+    -------
+    ndarray
+        (nbatch, 4) parameter sets.
+    """
+    rng = np.random.default_rng(seed)
+    bounds = np.asarray(bounds, dtype=np.float64)
+    d = len(bounds)
+    u = _to_unit(X, bounds)
+    y = np.log(np.maximum(loss, 1e-300))
+    cls = SURROGATES[surrogate]
+    if cls is QuadraticSurrogate and len(y) < 1 + 2 * d + d * (d - 1) // 2:
+        cls = GPSurrogate
+    # candidates: the whole box and the neighbourhood of the best points
+    cand = [rng.random((ncand, d))]
+    for i in np.argsort(y)[:4]:
+        cand.append(np.clip(u[i] + 0.05 * rng.standard_normal((ncand // 4, d)), 0, 1))
+    cand = np.vstack(cand)
+    picks = []
+    for _ in range(nbatch):
+        model = cls().fit(u, y)
+        mean, std = model.predict(cand)
+        score = mean - kappa * std
+        dist = np.min(np.linalg.norm(cand[:, None, :] - u[None, :, :], axis=-1), axis=1)
+        score[dist < min_dist] = np.inf
+        i = int(np.argmin(score))
+        if not np.isfinite(score[i]):
+            break
+        picks.append(cand[i])
+        # kriging believer: the pick enters the fit at its predicted value
+        u = np.vstack([u, cand[i]])
+        y = np.append(y, mean[i])
+    return _from_unit(np.array(picks).reshape(-1, d), bounds)
+
+
+## driver ----------------------------------------------------------------------
+
+def evaluate_batch(ez, params, store, refs, cfg, ntracer, rsd_fac, seed, Lbox, Ngrid, fnl, nworkers=1,
+                   sweep_cache=None, clus_cache=None, level=None, setup=None, setup_kwargs=None):
+    """
+    Measure a batch of parameter sets (in parallel) and record them; returns the losses.
+    `ez`, `setup` and `setup_kwargs` are as for `ez_sweep.run_sweep`.
+    """
+    tag = setup_tag(Lbox, Ngrid, ntracer, seed, fnl, rsd_fac, cfg)
+    stats = tuple(s for s in STATS if cfg['weights'].get(s, 0))
+    results = run_sweep([list(map(float, p)) for p in params], ntracer=ntracer, rsd_fac=rsd_fac, seed=seed,
+                        Lbox=Lbox, Ngrid=Ngrid, fnl=fnl, cache=sweep_cache, ez=ez, setup=setup,
+                        setup_kwargs=setup_kwargs, nworkers=nworkers, stats=stats, clus_cache=clus_cache)
+    losses = []
+    for p, res in zip(params, results):
+        resid = residuals(res, refs, cfg)
+        loss, terms = loss_of(resid, cfg)
+        store.add(point_key(p, tag), p, tag, loss, terms, resid, level=level)
+        losses.append(loss)
+    return np.array(losses)
+
+
+def calibrate(ez, store, refs, ntracer, rsd_fac, seed, Lbox, Ngrid, fnl, cfg=None, start=(), nbatch=4, nworkers=1,
+              max_evals=60, ninit=None, surrogate='gp', kappa=2.0, tol=1e-3, patience=3, sweep_cache=None,
+              clus_cache=None, rng_seed=0, level=None, setup=None, setup_kwargs=None):
+    """
+    Minimise the loss over the parameter box with surrogate-proposed batches.
+
+    Points already in `store` for this setup are reused, so an interrupted
+    calibration resumes where it stopped.
+
+    Parameters
+    ----------
+    start : sequence of parameter sets
+        Points to evaluate first (e.g. the current best guess).
+    nbatch : int
+        Points per batch, evaluated with `nworkers` processes.
+    max_evals : int
+        Total number of points of this setup (recorded ones included).
+    ninit : int, optional
+        Size of the initial Latin hypercube design, default 2 * nbatch.
+    tol, patience : float, int
+        Stop when the best loss improved by less than the fraction `tol` for
+        `patience` batches in a row.
+    level : int, optional
+        Fidelity level recorded with the points (see `multifidelity`).
+    setup, setup_kwargs : callable, dict, optional
+        EZmock setup of spawned workers, see `ez_sweep.run_sweep`; `ez` may
+        then be None.
+
+    Returns
+    -------
+    dict
+        Best point of the setup (``param``, ``loss``, per-stat residual terms).
+    """
+    cfg = cfg or load_calibration_config()
+    bounds = np.array([cfg['bounds'][p] for p in PARAMS], dtype=np.float64)
+    tag = setup_tag(Lbox, Ngrid, ntracer, seed, fnl, rsd_fac, cfg)
+    rng = np.random.default_rng(rng_seed)
+    ninit = ninit or 2 * nbatch
+    kwargs = dict(ntracer=ntracer, rsd_fac=rsd_fac, seed=seed, Lbox=Lbox, Ngrid=Ngrid, fnl=fnl, nworkers=nworkers,
+                  sweep_cache=sweep_cache, clus_cache=clus_cache, level=level, setup=setup, setup_kwargs=setup_kwargs)
+
+    def todo(params):
+        return [p for p in params if not store.has(point_key(p, tag))]
+
+    X, loss = store.points(tag)
+    first = todo([list(map(float, p)) for p in start])
+    if len(X) + len(first) < ninit:
+        design = _from_unit(latin_hypercube(ninit - len(X) - len(first), len(PARAMS), rng), bounds)
+        first += [list(map(float, np.round(p, 6))) for p in design]
+    if first:
+        print(f"Initial design: {len(first)} points")
+        evaluate_batch(ez, first, store, refs, cfg, **kwargs)
+    X, loss = store.points(tag)
+    best = loss.min()
+    stall = 0
+    while len(X) < max_evals and stall < patience:
+        n = min(nbatch, max_evals - len(X))
+        batch = propose(X, loss, bounds, n, surrogate=surrogate, kappa=kappa, seed=int(rng.integers(1 << 31)))
+        batch = todo([list(map(float, np.round(p, 6))) for p in batch])
+        if not batch:
+            break
+        evaluate_batch(ez, batch, store, refs, cfg, **kwargs)
+        X, loss = store.points(tag)
+        new = loss.min()
+        stall = stall + 1 if new > best * (1 - tol) else 0
+        best = min(best, new)
+        print(f"{len(X)} points, best loss {best:.4g}")
+    return store.best(tag)[0]
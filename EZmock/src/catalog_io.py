@@ -0,0 +1,298 @@
+"""
+Columnar binary cache for ASCII mock catalogs.
+
+The first read of a text catalog (e.g. ``galaxies_rsd_dv/QSOs.dat`` or an
+EZmock ``.dat`` file) converts the requested columns into one ``.npy`` file per
+column under ``<catalog>.cols/``, together with a small ``manifest.yaml``
+(source path, mtime, size, row count, column dtypes). Later reads memory-map the
+cached columns, so no text is parsed and no extra copy is made.
+
+Layout of a column directory::
+
+    QSOs.dat.cols/
+        manifest.yaml
+        x.npy
+        y.npy
+        z.npy
+
+A directory with the same layout but without a ``source`` entry in the manifest
+is a native binary catalog and is read directly.
+"""
+import itertools
+import os
+import shutil
+import numpy as np
+import yaml
+
+MANIFEST = 'manifest.yaml'
+CACHE_SUFFIX = '.cols'
+CHUNK_ROWS = 1_000_000
+
+
+def cache_dir_for(path):
+    """Default column directory of a text catalog."""
+    return str(path) + CACHE_SUFFIX
+
+
+def is_column_dir(path):
+    """Whether `path` is a directory in the column layout."""
+    return os.path.isfile(os.path.join(str(path), MANIFEST))
+
+
+def _is_numeric(line):
+    try:
+        [float(v) for v in line.split()]
+    except ValueError:
+        return False
+    return len(line.split()) > 0
+
+
+def _data_offset(f, comment='#'):
+    """
+    Byte offset of the first data row of a text catalog open in binary mode.
+
+    Comment lines are skipped. If the first non-comment line is not numeric
+    (the column-name line of the ECSV files written by AbacusHOD), it is
+    skipped as well.
+    """
+    f.seek(0)
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            return offset
+        if line.lstrip().startswith(comment.encode()):
+            continue
+        if not _is_numeric(line.decode()):
+            offset = f.tell()
+        return offset
+
+
+def _scan_text(path, comment='#'):
+    """
+    Locate the first data row of a text catalog and count the data rows.
+
+    Returns
+    -------
+    offset : int
+        Byte offset of the first data row (see `_data_offset`).
+    nrows : int
+        Number of data rows (upper bound if the file has trailing blank lines).
+    """
+    with open(path, 'rb') as f:
+        offset = _data_offset(f, comment)
+        f.seek(offset)
+        nrows = 0
+        last = b'\n'
+        while True:
+            block = f.read(1 << 24)
+            if not block:
+                break
+            nrows += block.count(b'\n')
+            last = block[-1:]
+        if last != b'\n':
+            nrows += 1
+    return offset, nrows
+
+
+def _source_stat(path):
+    st = os.stat(path)
+    return {'source': os.path.abspath(path), 'mtime': st.st_mtime, 'size': st.st_size}
+
+
+def read_manifest(cache_dir):
+    with open(os.path.join(str(cache_dir), MANIFEST), 'r') as f:
+        return yaml.safe_load(f)
+
+
+def write_manifest(cache_dir, manifest):
+    path = os.path.join(str(cache_dir), MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        yaml.safe_dump(manifest, f, sort_keys=False)
+    os.replace(path + '.tmp', path)
+
+
+def cache_is_valid(path, cache_dir, names=()):
+    """Whether `cache_dir` holds an up-to-date conversion of `path` with all `names`."""
+    if not is_column_dir(cache_dir):
+        return False
+    manifest = read_manifest(cache_dir)
+    stat = _source_stat(path)
+    if manifest.get('mtime') != stat['mtime'] or manifest.get('size') != stat['size']:
+        return False
+    return all(n in manifest['columns'] for n in names)
+
+
+def _same_conversion(path, cache_dir, manifest):
+    """Whether `cache_dir` is a valid cache of `path` with the columns and dtypes of `manifest`."""
+    return (cache_is_valid(path, cache_dir, manifest['columns'])
+            and read_manifest(cache_dir)['columns'] == manifest['columns'])
+
+
+def convert_text(path, cache_dir=None, names=('x', 'y', 'z'), usecols=(0, 1, 2), dtype='f4', chunk_rows=CHUNK_ROWS):
+    """
+    Convert columns of a text catalog into a column directory.
+
+    The text is parsed in chunks of `chunk_rows` rows straight into
+    memory-mapped ``.npy`` files, so peak memory stays at one chunk.
+
+    Parameters
+    ----------
+    path : str
+        Text catalog.
+    cache_dir : str, optional
+        Output directory, default ``<path>.cols``.
+    names, usecols : sequence
+        Names of the cached columns and their indices in the text file.
+    dtype : str or dict
+        Storage dtype, either one for all columns or a mapping name -> dtype.
+
+    Returns
+    -------
+    str
+        The column directory.
+    """
+    if len(names) != len(usecols):
+        raise ValueError("names and usecols must have the same length")
+    cache_dir = cache_dir_for(path) if cache_dir is None else str(cache_dir)
+    dtypes = {n: np.dtype(dtype[n] if isinstance(dtype, dict) else dtype) for n in names}
+    offset, nrows = _scan_text(path)
+    tmpdir = cache_dir + f'.tmp{os.getpid()}'
+    os.makedirs(tmpdir, exist_ok=True)
+    try:
+        cols = {n: np.lib.format.open_memmap(os.path.join(tmpdir, f'{n}.npy'), mode='w+', dtype=dtypes[n], shape=(nrows,))
+                for n in names}
+        nread = 0
+        with open(path, 'r') as f:
+            f.seek(offset)
+            while nread < nrows:
+                lines = itertools.islice(f, chunk_rows)
+                chunk = np.loadtxt(lines, usecols=usecols, ndmin=2)
+                if chunk.shape[0] == 0:
+                    break
+                for i, n in enumerate(names):
+                    cols[n][nread:nread + chunk.shape[0]] = chunk[:, i]
+                nread += chunk.shape[0]
+        for n in names:
+            cols[n].flush()
+        del cols
+        if nread != nrows:
+            # trailing blank lines: shrink the columns to the parsed rows
+            for n in names:
+                fn = os.path.join(tmpdir, f'{n}.npy')
+                np.save(fn + '.tmp.npy', np.load(fn, mmap_mode='r')[:nread])
+                os.replace(fn + '.tmp.npy', fn)
+        manifest = _source_stat(path)
+        manifest.update({
+            'nrows': int(nread),
+            'usecols': [int(c) for c in usecols],
+            'columns': {n: dtypes[n].str for n in names},
+        })
+        write_manifest(tmpdir, manifest)
+        if _same_conversion(path, cache_dir, manifest):
+            # another process finished the same conversion first and may be reading it
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return cache_dir
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            os.replace(tmpdir, cache_dir)
+        except OSError:
+            if not _same_conversion(path, cache_dir, manifest):
+                raise
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return cache_dir
+
+
+def write_columns(cache_dir, columns, meta=None):
+    """
+    Write in-memory columns as a native binary catalog (no ``source`` in the manifest).
+
+    Parameters
+    ----------
+    columns : dict
+        Column name -> 1-d array, all of the same length.
+    meta : dict, optional
+        Extra manifest entries.
+
+    Returns
+    -------
+    str
+        The column directory.
+    """
+    cache_dir = str(cache_dir)
+    nrows = {len(c) for c in columns.values()}
+    if len(nrows) != 1:
+        raise ValueError("columns must have the same length")
+    tmpdir = cache_dir + f'.tmp{os.getpid()}'
+    os.makedirs(tmpdir, exist_ok=True)
+    try:
+        for n, c in columns.items():
+            np.save(os.path.join(tmpdir, f'{n}.npy'), np.ascontiguousarray(c))
+        manifest = {'nrows': int(nrows.pop()), 'columns': {n: np.asarray(c).dtype.str for n, c in columns.items()}}
+        if meta:
+            manifest.update(meta)
+        write_manifest(tmpdir, manifest)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.replace(tmpdir, cache_dir)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return cache_dir
+
+
+def read_columns(cache_dir, names=None, mmap=True):
+    """
+    Read columns from a column directory.
+
+    Returns
+    -------
+    dict
+        Column name -> array. With ``mmap=True`` the arrays are read-only
+        memory maps (zero-copy views of the files).
+    """
+    manifest = read_manifest(cache_dir)
+    names = list(manifest['columns']) if names is None else list(names)
+    mode = 'r' if mmap else None
+    out = {}
+    for n in names:
+        if n not in manifest['columns']:
+            raise KeyError(f"column '{n}' not in {cache_dir}")
+        out[n] = np.load(os.path.join(str(cache_dir), f'{n}.npy'), mmap_mode=mode)
+    return out
+
+
+def load_catalog(path, names=('x', 'y', 'z'), usecols=(0, 1, 2), dtype='f4', cache_dir=None, rebuild=False, verbose=True):
+    """
+    Load columns of a catalog, building the binary cache on first use.
+
+    `path` may be a text catalog or a column directory. If the cache cannot be
+    written (e.g. read-only data directory or file system, full disk, and no
+    `cache_dir` given), the text is parsed into memory instead.
+
+    Returns
+    -------
+    dict
+        Column name -> array (memory-mapped when served from the cache).
+    """
+    path = str(path)
+    if is_column_dir(path):
+        return read_columns(path, names)
+    cache_dir = cache_dir_for(path) if cache_dir is None else str(cache_dir)
+    if rebuild or not cache_is_valid(path, cache_dir, names):
+        if verbose:
+            print(f"Converting {path} to binary cache {cache_dir}")
+        try:
+            convert_text(path, cache_dir, names=names, usecols=usecols, dtype=dtype)
+        except OSError as e:
+            print(f"Warning: cannot write cache ({e}), parsing text in memory.")
+            offset, _ = _scan_text(path)
+            with open(path, 'r') as f:
+                f.seek(offset)
+                data = np.loadtxt(f, usecols=usecols, ndmin=2, dtype=dtype if not isinstance(dtype, dict) else 'f8')
+            return {n: data[:, i] for i, n in enumerate(names)}
+    return read_columns(cache_dir, names)
@@ -0,0 +1,177 @@
+"""
+Rank-partitioned catalog reading for MPI measurements.
+
+Each MPI rank reads only its own part of a catalog, so a catalog is never
+parsed or held in full by every rank:
+
+* column directories (`catalog_io`, native or a valid cache of a text
+  catalog) are split by rows; each rank memory-maps the ``.npy`` files and
+  copies rows ``[start, stop)`` only;
+* text catalogs are split by bytes; each rank seeks to its byte range
+  (after the header, see `catalog_io._data_offset`), moves both ends forward
+  to the next line start and parses only the lines that start in its range.
+
+The slices are disjoint and together cover the catalog, which is what
+`pypower.CatalogFFTPower` expects with ``mpiroot=None`` (positions scattered
+over the ranks). `catalog_power` feeds them to it.
+
+Check on a single machine with::
+
+    mpirun -n 4 python src/catalog_mpi.py out/EZmock_L1000_....dat --check
+    mpirun -n 4 python src/catalog_mpi.py out/EZmock_L1000_....cols --boxsize 1000 --nmesh 256
+
+Example
+-------
+>>> from pypower import mpi
+>>> poles = catalog_power('QSOs.dat', boxsize=2000, nmesh=256, edges=edges, ells=(0, 2), mpicomm=mpi.COMM_WORLD)
+"""
+import argparse
+import io
+import itertools
+import os
+import numpy as np
+from catalog_io import CHUNK_ROWS, is_column_dir, cache_dir_for, cache_is_valid, read_columns, read_manifest, _data_offset
+
+
+def rank_slice(n, rank, size):
+    """Range [start, stop) of `rank` when `n` items are split as evenly as possible over `size` ranks."""
+    base, extra = divmod(int(n), int(size))
+    start = rank * base + min(rank, extra)
+    return start, start + base + (rank < extra)
+
+
+def _line_start(f, pos, lo):
+    """First line start at or after byte `pos` (`lo`: offset of the first data row)."""
+    if pos <= lo:
+        return lo
+    f.seek(pos - 1)
+    f.readline()  # the line holding byte pos - 1 belongs to the previous rank
+    return f.tell()
+
+
+def read_text_slice(path, rank, size, names=('x', 'y', 'z'), usecols=(0, 1, 2), dtype='f4', chunk_rows=CHUNK_ROWS):
+    """
+    Parse the lines of a text catalog whose first byte lies in the byte range of `rank`.
+
+    The data part of the file (after the header) is split into `size` equal
+    byte ranges; a line belongs to the range holding its first byte.
+
+    Returns
+    -------
+    dict
+        Column name -> array of the rows of this rank.
+    """
+    with open(path, 'rb') as f:
+        lo = _data_offset(f)
+        end = os.fstat(f.fileno()).st_size
+        a, b = rank_slice(end - lo, rank, size)
+        start = _line_start(f, lo + a, lo)
+        stop = _line_start(f, lo + b, lo) if b < end - lo else end
+        f.seek(start)
+        block = f.read(max(stop - start, 0))
+    parts = []
+    lines = io.TextIOWrapper(io.BytesIO(block))
+    while True:
+        chunk = list(itertools.islice(lines, chunk_rows))
+        if not chunk:
+            break
+        chunk = [line for line in chunk if line.strip()]
+        if chunk:
+            parts.append(np.loadtxt(chunk, usecols=usecols, ndmin=2).astype(dtype, copy=False))
+    del block
+    data = np.concatenate(parts) if parts else np.empty((0, len(usecols)), dtype=dtype)
+    return {n: np.ascontiguousarray(data[:, i]) for i, n in enumerate(names)}
+
+
+def read_column_slice(cache_dir, rank, size, names=('x', 'y', 'z')):
+    """Rows of `rank` of a column directory, copied from the memory maps."""
+    nrows = int(read_manifest(cache_dir)['nrows'])
+    start, stop = rank_slice(nrows, rank, size)
+    return {n: np.array(c[start:stop]) for n, c in read_columns(cache_dir, names).items()}
+
+
+def read_catalog_slice(path, mpicomm=None, names=('x', 'y', 'z'), usecols=(0, 1, 2), dtype='f4'):
+    """
+    Read the part of a catalog belonging to this MPI rank.
+
+    Parameters
+    ----------
+    path : str
+        Column directory or text catalog. A text catalog with a valid binary
+        cache (``<path>.cols``) is read from the cache; the cache is not built
+        here, since every rank would write it.
+    mpicomm : MPI communicator, optional
+        Default: a single rank reading everything.
+    names, usecols : sequence
+        Names of the columns and their indices in a text catalog.
+
+    Returns
+    -------
+    dict
+        Column name -> array of the local rows.
+    """
+    path = str(path)
+    rank, size = (0, 1) if mpicomm is None else (mpicomm.rank, mpicomm.size)
+    if is_column_dir(path):
+        return read_column_slice(path, rank, size, names)
+    if cache_is_valid(path, cache_dir_for(path), names):
+        return read_column_slice(cache_dir_for(path), rank, size, names)
+    return read_text_slice(path, rank, size, names=names, usecols=usecols, dtype=dtype)
+
+
+def catalog_power(path, boxsize, nmesh, edges, ells=(0, 2), mpicomm=None, names=('x', 'y', 'z'), usecols=(0, 1, 2),
+                  los='z', resampler='tsc', interlacing=3, dtype='f4'):
+    """
+    Power spectrum multipoles of a catalog with each rank reading its own slice.
+
+    The local positions go to `pypower.CatalogFFTPower` with ``mpiroot=None``.
+
+    Returns
+    -------
+    pypower.PowerSpectrumMultipoles
+        ``result.poles`` of `CatalogFFTPower`.
+    """
+    from pypower import CatalogFFTPower, mpi
+    mpicomm = mpi.COMM_WORLD if mpicomm is None else mpicomm
+    cols = read_catalog_slice(path, mpicomm, names=names, usecols=usecols, dtype=dtype)
+    pos = np.column_stack([cols[n] for n in names[:3]])
+    result = CatalogFFTPower(pos, data_weights1=np.ones(len(pos)), boxsize=boxsize, nmesh=nmesh,
+                             resampler=resampler, interlacing=interlacing, ells=ells, los=los, edges=edges,
+                             position_type='pos', mpicomm=mpicomm, mpiroot=None)
+    return result.poles
+
+
+def check_slices(path, mpicomm, names=('x', 'y', 'z'), usecols=(0, 1, 2)):
+    """Compare the union of the rank slices with a serial read on rank 0 (row count and column sums)."""
+    cols = read_catalog_slice(path, mpicomm, names=names, usecols=usecols, dtype='f8')
+    nlocal = len(cols[names[0]])
+    ntot = mpicomm.allreduce(nlocal)
+    sums = [mpicomm.allreduce(float(cols[n].sum())) for n in names]
+    nrank = mpicomm.gather(nlocal, root=0)
+    ok = True
+    if mpicomm.rank == 0:
+        ref = read_catalog_slice(path, None, names=names, usecols=usecols, dtype='f8')
+        ok = ntot == len(ref[names[0]]) and np.allclose(sums, [ref[n].sum() for n in names], rtol=1e-10)
+        print(f"{path}: {ntot} rows over {mpicomm.size} ranks {nrank}, serial {len(ref[names[0]])}: {'OK' if ok else 'MISMATCH'}")
+    return mpicomm.bcast(ok, root=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read a catalog with one slice per MPI rank (run under mpirun).')
+    parser.add_argument('path', help='Column directory or text catalog')
+    parser.add_argument('--check', action='store_true', help='Compare the slices with a serial read')
+    parser.add_argument('--boxsize', type=float, default=None, help='Measure P(k) multipoles in a box of this size')
+    parser.add_argument('--nmesh', type=int, default=256)
+    parser.add_argument('--usecols', type=int, nargs=3, default=(0, 1, 2))
+    args = parser.parse_args()
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    if args.check and not check_slices(args.path, comm, usecols=args.usecols):
+        comm.Abort(1)
+    if args.boxsize is not None:
+        kedges = np.linspace(0, args.nmesh * np.pi / args.boxsize, args.nmesh // 2 + 1)
+        poles = catalog_power(args.path, args.boxsize, args.nmesh, kedges, mpicomm=comm, usecols=args.usecols)
+        if comm.rank == 0:
+            k, p0 = poles(ell=0, return_k=True, complex=False)
+            for ki, pi in zip(k, p0):
+                print(f'{ki:.5f} {pi:.6e}')
@@ -0,0 +1,279 @@
+"""
+Registry of clustering estimators for pk, xi and bk.
+
+Every backend measures a catalog in a periodic box and returns the common
+result type of the repository: the table of its statistic, with the columns of
+``pkref.txt``/``xiref.txt``/``bkref.txt`` (`HEADERS`). A backend is selected
+with ``backend:`` under ``clustering: <stat>:`` in ``conf/fitEZ.yaml``; without
+it, the first available one of `DEFAULTS` is used.
+
+The modules behind a backend (catinbox, pyfcfc, pypower, the native
+estimators) are imported when the backend is first used, so importing this
+module (and `prep_ref`) costs nothing; `available` looks for them without
+importing them.
+
+Registered backends
+-------------------
+pk : catinbox, native (`powspec`), pypower, external
+xi : pyfcfc, native (`xi_box`), external
+bk : catinbox, native (`bispec`), external
+
+``external`` runs an executable on a temporary text catalog (x y z) and reads
+its output table. Its settings go under ``external:`` of the statistic::
+
+    pk:
+      backend: external
+      external:
+        command: '{exe} --conf conf/powspec.conf --data {catalog} --output {output} --box {lbox}'
+        columns: [0, 1, 2, 3, 4, 5, 6, 7]   # output columns in the order of HEADERS
+
+where ``{exe}`` is the path of ``clustering: executables: <stat>``.
+
+Example
+-------
+>>> @register('pk', 'mycode', requires=('mycode',))
+... def pk_mycode(x, y, z, **cfg):
+...     return table                                   # kcen kmin kmax kavg nmod P_0 P_2 P_4
+>>> table = measure('pk', x, y, z, backend='native', **pk_settings)
+"""
+import importlib
+import importlib.util
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+HEADERS = {
+    'pk': 'kcen kmin kmax kavg nmod P_0 P_2 P_4',
+    'xi': 's smin smax xi0 xi2',
+    'bk': 'theta theta_mean k3 modes B Q',
+}
+DEFAULTS = {
+    'pk': ('catinbox', 'native'),
+    'xi': ('pyfcfc', 'native'),
+    'bk': ('catinbox', 'native'),
+}
+PYFCFC_PATH = "/global/homes/s/siyizhao/lib/pyfcfc"
+FCFC_CONF = 'conf/fcfc_ref.conf'
+
+_registry = {}  # (stat, name) -> (function, required modules)
+
+
+def register(stat, name, requires=()):
+    """
+    Decorator adding `func(x, y, z, **cfg) -> table` as backend `name` of `stat`.
+
+    `requires` are the top-level modules the backend imports on use.
+    """
+    def deco(func):
+        _registry[(stat, name)] = (func, tuple(requires))
+        return func
+    return deco
+
+
+def lazy_import(name):
+    """Import a backend module on first use."""
+    if name.split('.')[0] == 'pyfcfc' and PYFCFC_PATH not in sys.path:
+        sys.path.append(PYFCFC_PATH)
+    return importlib.import_module(name)
+
+
+def _found(module):
+    if module == 'pyfcfc' and PYFCFC_PATH not in sys.path:
+        sys.path.append(PYFCFC_PATH)
+    return importlib.util.find_spec(module) is not None
+
+
+def backends(stat):
+    """Names of the backends registered for `stat`."""
+    return [name for s, name in _registry if s == stat]
+
+
+def available(stat, name):
+    """Whether backend `name` of `stat` is registered and its modules are installed (nothing is imported)."""
+    if (stat, name) not in _registry:
+        return False
+    return all(_found(m) for m in _registry[(stat, name)][1])
+
+
+def select(stat, name=None):
+    """
+    Backend of `stat`: `name` if given (it must be available), else the first available of `DEFAULTS`.
+
+    Raises
+    ------
+    ValueError
+        Unknown or unavailable backend.
+    """
+    if name is None:
+        for name in DEFAULTS[stat]:
+            if available(stat, name):
+                return name
+        raise ValueError(f"no {stat} backend available, tried {DEFAULTS[stat]}")
+    if (stat, name) not in _registry:
+        raise ValueError(f"unknown {stat} backend '{name}', choose from {backends(stat)}")
+    if not available(stat, name):
+        raise ValueError(f"{stat} backend '{name}' needs {_registry[(stat, name)][1]}, which is not installed")
+    return name
+
+
+def options(stat, name, clustering):
+    """Backend settings from the ``clustering`` section of fitEZ.yaml (``external:`` and its executable)."""
+    if name != 'external':
+        return {}
+    opts = dict(clustering[stat].get('external') or {})
+    if 'command' not in opts:
+        raise ValueError(f"clustering: {stat}: external: needs a 'command'")
+    exe = (clustering.get('executables') or {}).get(stat)
+    if exe is not None:
+        opts['exe'] = exe
+    return opts
+
+
+def measure(stat, x, y, z, backend=None, **cfg):
+    """Table of `stat` measured by `backend` (see `select`); `cfg` goes to the backend function."""
+    func, _ = _registry[(stat, select(stat, backend))]
+    return func(x, y, z, **cfg)
+
+
+## result tables ----------------------------------------------------------------
+
+def pk_table(res):
+    """Table of a `catinbox.powspec_box`-like result (attributes k, kedge, kmean, nmode, p0, p2, p4)."""
+    p4 = res.p4
+    if p4 is None:
+        p4 = np.zeros_like(res.p0)
+        print("Warning: P_4 is None, set to zero.")
+    return np.column_stack((res.k, res.kedge[:-1], res.kedge[1:], res.kmean, res.nmode, res.p0, res.p2, p4))
+
+
+def xi_table(xiref):
+    """Columns s smin smax xi0 xi2 of a `py_compute_cf`-like result."""
+    s = xiref['s']
+    smin = xiref['pairs']['smin'][:,0]
+    smax = xiref['pairs']['smax'][:,0]
+    xi0 = xiref['multipoles'][0][0]
+    xi2 = xiref['multipoles'][0][1]
+    return np.column_stack((s, smin, smax, xi0, xi2))
+
+
+def bk_table(res):
+    """Table of a `catinbox.bispec_box`-like result (attributes a, amean, k3, nmode, b, q)."""
+    return np.column_stack((res.a, res.amean, res.k3, res.nmode, res.b, res.q))
+
+
+## pk -----------------------------------------------------------------------------
+
+@register('pk', 'catinbox', requires=('catinbox',))
+def pk_catinbox(x, y, z, **cfg):
+    return pk_table(lazy_import('catinbox').powspec_box(x, y, z, **cfg))
+
+
+@register('pk', 'native')
+def pk_native(x, y, z, **cfg):
+    return pk_table(lazy_import('powspec').powspec_box(x, y, z, **cfg))
+
+
+@register('pk', 'pypower', requires=('pypower',))
+def pk_pypower(x, y, z, ngrid, lbox, kmin, kmax, nbin, assign='CIC', intlace=True, ncpu=1, **cfg):
+    """`pypower.CatalogFFTPower` in a single process; P_0 without shot noise, as the others."""
+    pypower = lazy_import('pypower')
+    pos = np.column_stack((x, y, z))
+    result = pypower.CatalogFFTPower(pos, boxsize=lbox, boxcenter=lbox / 2, nmesh=ngrid, resampler=assign.lower(),
+                                     interlacing=2 if intlace else False, ells=(0, 2, 4), los='z', wrap=True,
+                                     edges=np.linspace(kmin, kmax, nbin + 1), position_type='pos', mpiroot=None,
+                                     mpicomm=lazy_import('mpi4py.MPI').COMM_SELF)
+    poles = result.poles
+    kedge = poles.edges[0]
+    p0, p2, p4 = (poles(ell=ell, complex=False) for ell in (0, 2, 4))
+    return np.column_stack((0.5 * (kedge[1:] + kedge[:-1]), kedge[:-1], kedge[1:], poles.k, poles.nmodes, p0, p2, p4))
+
+
+## xi -----------------------------------------------------------------------------
+
+def fcfc_conf(lbox, conf=FCFC_CONF):
+    """FCFC configuration for box size `lbox`, derived from `conf` if it differs from BOX_SIZE there."""
+    with open(conf, 'r') as f:
+        lines = f.readlines()
+    for i, line in enumerate(lines):
+        if line.startswith('BOX_SIZE'):
+            if float(line.split('=')[1]) == float(lbox):
+                return conf
+            lines[i] = f'BOX_SIZE        = {float(lbox)}\n'
+    path = conf.replace('.conf', f'_L{lbox:g}.conf')
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    return path
+
+
+def pyfcfc_cf(xs, ys, zs, sedges, nmu=100, conf=FCFC_CONF):
+    """`pyfcfc.boxes.py_compute_cf` of an auto pair count, with the C output sent to /dev/null."""
+    py_compute_cf = lazy_import('pyfcfc.boxes').py_compute_cf
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    old_stdout_fd = os.dup(1)
+    old_stderr_fd = os.dup(2)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        data = np.column_stack((xs, ys, zs)).astype(np.float32)
+        w = np.ones(data.shape[0], dtype=np.float32)
+        return py_compute_cf([data, data], [w, w], sedges, None, nmu, conf=conf)
+    finally:
+        os.dup2(old_stdout_fd, 1)
+        os.dup2(old_stderr_fd, 2)
+        for fd in (old_stdout_fd, old_stderr_fd, devnull):
+            os.close(fd)
+
+
+@register('xi', 'pyfcfc', requires=('pyfcfc',))
+def xi_pyfcfc(x, y, z, lbox, smin, smax, nbin, nmu=100, conf=FCFC_CONF, **cfg):
+    return xi_table(pyfcfc_cf(x, y, z, np.linspace(smin, smax, nbin + 1), nmu, conf=fcfc_conf(lbox, conf)))
+
+
+@register('xi', 'native')
+def xi_native(x, y, z, lbox, smin, smax, nbin, nmu=100, ncpu=1, **cfg):
+    sedges = np.linspace(smin, smax, nbin + 1)
+    return xi_table(lazy_import('xi_box').xi_box(x, y, z, lbox, sedges, nmu=nmu, nthread=ncpu))
+
+
+## bk -----------------------------------------------------------------------------
+
+@register('bk', 'catinbox', requires=('catinbox',))
+def bk_catinbox(x, y, z, **cfg):
+    return bk_table(lazy_import('catinbox').bispec_box(x, y, z, **cfg))
+
+
+@register('bk', 'native')
+def bk_native(x, y, z, **cfg):
+    return bk_table(lazy_import('bispec').bispec_box(x, y, z, **cfg))
+
+
+## external executables -----------------------------------------------------------
+
+def run_external(stat, x, y, z, command, columns=None, exe=None, **cfg):
+    """
+    Measure with an external executable.
+
+    The catalog is written as text (x y z) to a temporary directory; `command`
+    is formatted with ``exe``, ``catalog``, ``output`` and the entries of `cfg`
+    (lbox, ngrid, ncpu, ...), run, and the table is read from ``output``.
+    """
+    with tempfile.TemporaryDirectory(prefix=f'clus_{stat}_') as tmp:
+        catalog = os.path.join(tmp, 'catalog.dat')
+        output = os.path.join(tmp, f'{stat}.txt')
+        np.savetxt(catalog, np.column_stack((x, y, z)), fmt='%.6f')
+        args = shlex.split(command.format(exe=exe, catalog=catalog, output=output, **cfg))
+        proc = subprocess.run(args, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"{args[0]} failed ({proc.returncode}): {proc.stderr.strip()[-2000:]}")
+        table = np.loadtxt(output, usecols=columns, ndmin=2)
+    ncol = len(HEADERS[stat].split())
+    if table.shape[1] != ncol:
+        raise ValueError(f"{args[0]} returned {table.shape[1]} columns, expected {ncol} ({HEADERS[stat]}); set 'columns'")
+    return table
+
+
+for _stat in HEADERS:
+    register(_stat, 'external')(lambda x, y, z, _stat=_stat, **cfg: run_external(_stat, x, y, z, **cfg))
@@ -0,0 +1,183 @@
+"""
+Content-addressed cache of clustering measurements (pk, xi, bk tables).
+
+An entry is keyed by the kind of measurement, a fingerprint of the input
+catalog and the effective estimator settings. Each entry is a pair of files
+``{key}.npy`` (the table) and ``{key}.json`` (what it was computed from), so
+several processes can share one cache directory without a common index. The
+``.json`` is written first, so a table without it is only ever a leftover of an
+interrupted write or removal; it is a miss, and such files are removed by `evict`.
+The least recently used entries are evicted once the cache exceeds `max_bytes`.
+"""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# age (s) after which a table or record without its counterpart is a leftover, not a write in progress
+ORPHAN_AGE = 60
+
+def _file_view(c):
+    """Byte offset into its file, strides and dtype of a memory-mapped column (or a view of one)."""
+    root = c
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    offset = int(root.offset) + c.ctypes.data - root.ctypes.data
+    return [offset, list(c.strides), str(c.dtype)]
+
+
+def catalog_fingerprint(x, y, z, path=None):
+    """
+    Fingerprint of a catalog.
+
+    If `path` is given, or the columns are memory maps of files (e.g. from
+    `catalog_io`), the fingerprint is built from file names, mtimes and sizes,
+    and for memory maps the position of the columns in the files (so slices of
+    one file differ); otherwise it is a SHA-1 of the column contents.
+    """
+    cols = (x, y, z)
+    views = None
+    if path is None and all(isinstance(c, np.memmap) and c.filename for c in cols):
+        path = [c.filename for c in cols]
+        views = [_file_view(c) for c in cols]
+    if path is not None:
+        paths = [path] if isinstance(path, (str, os.PathLike)) else path
+        rec = []
+        for p in paths:
+            st = os.stat(p)
+            rec.append([os.path.abspath(p), st.st_mtime, st.st_size])
+        rec.append([int(c.shape[0]) for c in cols])
+        if views is not None:
+            rec.append(views)
+        return 'file:' + hashlib.sha1(json.dumps(rec).encode()).hexdigest()
+    h = hashlib.sha1()
+    for c in cols:
+        c = np.ascontiguousarray(c)
+        h.update(str(c.dtype).encode() + str(c.shape).encode())
+        h.update(memoryview(c).cast('B'))
+    return 'sha1:' + h.hexdigest()
+
+
+class ClusCache:
+    """
+    Clustering measurements on disk.
+
+    Parameters
+    ----------
+    root : str
+        Cache directory.
+    max_bytes : int
+        Size limit of the cache; least recently used entries are evicted beyond it.
+    """
+
+    def __init__(self, root, max_bytes=1 << 30):
+        self.root = str(root)
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(kind, fingerprint, settings):
+        rec = {'kind': kind, 'catalog': fingerprint, 'settings': settings}
+        return hashlib.sha1(json.dumps(rec, sort_keys=True, default=float).encode()).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.root, f'{key}.npy'), os.path.join(self.root, f'{key}.json')
+
+    def get(self, key):
+        """Cached table, or None."""
+        fn, fn_meta = self._paths(key)
+        if not os.path.isfile(fn_meta):
+            if os.path.isfile(fn):
+                # table left by an interrupted put or remove
+                self.remove(key)
+            return None
+        try:
+            table = np.load(fn)
+        except (FileNotFoundError, ValueError):
+            return None
+        now = time.time()
+        try:
+            os.utime(fn_meta, (now, now))
+        except FileNotFoundError:
+            # evicted by another process meanwhile; the table is still valid
+            pass
+        return table
+
+    def put(self, key, table, kind, fingerprint, settings):
+        fn, fn_meta = self._paths(key)
+        with open(fn_meta + f'.tmp{os.getpid()}', 'w') as f:
+            json.dump({'kind': kind, 'catalog': fingerprint, 'settings': settings}, f, default=float)
+        os.replace(fn_meta + f'.tmp{os.getpid()}', fn_meta)
+        tmp = fn + f'.tmp{os.getpid()}.npy'
+        np.save(tmp, np.asarray(table))
+        os.replace(tmp, fn)
+        self.evict()
+
+    def entries(self):
+        """
+        key -> meta (with 'bytes' and 'atime') of all entries. A table or
+        record without its counterpart is listed with ``kind`` None and
+        ``orphan`` True.
+        """
+        out = {}
+        keys = {fn.rsplit('.', 1)[0] for fn in os.listdir(self.root)
+                if fn.endswith(('.npy', '.json')) and '.tmp' not in fn}
+        for key in keys:
+            fn_npy, fn_meta = self._paths(key)
+            try:
+                if os.path.isfile(fn_npy) and os.path.isfile(fn_meta):
+                    with open(fn_meta, 'r') as f:
+                        meta = json.load(f)
+                    meta['bytes'] = os.path.getsize(fn_npy) + os.path.getsize(fn_meta)
+                    meta['atime'] = os.path.getmtime(fn_meta)
+                else:
+                    fn = fn_npy if os.path.isfile(fn_npy) else fn_meta
+                    meta = {'kind': None, 'catalog': None, 'settings': None, 'orphan': True,
+                            'bytes': os.path.getsize(fn), 'atime': os.path.getmtime(fn)}
+            except (FileNotFoundError, ValueError):
+                continue
+            out[key] = meta
+        return out
+
+    def remove(self, key):
+        for fn in self._paths(key):
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used entries until the cache fits in `max_bytes`."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        stale = time.time() - ORPHAN_AGE
+        entries = []
+        for key, meta in sorted(self.entries().items(), key=lambda kv: kv[1]['atime']):
+            if meta.get('orphan') and meta['atime'] < stale:
+                self.remove(key)
+            else:
+                entries.append((key, meta))
+        total = sum(m['bytes'] for _, m in entries)
+        for key, meta in entries:
+            if total <= max_bytes:
+                break
+            self.remove(key)
+            total -= meta['bytes']
+
+    def invalidate(self, kind=None, fingerprint=None):
+        """
+        Remove entries of a measurement kind and/or a catalog fingerprint
+        (all entries if both are None). Returns the number of removed entries.
+        """
+        n = 0
+        for key, meta in self.entries().items():
+            if kind is not None and meta['kind'] != kind:
+                continue
+            if fingerprint is not None and meta['catalog'] != fingerprint:
+                continue
+            self.remove(key)
+            n += 1
+        return n
+
+    def clear(self):
+        return self.invalidate()
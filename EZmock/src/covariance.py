@@ -0,0 +1,281 @@
+"""
+Streaming covariance of mock data vectors.
+
+`CovAccumulator` keeps the running mean and the sum of squared deviations of
+the data vectors (Welford updates; batches and accumulators of other workers
+are combined with the pairwise merge of Chan et al.), so memory does not grow
+with the number of mocks. The state is checkpointed to ``.npz`` and reloaded
+to resume a run; the realisations already included are recorded as ranges of
+ids, so a resubmitted job skips them.
+
+The covariance is written as a plain text matrix, the format `data_object`
+reads from ``path2cov``. With ``hartlap=True`` the written matrix is the sample
+covariance divided by the Hartlap factor h = (n - p - 2) / (n - 1), so that the
+inverse `data_object` computes from it is the unbiased precision matrix
+h C^-1.
+
+Example
+-------
+>>> acc = CovAccumulator.open('out/cov_pk.npz')
+>>> for seed in range(100, 400):
+...     if seed in acc:
+...         continue
+...     res = measure(seed)                       # e.g. from ez_pipeline.run_pipeline
+...     acc.update(data_vector(res, ells=(0, 2), kmax=0.3), mock_id=seed)
+...     acc.save()
+>>> acc.write('out/cov_pk.txt', hartlap=True)
+"""
+import argparse
+import os
+import numpy as np
+
+# columns of the measured tables (see prep_ref.save_ref_clus)
+COLUMNS = {
+    'pk': {'x': 0, 'ells': {0: 5, 2: 6, 4: 7}},
+    'xi': {'x': 0, 'ells': {0: 3, 2: 4}},
+    'bk': {'x': 0, 'ells': {'B': 4, 'Q': 5}},
+}
+
+
+def data_vector(res, stats=('pk',), ells=(0, 2), kmin=None, kmax=None, smin=None, smax=None, bk='B'):
+    """
+    Concatenate measured multipoles into one data vector.
+
+    Parameters
+    ----------
+    res : dict
+        stat -> table, as returned by `ez_pipeline.run_pipeline` or `prep_ref.measure_*`.
+    stats : sequence of str
+        Statistics to include, in order ('pk', 'xi', 'bk').
+    ells : sequence of int
+        Multipoles of pk and xi.
+    kmin, kmax, smin, smax : float, optional
+        Scale cuts of pk and xi (on the bin centres).
+    bk : str
+        'B' or 'Q'.
+
+    Returns
+    -------
+    ndarray
+        The data vector, float64.
+    """
+    parts = []
+    for s in stats:
+        table = np.asarray(res[s])
+        x = table[:, COLUMNS[s]['x']]
+        if s == 'bk':
+            parts.append(table[:, COLUMNS[s]['ells'][bk]])
+            continue
+        lo, hi = (kmin, kmax) if s == 'pk' else (smin, smax)
+        sel = np.ones(len(x), dtype=bool)
+        if lo is not None:
+            sel &= x >= lo
+        if hi is not None:
+            sel &= x <= hi
+        for ell in ells:
+            parts.append(table[sel, COLUMNS[s]['ells'][ell]])
+    return np.concatenate(parts).astype(np.float64)
+
+
+def hartlap_factor(n, p):
+    """Hartlap et al. (2007) correction (n - p - 2) / (n - 1) of the inverse of a sample covariance."""
+    if n <= p + 2:
+        raise ValueError(f"{n} realisations are not enough for an inverse covariance of {p} bins (need > {p + 2})")
+    return (n - p - 2) / (n - 1)
+
+
+def _add_range(ranges, start, stop):
+    """Insert [start, stop) into a sorted list of disjoint ranges, merging neighbours."""
+    merged = []
+    for a, b in sorted(ranges + [[start, stop]]):
+        if merged and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    return merged
+
+
+class CovAccumulator:
+    """
+    Running mean and covariance of data vectors of length `nbins`.
+
+    Parameters
+    ----------
+    nbins : int, optional
+        Length of the data vectors; taken from the first update if not given.
+    path : str, optional
+        Checkpoint file used by `save`.
+    """
+
+    def __init__(self, nbins=None, path=None):
+        self.path = path
+        self.n = 0
+        self.ids = []  # ranges [start, stop) of the included mock ids
+        self._allocate(nbins)
+
+    def _allocate(self, nbins):
+        self.nbins = None if nbins is None else int(nbins)
+        self.mean = None if nbins is None else np.zeros(self.nbins)
+        self.m2 = None if nbins is None else np.zeros((self.nbins, self.nbins))
+
+    def __contains__(self, mock_id):
+        return any(a <= mock_id < b for a, b in self.ids)
+
+    def _check(self, x):
+        if self.nbins is None:
+            self._allocate(x.shape[-1])
+        if x.shape[-1] != self.nbins:
+            raise ValueError(f"data vector of length {x.shape[-1]}, expected {self.nbins}")
+
+    def update(self, x, mock_id=None):
+        """
+        Add one data vector (shape (nbins,)) or a batch (shape (nmock, nbins)).
+
+        `mock_id` (int, or sequence for a batch) records the realisation for `__contains__`;
+        a realisation that is already included is refused, as in `merge`.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        self._check(x)
+        if mock_id is not None:
+            ids = [int(i) for i in np.atleast_1d(mock_id)]
+            if len(ids) != (1 if x.ndim == 1 else len(x)):
+                raise ValueError(f"{len(ids)} mock ids for {1 if x.ndim == 1 else len(x)} data vectors")
+            dup = sorted({i for i in ids if i in self} | {i for i in ids if ids.count(i) > 1})
+            if dup:
+                raise ValueError(f"mock ids {dup} are repeated or already included")
+        if x.ndim == 1:
+            self.n += 1
+            delta = x - self.mean
+            self.mean += delta / self.n
+            self.m2 += np.outer(delta, x - self.mean)
+        else:
+            mean = x.mean(axis=0)
+            dev = x - mean
+            self._merge(len(x), mean, dev.T.dot(dev))
+        if mock_id is not None:
+            for i in ids:
+                self.ids = _add_range(self.ids, i, i + 1)
+        return self
+
+    def _merge(self, n, mean, m2):
+        if n == 0:
+            return
+        ntot = self.n + n
+        delta = mean - self.mean
+        self.m2 += m2 + np.outer(delta, delta) * (self.n * n / ntot)
+        self.mean += delta * (n / ntot)
+        self.n = ntot
+
+    def merge(self, other):
+        """Combine with the accumulator of another worker (disjoint realisations)."""
+        if other.n == 0:
+            return self
+        if self.nbins is None:
+            self._allocate(other.nbins)
+        if other.nbins != self.nbins:
+            raise ValueError(f"cannot merge accumulators of {other.nbins} and {self.nbins} bins")
+        for a, b in other.ids:
+            if any(a < d and c < b for c, d in self.ids):
+                raise ValueError(f"mock ids [{a}, {b}) are already included")
+        self._merge(other.n, other.mean, other.m2)
+        for a, b in other.ids:
+            self.ids = _add_range(self.ids, a, b)
+        return self
+
+    def covariance(self):
+        """Unbiased sample covariance (normalised by n - 1)."""
+        if self.n < 2:
+            raise ValueError(f"need at least 2 realisations, have {self.n}")
+        cov = self.m2 / (self.n - 1)
+        return 0.5 * (cov + cov.T)
+
+    def precision(self, hartlap=True):
+        """Inverse covariance, with the Hartlap correction by default."""
+        prec = np.linalg.inv(self.covariance())
+        if hartlap:
+            prec *= hartlap_factor(self.n, self.nbins)
+        return prec
+
+    def write(self, path2cov, hartlap=True, path2inv=None, path2mean=None):
+        """
+        Write the covariance in the text format of ``path2cov`` in `data_object`.
+
+        Parameters
+        ----------
+        hartlap : bool
+            Divide the covariance by the Hartlap factor, so that its inverse is
+            the unbiased precision matrix.
+        path2inv, path2mean : str, optional
+            Also write the (Hartlap-corrected) inverse and the mean data vector.
+        """
+        cov = self.covariance()
+        header = f'covariance of {self.n} realisations, {self.nbins} bins'
+        if hartlap:
+            h = hartlap_factor(self.n, self.nbins)
+            cov = cov / h
+            header += f', divided by the Hartlap factor {h:.6f}'
+        np.savetxt(path2cov, cov, header=header)
+        if path2inv is not None:
+            np.savetxt(path2inv, self.precision(hartlap=hartlap),
+                       header=f'inverse covariance of {self.n} realisations' + (', Hartlap corrected' if hartlap else ''))
+        if path2mean is not None:
+            np.savetxt(path2mean, self.mean, header=f'mean of {self.n} realisations')
+
+    ## checkpoints -------------------------------------------------------------
+
+    def save(self, path=None):
+        """Write the state to `path` (default: the checkpoint given at construction)."""
+        path = path or self.path
+        if path is None:
+            raise ValueError("no checkpoint path")
+        if self.nbins is None:
+            raise ValueError("nothing to save")
+        tmp = path + f'.tmp{os.getpid()}.npz'
+        np.savez(tmp, n=self.n, mean=self.mean, m2=self.m2, ids=np.array(self.ids, dtype=np.int64).reshape(-1, 2))
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            acc = cls(len(f['mean']), path=path)
+            acc.n = int(f['n'])
+            acc.mean = f['mean'].copy()
+            acc.m2 = f['m2'].copy()
+            acc.ids = [[int(a), int(b)] for a, b in f['ids']]
+        return acc
+
+    @classmethod
+    def open(cls, path, nbins=None):
+        """Resume from the checkpoint at `path`, or start a new accumulator there."""
+        if os.path.isfile(path):
+            acc = cls.load(path)
+            if nbins is not None and acc.nbins != nbins:
+                raise ValueError(f"checkpoint {path} has {acc.nbins} bins, expected {nbins}")
+            print(f'Resume covariance from {path}: {acc.n} realisations')
+            return acc
+        return cls(nbins, path=path)
+
+
+def merge_checkpoints(paths):
+    """Combine the checkpoints of several workers."""
+    acc = CovAccumulator.load(paths[0])
+    for p in paths[1:]:
+        acc.merge(CovAccumulator.load(p))
+    return acc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge covariance checkpoints and write the covariance.')
+    parser.add_argument('checkpoints', nargs='+', help='Checkpoint files (.npz) of CovAccumulator')
+    parser.add_argument('--out', '-o', required=True, help='Covariance text file (path2cov)')
+    parser.add_argument('--inv', default=None, help='Also write the inverse covariance')
+    parser.add_argument('--mean', default=None, help='Also write the mean data vector')
+    parser.add_argument('--no-hartlap', action='store_true', help='Write the plain sample covariance')
+    parser.add_argument('--save', default=None, help='Save the merged state as a checkpoint')
+    args = parser.parse_args()
+    acc = merge_checkpoints(args.checkpoints)
+    if args.save:
+        acc.save(args.save)
+    acc.write(args.out, hartlap=not args.no_hartlap, path2inv=args.inv, path2mean=args.mean)
+    print(f'Covariance of {acc.n} realisations and {acc.nbins} bins written to {args.out}')
@@ -2,8 +2,26 @@
 # 1. paths to fftw2 and gsl libraries
 # 2. glass file: conf_2lpt/glass1_le, conf_2lpt/abacus_c000_tk.dat
 
-import os, subprocess
+import os, subprocess, shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from disp_store import DispStore, DISP_ROOT
+from perftrace import span
+
+EXE_2LPT = os.path.expanduser("~/lib/2LPTic_PNG/2LPTnonlocal")
+GLASS_FILE = "conf_2lpt/glass1_le"
+TRANSFER_FILE = "conf_2lpt/abacus_c000_tk.dat"
+# the modified 2LPTnonlocal ignores OutputDir and writes disp{x,y,z}_{seed}.txt here
+DISP_TEXT_DIR = "/pscratch/sd/s/siyizhao/2LPTdisp/"
+# AbacusSummit c000 cosmology, as in the 2LPTnonlocal parameter files
+COSMO = {
+    "Omega": 0.315192,
+    "OmegaLambda": 0.684808,
+    "OmegaBaryon": 0.0493,
+    "HubbleParam": 0.6736,
+    "Sigma8": 0.819,
+    "PrimordialIndex": 0.9649,
+}
 
 def generate_2lpt_param(
     seed: int,
@@ -13,6 +31,10 @@ def generate_2lpt_param(
     Lbox: int = 2000,
     fix_amp: int = 0,
     output_path: str | None = None,
+    output_dir: str = "/pscratch/sd/s/siyizhao/no_need_of_dir",
+    glass_file: str = GLASS_FILE,
+    transfer_file: str = TRANSFER_FILE,
+    cosmo: dict = COSMO,
 ) -> str:
     """
     Build a parameter file (as text) and optionally write it to `output_path`.
@@ -22,23 +44,28 @@ def generate_2lpt_param(
     fix_amp : int
         Whether to fix the amplitude of the initial conditions.
         0: no (default), 1: yes.
+    output_dir, glass_file, transfer_file : str
+        Paths written into the parameter file. Use absolute paths when
+        2LPTnonlocal does not run in the EZmock directory.
+    cosmo : dict
+        Cosmological parameters (keys as in the parameter file), default `COSMO`.
     """
 
     script = f"""Nmesh         {Ngrid}     
 Nsample       {Ngrid}                                    
 Box           {Lbox}
 FileBase      ics_{Ngrid}_{Lbox}
-OutputDir     /pscratch/sd/s/siyizhao/no_need_of_dir
-GlassFile     conf_2lpt/glass1_le
+OutputDir     {output_dir}
+GlassFile     {glass_file}
 GlassTileFac  {Ngrid}     
 
-Omega               0.315192      
-OmegaLambda         0.684808      
-OmegaBaryon         0.0493    
+Omega               {cosmo["Omega"]}      
+OmegaLambda         {cosmo["OmegaLambda"]}      
+OmegaBaryon         {cosmo["OmegaBaryon"]}    
 OmegaDM_2ndSpecies  0.00      	    
-HubbleParam         0.6736       
-Sigma8              0.819
-PrimordialIndex     0.9649         
+HubbleParam         {cosmo["HubbleParam"]}       
+Sigma8              {cosmo["Sigma8"]}
+PrimordialIndex     {cosmo["PrimordialIndex"]}         
 Redshift            {redshift}  
 Fnl                 {fnl}
 
@@ -51,7 +78,7 @@ FileWithInputSpectrum    conf_2lpt/no_need_of_file.txt
 InputSpectrum_UnitLength_in_cm  3.085678e24 
 ShapeGamma       0.201     
 WhichTransfer    2        
-FileWithInputTransfer     conf_2lpt/abacus_c000_tk.dat
+FileWithInputTransfer     {transfer_file}
 
 Seed             {seed}       
 
@@ -73,45 +100,147 @@ WDM_PartMass_in_kev  10.0
 
     return script
 
-def run_disp_2lpt(seed, redshift, fnl, Ngrid=512, Lbox=2000, fix_amp=0):
+def _env_2lpt(nthread=None):
+    """Environment for 2LPTnonlocal: fftw2 and gsl libraries, OpenMP threads."""
+    home = os.path.expanduser("~")
+    env = os.environ.copy()
+    # fftw2 and gsl paths
+    new_ld = f"{home}/lib/fftw-2.1.5/lib:{home}/.conda/envs/ezmock_png/lib"
+    if env.get("LD_LIBRARY_PATH"):
+        new_ld = new_ld + ":" + env["LD_LIBRARY_PATH"]
+    env["LD_LIBRARY_PATH"] = new_ld
+    if nthread is None:
+        env.setdefault("OMP_NUM_THREADS", "1")
+    else:
+        env["OMP_NUM_THREADS"] = str(nthread)
+    return env
+
+def run_disp_2lpt(seed, redshift, fnl, Ngrid=512, Lbox=2000, fix_amp=0, exe=None, workdir=None, nthread=None, fn_config=None, logpath=None):
     '''
     Generate 2LPT displacement field for given seed, redshift, fnl.
     LOG: logs/2lpt_r{seed}.log
+
+    `exe` defaults to $EXE_2LPT or ~/lib/2LPTic_PNG/2LPTnonlocal, `workdir` is the
+    working directory of the 2LPTnonlocal process (default: current directory),
+    `nthread` sets OMP_NUM_THREADS (default: inherited, or 1).
     '''
     # prepare parameter file for 2LPTnonlocal ----------------------------------
-    fn_config = f'conf_2lpt/params_2lpt/r{seed}.param'
-    generate_2lpt_param(seed=seed, redshift=redshift, fnl=fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=fix_amp, output_path=fn_config)
-    print(f"Generated {fn_config}")
+    if fn_config is None:
+        fn_config = f'conf_2lpt/params_2lpt/r{seed}.param'
+        generate_2lpt_param(seed=seed, redshift=redshift, fnl=fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=fix_amp, output_path=fn_config)
+        print(f"Generated {fn_config}")
     
     # prepare displacement field with 2LPTnonlocal -----------------------------
     print(f'Generating 2LPT displacement field for seed {seed}...')
 
-    home = os.path.expanduser("~")
     cmd = [
-        f"{home}/lib/2LPTic_PNG/2LPTnonlocal",
-        fn_config
+        exe or os.environ.get("EXE_2LPT", EXE_2LPT),
+        os.path.abspath(fn_config)
     ]
-    # fftw2 and gsl paths
-    new_ld = f"{home}/lib/fftw-2.1.5/lib:{home}/.conda/envs/ezmock_png/lib"
-    if os.environ.get("LD_LIBRARY_PATH"):
-        new_ld = new_ld + ":" + os.environ.get("LD_LIBRARY_PATH")
-    os.environ["LD_LIBRARY_PATH"] = new_ld
-
-    # Use a snapshot of os.environ for subprocess.run and ensure single-threaded
-    env = os.environ.copy()
-    env.setdefault("OMP_NUM_THREADS", "1")
+    env = _env_2lpt(nthread)
 
-    # create logs directory in the current working directory
-    logs_dir = os.path.abspath(os.path.join(os.getcwd(), 'logs'))
-    os.makedirs(logs_dir, exist_ok=True)
-    logpath = os.path.join(logs_dir, f"2lpt_r{seed}.log")
+    if logpath is None:
+        # create logs directory in the current working directory
+        logs_dir = os.path.abspath(os.path.join(os.getcwd(), 'logs'))
+        os.makedirs(logs_dir, exist_ok=True)
+        logpath = os.path.join(logs_dir, f"2lpt_r{seed}.log")
     with open(logpath, "w") as logfile:
         try:
-            subprocess.run(cmd, env=env, stdout=logfile, stderr=subprocess.STDOUT, check=True)
+            # child CPU time and peak RSS of 2LPTnonlocal are recorded by the span
+            with span('2LPTnonlocal', seed=seed, Ngrid=Ngrid, Lbox=Lbox, nthread=nthread):
+                subprocess.run(cmd, env=env, cwd=workdir, stdout=logfile, stderr=subprocess.STDOUT, check=True)
         except subprocess.CalledProcessError as e:
             print(f"2LPT failed for seed {seed}, returncode {e.returncode}. See {logpath}")
             raise
         
-    print('Done. Displacement field saved to /pscratch/sd/s/siyizhao/2LPTdisp/. LOG:', logpath)
+    print(f"Done. Displacement field saved to {workdir or DISP_TEXT_DIR}. LOG: {logpath}")
+
+
+def _run_one_seed(seed, redshift, fnl, Ngrid, Lbox, fix_amp, ncores, jobdir, store, exe, disp_dir, keep_text):
+    """One job of `run_disp_2lpt_batch`: run 2LPTnonlocal in its own directory and store the result."""
+    os.makedirs(jobdir, exist_ok=True)
+    fn_config = os.path.join(jobdir, f'r{seed}.param')
+    conf_dir = os.path.abspath('conf_2lpt')
+    generate_2lpt_param(seed=seed, redshift=redshift, fnl=fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=fix_amp,
+                        output_path=fn_config, output_dir=jobdir,
+                        glass_file=os.path.join(conf_dir, 'glass1_le'),
+                        transfer_file=os.path.join(conf_dir, 'abacus_c000_tk.dat'))
+    logpath = os.path.join(jobdir, f'2lpt_r{seed}.log')
+    run_disp_2lpt(seed, redshift, fnl, Ngrid=Ngrid, Lbox=Lbox, fix_amp=fix_amp, exe=exe, workdir=jobdir,
+                  nthread=ncores, fn_config=fn_config, logpath=logpath)
+    src = disp_dir or jobdir
+    fns = [os.path.join(src, f'disp{c}_{seed}.txt') for c in 'xyz']
+    path = store.import_text(*fns, seed=seed, redshift=redshift, Lbox=Lbox, Ngrid=Ngrid, fnl=fnl, fix_amp=fix_amp,
+                             remove=not keep_text)
+    if not keep_text:
+        shutil.rmtree(jobdir, ignore_errors=True)
+    return path
+
+def run_disp_2lpt_batch(seeds, redshift, fnl, Ngrid=512, Lbox=2000, fix_amp=0, ncores_per_job=1, njobs=None,
+                        store=DISP_ROOT, workroot='2lpt_jobs', exe=None, disp_dir=DISP_TEXT_DIR, keep_text=False):
+    """
+    Generate 2LPT displacement fields for many seeds with concurrent 2LPTnonlocal processes.
 
+    Each job runs in its own directory ``{workroot}/r{seed}_...`` with its own
+    parameter file and log, and its ``dispx/dispy/dispz`` files are converted into
+    the displacement store. Seeds already in the store are skipped, so an
+    interrupted batch resumes where it stopped.
 
+    Parameters
+    ----------
+    seeds : iterable of int
+        Seeds to run.
+    ncores_per_job : int
+        OMP_NUM_THREADS of each 2LPTnonlocal process.
+    njobs : int, optional
+        Number of concurrent processes, default: available cores // ncores_per_job.
+    store : str or DispStore
+        Displacement store (root directory or instance).
+    exe : str, optional
+        2LPTnonlocal executable (any stand-in writing ``disp{x,y,z}_{seed}.txt`` works).
+    disp_dir : str or None
+        Directory where the executable writes the displacement text files.
+        The modified 2LPTnonlocal ignores ``OutputDir`` and writes to
+        `DISP_TEXT_DIR` (created here); None for an executable that writes
+        to ``OutputDir``, i.e. the job directory.
+
+    Returns
+    -------
+    dict
+        seed -> 'skipped', 'done' or 'failed'.
+    """
+    if not isinstance(store, DispStore):
+        store = DispStore(store)
+    if disp_dir is not None:
+        os.makedirs(disp_dir, exist_ok=True)
+    if njobs is None:
+        ncpu = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count() or 1))
+        njobs = max(1, ncpu // ncores_per_job)
+    status = {}
+    todo = []
+    for seed in seeds:
+        if store.has(seed, redshift, Lbox, Ngrid, fnl, fix_amp):
+            status[seed] = 'skipped'
+        else:
+            todo.append(seed)
+    print(f"{len(todo)} seeds to run ({len(status)} already in store), {njobs} jobs x {ncores_per_job} cores")
+
+    workroot = os.path.abspath(workroot)
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        futures = {}
+        for seed in todo:
+            jobdir = os.path.join(workroot, f'r{seed}_z{redshift:g}_L{Lbox:g}_N{Ngrid:d}_fnl{fnl:g}_fa{fix_amp:d}')
+            fut = pool.submit(_run_one_seed, seed, redshift, fnl, Ngrid, Lbox, fix_amp, ncores_per_job,
+                              jobdir, store, exe, disp_dir, keep_text)
+            futures[fut] = seed
+        for fut in as_completed(futures):
+            seed = futures[fut]
+            try:
+                fut.result()
+                status[seed] = 'done'
+            except Exception as e:
+                print(f"Seed {seed} failed: {e}")
+                status[seed] = 'failed'
+    nfail = sum(v == 'failed' for v in status.values())
+    print(f"Batch finished: {len(todo) - nfail} done, {nfail} failed, {len(status) - len(todo)} skipped.")
+    return status
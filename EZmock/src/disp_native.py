@@ -0,0 +1,222 @@
+"""
+In-process ZA/2LPT displacement fields with local primordial non-Gaussianity.
+
+A NumPy/SciPy replacement of ``2LPTnonlocal`` for calibration runs on small
+grids: no external binary, fftw2, glass file or text dump. The steps are
+
+1. a Gaussian primordial potential phi on the grid, P_phi(k) = A k^(ns - 4),
+   with A set by sigma8 of the linear density at z = 0 (optionally with fixed
+   mode amplitudes, `fix_amp`);
+2. local PNG in real space, Phi = phi + fnl (phi^2 - <phi^2>);
+3. the linear density delta(k) = M(k) Phi(k), M(k) = 2 k^2 T(k) D(0) / (3 Omega_m (H0/c)^2),
+   with the transfer function of ``conf_2lpt/abacus_c000_tk.dat`` and the
+   growth factor D normalised to the scale factor in matter domination (the
+   CMB convention of fnl);
+4. the ZA displacement Psi1 = i k / k^2 delta(k) and, for ``order=2``, the 2LPT
+   term Psi2 = -(3/7) Omega_m(z)^(-1/143) D1^2 grad phi2, where
+   nabla^2 phi2 = sum_{i<j} (phi1_ii phi1_jj - phi1_ij^2),
+
+all scaled to the output redshift. Particles sit on the regular grid (no glass
+tiling). FFTs are threaded through `mesh.rfftn`/`mesh.irfftn`, and fields are
+float32 throughout.
+
+The output has the layout of `DispStore.load`: three flat float32 arrays of
+length Ngrid^3 in Mpc/h (index (ix * Ngrid + iy) * Ngrid + iz), which
+`EZmock.create_dens_field_from_disp` takes directly. The random streams differ
+from 2LPTnonlocal, so a seed gives a different realisation than the binary;
+keep native fields in their own store.
+
+Example
+-------
+>>> dx, dy, dz = generate_disp(seed=42, redshift=3.0, fnl=100, Ngrid=256, Lbox=1000, fix_amp=1, nthread=8)
+>>> ez.create_dens_field_from_disp(dx, dy, dz, deepcopy=True)
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import integrate
+from mesh import kgrid, rfftn, irfftn
+from disp2LPT_helper import COSMO, TRANSFER_FILE
+from perftrace import span
+
+C_KMS = 299792.458
+H0_HMPC = 100.0 / C_KMS  # H0 / c in h/Mpc
+
+
+def load_transfer(path=TRANSFER_FILE):
+    """
+    Transfer function from a two-column text file (k in h/Mpc, T(k) normalised to 1 at low k).
+
+    Returns
+    -------
+    callable
+        T(k), interpolated in log-log; T = T(kmin) below the table and a
+        power-law continuation above it.
+    """
+    k, t = np.loadtxt(path, usecols=(0, 1), unpack=True)
+    lk, lt = np.log(k), np.log(t)
+    slope = (lt[-1] - lt[-2]) / (lk[-1] - lk[-2])
+
+    def transfer(kk):
+        lkk = np.log(np.maximum(kk, k[0]))
+        out = np.interp(lkk, lk, lt)
+        hi = lkk > lk[-1]
+        out[hi] = lt[-1] + slope * (lkk[hi] - lk[-1])
+        return np.exp(out)
+    return transfer
+
+
+def growth_factor(z, cosmo=COSMO):
+    """Linear growth factor D(z) of a LambdaCDM background, normalised to D = a in matter domination."""
+    om, ol = cosmo['Omega'], cosmo['OmegaLambda']
+    ok = 1 - om - ol
+    a = 1.0 / (1.0 + z)
+
+    def hubble(x):
+        return np.sqrt(om / x ** 3 + ok / x ** 2 + ol)
+    integral, _ = integrate.quad(lambda x: 1.0 / (x * hubble(x)) ** 3, 0, a)
+    return 2.5 * om * hubble(a) * integral
+
+
+def omega_m(z, cosmo=COSMO):
+    om, ol = cosmo['Omega'], cosmo['OmegaLambda']
+    ok = 1 - om - ol
+    a3 = (1.0 + z) ** 3
+    return om * a3 / (om * a3 + ok * (1.0 + z) ** 2 + ol)
+
+
+def potential_to_density(k, transfer, cosmo=COSMO):
+    """M(k) = delta(k, z=0) / Phi(k): Poisson equation, transfer function and growth to z = 0."""
+    return 2.0 / 3.0 * k ** 2 * transfer(k) * growth_factor(0.0, cosmo) / (cosmo['Omega'] * H0_HMPC ** 2)
+
+
+def potential_amplitude(transfer, cosmo=COSMO, R=8.0):
+    """A of P_phi(k) = A k^(ns - 4) such that the linear density at z = 0 has sigma(R) = Sigma8."""
+    lnk = np.linspace(np.log(1e-5), np.log(1e2), 8192)
+    k = np.exp(lnk)
+    kr = k * R
+    w = 3 * (np.sin(kr) - kr * np.cos(kr)) / kr ** 3
+    pk = k ** (cosmo['PrimordialIndex'] - 4) * potential_to_density(k, transfer, cosmo) ** 2
+    sigma2 = integrate.trapezoid(k ** 3 * pk * w ** 2, lnk) / (2 * np.pi ** 2)
+    return cosmo['Sigma8'] ** 2 / sigma2
+
+
+def _slabs(field, kfull, khalf, func, nthread):
+    """
+    Multiply an rfftn field, slab by slab along x, by func(kv, k2), where
+    kv = (kx, ky, kz) and k2 broadcast to the (ny, nz) slab.
+    """
+    ky = kfull[:, None]
+    kz = khalf[None, :]
+    kyz2 = ky ** 2 + kz ** 2
+
+    def job(i):
+        kx = kfull[i, None, None]
+        field[i] *= func((kx, ky, kz), kx ** 2 + kyz2)
+    with ThreadPoolExecutor(max_workers=nthread) as pool:
+        list(pool.map(job, range(field.shape[0])))
+    return field
+
+
+def gaussian_potential(Ngrid, Lbox, seed, amplitude, ns, fix_amp=0, nthread=1):
+    """
+    Real-space Gaussian potential on the grid with P_phi(k) = amplitude k^(ns - 4).
+
+    The modes are drawn as the FFT of float32 white noise, so the field is
+    Hermitian by construction; with `fix_amp` every |phi(k)| is set to its rms.
+    """
+    shape = (Ngrid,) * 3
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal(shape, dtype=np.float32)
+    field = rfftn(noise, nthread)
+    del noise
+    kfull, khalf = kgrid(Ngrid, Lbox)
+    norm = np.float32(Ngrid ** 3 / Lbox ** 3)
+
+    def amp(kv, k2):
+        k2 = np.where(k2 > 0, k2, np.inf).astype(np.float32)
+        return np.sqrt(np.float32(amplitude) * norm * k2 ** np.float32((ns - 4) / 2))
+    if fix_amp:
+        mag = np.abs(field)
+        mag[mag == 0] = 1
+        field /= mag
+        field *= np.float32(np.sqrt(Ngrid ** 3))
+        del mag
+    _slabs(field, kfull, khalf, amp, nthread)
+    field[0, 0, 0] = 0
+    return irfftn(field, shape, nthread).astype(np.float32, copy=False)
+
+
+def generate_disp(seed, redshift, fnl, Ngrid=256, Lbox=1000, fix_amp=0, order=2, cosmo=COSMO,
+                  transfer_file=TRANSFER_FILE, nthread=1):
+    """
+    Displacement field at `redshift` with local PNG `fnl`.
+
+    Parameters
+    ----------
+    seed : int
+        Seed of the Gaussian potential.
+    fix_amp : int
+        Fix the amplitude of the initial modes (1) or draw them (0).
+    order : int
+        1 for the Zel'dovich approximation, 2 for 2LPT.
+    cosmo : dict
+        Cosmology, keys as in `disp2LPT_helper.COSMO`.
+    nthread : int
+        Threads of the FFTs and the k-space loops.
+
+    Returns
+    -------
+    dx, dy, dz : ndarray
+        Flat float32 displacements in Mpc/h, length Ngrid^3.
+    """
+    if order not in (1, 2):
+        raise ValueError(f"order must be 1 (ZA) or 2 (2LPT), got {order}")
+    shape = (Ngrid,) * 3
+    transfer = load_transfer(transfer_file)
+    with span('disp_native', seed=seed, Ngrid=Ngrid, Lbox=Lbox, order=order, nthread=nthread):
+        phi = gaussian_potential(Ngrid, Lbox, seed, potential_amplitude(transfer, cosmo), cosmo['PrimordialIndex'],
+                                 fix_amp=fix_amp, nthread=nthread)
+        if fnl != 0:
+            phi2 = phi * phi
+            phi += np.float32(fnl) * (phi2 - np.float32(phi2.mean(dtype=np.float64)))
+            del phi2
+        delta_k = rfftn(phi, nthread)
+        del phi
+        kfull, khalf = kgrid(Ngrid, Lbox)
+        d0 = growth_factor(0.0, cosmo)
+        # delta(k, z=0) / k^2, so that each displacement and second derivative is one multiplication
+        _slabs(delta_k, kfull, khalf,
+               lambda kv, k2: (potential_to_density(np.sqrt(k2), transfer, cosmo)
+                                       / np.where(k2 > 0, k2, np.inf)).astype(np.float32), nthread)
+        delta_k[0, 0, 0] = 0
+        growth = growth_factor(redshift, cosmo) / d0
+
+        def derivative(i, j=None):
+            # i k_i delta / k^2 (displacement) or k_i k_j delta / k^2 (phi1_ij)
+            f = delta_k.copy()
+            if j is None:
+                _slabs(f, kfull, khalf, lambda kv, k2: (1j * kv[i]).astype(np.complex64), nthread)
+            else:
+                _slabs(f, kfull, khalf,
+                       lambda kv, k2: (kv[i] * kv[j]).astype(np.float32), nthread)
+            return irfftn(f, shape, nthread).astype(np.float32, copy=False)
+
+        disp = [derivative(i) * np.float32(growth) for i in range(3)]
+        if order == 2:
+            diag = [derivative(i, i) for i in range(3)]
+            delta2 = diag[0] * diag[1] + diag[0] * diag[2] + diag[1] * diag[2]
+            del diag
+            for i, j in ((0, 1), (0, 2), (1, 2)):
+                delta2 -= derivative(i, j) ** 2
+            d2_k = rfftn(delta2, nthread)
+            del delta2
+            _slabs(d2_k, kfull, khalf, lambda kv, k2: (1 / np.where(k2 > 0, k2, np.inf)).astype(np.float32), nthread)
+            d2_k[0, 0, 0] = 0
+            # Psi2 = D2 grad phi2 = -D2 i k delta2 / k^2, D2 = -3/7 D1^2 Omega_m(z)^(-1/143)
+            coeff = np.float32(3.0 / 7.0 * growth ** 2 * omega_m(redshift, cosmo) ** (-1.0 / 143))
+            for i in range(3):
+                f = d2_k.copy()
+                _slabs(f, kfull, khalf, lambda kv, k2: (1j * kv[i]).astype(np.complex64), nthread)
+                disp[i] += coeff * irfftn(f, shape, nthread).astype(np.float32, copy=False)
+            del d2_k
+    return tuple(d.ravel() for d in disp)
@@ -0,0 +1,129 @@
+"""
+Binary store of 2LPT displacement fields.
+
+Each displacement field is kept as three float32 ``.npy`` files (Ngrid^3
+values each) in a directory named after its key, together with a ``meta.yaml``
+holding the key::
+
+    <root>/
+        s42_z2_L2000_N512_fnl600_fa1/
+            meta.yaml
+            dx.npy
+            dy.npy
+            dz.npy
+
+The key is (seed, redshift, Lbox, Ngrid, fnl, fix_amp). Fields are loaded
+through memory maps, so loading costs no parsing and no extra copy.
+"""
+import os
+import shutil
+import numpy as np
+import yaml
+from perftrace import span
+
+DISP_ROOT = '/pscratch/sd/s/siyizhao/2LPTdisp/'
+META = 'meta.yaml'
+COMPONENTS = ('dx', 'dy', 'dz')
+
+
+def disp_key(seed, redshift, Lbox, Ngrid, fnl, fix_amp=0):
+    """Canonical key of a displacement field."""
+    return {
+        'seed': int(seed),
+        'redshift': float(redshift),
+        'Lbox': float(Lbox),
+        'Ngrid': int(Ngrid),
+        'fnl': float(fnl),
+        'fix_amp': int(fix_amp),
+    }
+
+
+def entry_name(key):
+    """Directory name of a key, e.g. ``s42_z2_L2000_N512_fnl600_fa1``."""
+    return (f"s{key['seed']:d}_z{key['redshift']:g}_L{key['Lbox']:g}_N{key['Ngrid']:d}"
+            f"_fnl{key['fnl']:g}_fa{key['fix_amp']:d}")
+
+
+class DispStore:
+    """
+    Displacement fields on disk, keyed by (seed, redshift, Lbox, Ngrid, fnl, fix_amp).
+
+    Parameters
+    ----------
+    root : str
+        Directory of the store.
+    """
+
+    def __init__(self, root=DISP_ROOT):
+        self.root = str(root)
+
+    def path(self, seed, redshift, Lbox, Ngrid, fnl, fix_amp=0):
+        key = disp_key(seed, redshift, Lbox, Ngrid, fnl, fix_amp)
+        return os.path.join(self.root, entry_name(key))
+
+    def has(self, seed, redshift, Lbox, Ngrid, fnl, fix_amp=0):
+        return os.path.isfile(os.path.join(self.path(seed, redshift, Lbox, Ngrid, fnl, fix_amp), META))
+
+    def load(self, seed, redshift, Lbox, Ngrid, fnl, fix_amp=0, mmap=True):
+        """
+        Load (dx, dy, dz) as flat float32 arrays of length Ngrid^3.
+        With ``mmap=True`` they are read-only memory maps of the store files.
+        """
+        path = self.path(seed, redshift, Lbox, Ngrid, fnl, fix_amp)
+        if not os.path.isfile(os.path.join(path, META)):
+            raise FileNotFoundError(f"No displacement field in store: {path}")
+        mode = 'r' if mmap else None
+        return tuple(np.load(os.path.join(path, f'{c}.npy'), mmap_mode=mode) for c in COMPONENTS)
+
+    def save(self, dx, dy, dz, seed, redshift, Lbox, Ngrid, fnl, fix_amp=0, extra=None):
+        """Write a displacement field (converted to float32) into the store."""
+        key = disp_key(seed, redshift, Lbox, Ngrid, fnl, fix_amp)
+        path = os.path.join(self.root, entry_name(key))
+        tmp = path + f'.tmp{os.getpid()}'
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            for c, d in zip(COMPONENTS, (dx, dy, dz)):
+                d = np.asarray(d, dtype=np.float32).ravel()
+                if d.size != key['Ngrid'] ** 3:
+                    raise ValueError(f"{c} has {d.size} values, expected Ngrid^3 = {key['Ngrid'] ** 3}")
+                np.save(os.path.join(tmp, f'{c}.npy'), d)
+            meta = dict(key)
+            if extra:
+                meta.update(extra)
+            with open(os.path.join(tmp, META), 'w') as f:
+                yaml.safe_dump(meta, f, sort_keys=False)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return path
+
+    def import_text(self, fnx, fny, fnz, seed, redshift, Lbox, Ngrid, fnl, fix_amp=0, remove=False):
+        """
+        Convert the ``dispx/dispy/dispz`` text files written by 2LPTnonlocal into the store.
+        The text is parsed directly into float32, one component at a time.
+        """
+        fields = []
+        with span('disp_import_text', seed=seed, Ngrid=Ngrid):
+            for fn in (fnx, fny, fnz):
+                fields.append(np.fromfile(fn, dtype=np.float32, sep=' '))
+        path = self.save(*fields, seed=seed, redshift=redshift, Lbox=Lbox, Ngrid=Ngrid, fnl=fnl, fix_amp=fix_amp,
+                         extra={'source': [os.path.abspath(fn) for fn in (fnx, fny, fnz)]})
+        if remove:
+            for fn in (fnx, fny, fnz):
+                os.remove(fn)
+        return path
+
+    def manifest(self):
+        """All entries of the store, entry name -> meta."""
+        out = {}
+        if not os.path.isdir(self.root):
+            return out
+        for name in sorted(os.listdir(self.root)):
+            fn = os.path.join(self.root, name, META)
+            if os.path.isfile(fn):
+                with open(fn, 'r') as f:
+                    out[name] = yaml.safe_load(f)
+        return out
@@ -0,0 +1,183 @@
+"""
+In-memory EZmock -> clustering pipeline.
+
+`populate_tracer` returns the tracers in memory; this stage feeds them straight
+into the `prep_ref` measurements instead of writing an ASCII catalog with
+`populate_tracer_to_file` and parsing it back. By default only the summary
+statistics are written (``{name}.pk.txt``, ``.xi.txt``, ``.bk.txt`` with the
+columns of ``pkref.txt``/``xiref.txt``/``bkref.txt``); the catalog itself is
+written only on request, as a binary column directory (``{name}.cols``, see
+`catalog_io`). The file name holds the parameters, Lbox, Ngrid and fnl; the
+rest of the run (ntracer, rsd_fac, seed) is recorded next to the statistics in
+``{name}.run.yaml``, and saved statistics are reused only if it matches.
+
+Example
+-------
+>>> for param, res in run_pipeline(ez, params, ntracer, rsd_fac, Lbox, Ngrid, fnl, odir='out'):
+...     plt.plot(res['pk'][:, 0], res['pk'][:, 0] * res['pk'][:, 5])
+"""
+import os
+import numpy as np
+import yaml
+from prep_ref import measure_pk, measure_xi, measure_bk, pk_setup, xi_setup, bk_setup
+from clus_cache import catalog_fingerprint
+from catalog_io import write_columns, is_column_dir
+from clus_backends import HEADERS
+from perftrace import span
+
+STATS = ('pk', 'xi', 'bk')
+
+
+def tracer_positions(tracers):
+    """x, y, z of the output of `EZmock.populate_tracer` (tuple of columns or (N, >=3) array)."""
+    if isinstance(tracers, np.ndarray) and tracers.ndim == 2:
+        return tracers[:, 0], tracers[:, 1], tracers[:, 2]
+    return tracers[0], tracers[1], tracers[2]
+
+
+def mock_name(param, Lbox, Ngrid, fnl):
+    """File stem of an EZmock, as used for the ``populate_tracer_to_file`` catalogs."""
+    rho_c, rho_exp, pdf_base, sigma_v = param
+    return f'EZmock_L{Lbox:g}_N{Ngrid:d}_fnl{fnl:g}_c{rho_c:g}_e{rho_exp:g}_b{pdf_base:g}_v{sigma_v:g}'
+
+
+def run_record(param, Lbox, Ngrid, fnl, ntracer, rsd_fac, seed=None):
+    """Settings of an EZmock run, saved as ``{name}.run.yaml`` next to its statistics."""
+    return {'param': [float(p) for p in param], 'Lbox': float(Lbox), 'Ngrid': int(Ngrid), 'fnl': float(fnl),
+            'ntracer': int(ntracer), 'rsd_fac': float(rsd_fac), 'seed': None if seed is None else str(seed)}
+
+
+def measure_catalog(x, y, z, Lbox, Ngrid, stats=STATS, clus_cache=None, xi_pool=None, fingerprint=None):
+    """
+    Measure the requested statistics of an in-memory catalog.
+
+    With `clus_cache` (a `clus_cache.ClusCache`), measurements of an identical
+    catalog are reused. With `xi_pool` (a `xi_pool.XiPool`), xi is submitted to
+    the pool and returned as a Future.
+
+    Returns
+    -------
+    dict
+        stat -> table as written by `prep_ref.measure_*`.
+    """
+    if fingerprint is None and clus_cache is not None:
+        fingerprint = catalog_fingerprint(x, y, z)
+    res = {}
+    for s in stats:
+        if s == 'xi' and xi_pool is not None:
+            res[s] = xi_pool.submit(x, y, z, lbox=Lbox, fingerprint=fingerprint)
+        elif s == 'xi':
+            res[s] = measure_xi(x, y, z, lbox=Lbox, cache=clus_cache, fingerprint=fingerprint)
+        elif s == 'pk':
+            res[s] = measure_pk(x, y, z, lbox=Lbox, ngrid=Ngrid, cache=clus_cache, fingerprint=fingerprint)
+        elif s == 'bk':
+            res[s] = measure_bk(x, y, z, lbox=Lbox, ngrid=Ngrid, cache=clus_cache, fingerprint=fingerprint)
+        else:
+            raise ValueError(f"unknown statistic '{s}'")
+    return res
+
+
+def measure_settings(Lbox, Ngrid):
+    """Effective settings (backend included) of the pk, xi and bk measurements of `measure_catalog`."""
+    return {'pk': pk_setup(Lbox, Ngrid)[2], 'xi': xi_setup(Lbox)[2], 'bk': bk_setup(Lbox, Ngrid)[2]}
+
+
+def stat_paths(odir, name, stats=STATS):
+    return {s: os.path.join(odir, f'{name}.{s}.txt') for s in stats}
+
+
+def record_path(odir, name):
+    return os.path.join(odir, f'{name}.run.yaml')
+
+
+def save_stats(res, paths, record=None, path2record=None):
+    for s, table in res.items():
+        np.savetxt(paths[s], table, header=HEADERS[s])
+    if path2record is not None:
+        with open(path2record, 'w') as f:
+            yaml.safe_dump(record, f, sort_keys=False)
+
+
+def load_stats(paths, record=None, path2record=None):
+    """Saved statistics, or None if any is missing or they were saved for another run than `record`."""
+    if not all(os.path.isfile(p) for p in paths.values()):
+        return None
+    if path2record is not None:
+        if not os.path.isfile(path2record):
+            return None
+        with open(path2record, 'r') as f:
+            if yaml.safe_load(f) != record:
+                return None
+    return {s: np.loadtxt(p) for s, p in paths.items()}
+
+
+def run_pipeline(ez, params, ntracer, rsd_fac, Lbox, Ngrid, fnl, odir=None, stats=STATS, save_catalog=False,
+                 clus_cache=None, xi_pool=None, overwrite=False, seed=None):
+    """
+    Populate tracers for each parameter set and measure them in memory.
+
+    Parameters
+    ----------
+    ez : EZmock
+        Instance with the density field built.
+    params : list of (rho_c, rho_exp, pdf_base, sigma_v)
+        Parameter sets.
+    odir : str, optional
+        Output directory of the summary statistics; nothing is written if None.
+        Parameter sets whose statistics already exist there, saved with the
+        same ntracer, rsd_fac and seed, are loaded, not rerun.
+    save_catalog : bool
+        Also write each catalog as a binary column directory ``{odir}/{name}.cols``.
+    clus_cache : clus_cache.ClusCache, optional
+        Measurement cache passed on to the `prep_ref` measurements.
+    xi_pool : xi_pool.XiPool, optional
+        xi of one parameter set is measured by the pool while the next one is populated.
+    overwrite : bool
+        Rerun parameter sets with saved statistics.
+    seed : int, optional
+        Seed of the displacement field of `ez`, recorded with the statistics.
+
+    Yields
+    ------
+    param, dict
+        Parameter set and stat -> table, in the order of `params`.
+    """
+    if odir is not None:
+        os.makedirs(odir, exist_ok=True)
+    pending = None
+    for param in params:
+        name = mock_name(param, Lbox, Ngrid, fnl)
+        record = run_record(param, Lbox, Ngrid, fnl, ntracer, rsd_fac, seed)
+        paths = stat_paths(odir, name, stats) if odir is not None else None
+        path2record = record_path(odir, name) if odir is not None else None
+        res = load_stats(paths, record, path2record) if paths is not None and not overwrite else None
+        if res is not None and (not save_catalog or is_column_dir(os.path.join(odir, f'{name}.cols'))):
+            print(f'Found saved statistics for parameters: {param}')
+            if pending is not None:
+                yield _finish(*pending)
+                pending = None
+            yield param, res
+            continue
+        print(f'Running EZmock with parameters: {param}')
+        with span('populate_tracer', param=[float(p) for p in param]):
+            tracers = ez.populate_tracer(*param, ntracer, rsd_fac=rsd_fac)
+        x, y, z = tracer_positions(tracers)
+        if save_catalog and odir is not None:
+            with span('write_columns'):
+                write_columns(os.path.join(odir, f'{name}.cols'), {'x': x, 'y': y, 'z': z}, meta=record)
+        res = measure_catalog(x, y, z, Lbox, Ngrid, stats=stats, clus_cache=clus_cache, xi_pool=xi_pool)
+        del tracers, x, y, z
+        # the previous xi finishes while this parameter set was populated and measured
+        if pending is not None:
+            yield _finish(*pending)
+        pending = (param, res, paths, record, path2record)
+    if pending is not None:
+        yield _finish(*pending)
+
+
+def _finish(param, res, paths, record, path2record):
+    if 'xi' in res and hasattr(res['xi'], 'result'):
+        res['xi'] = res['xi'].result()
+    if paths is not None:
+        save_stats(res, paths, record, path2record)
+    return param, res
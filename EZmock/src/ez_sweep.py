@@ -0,0 +1,253 @@
+"""
+Parallel sweep of EZmock parameters (rho_c, rho_exp, pdf_base, sigma_v) with a result cache.
+
+The density field is built once (by the caller, or by `setup` in each worker)
+and every parameter set is evaluated with `populate_tracer` in memory, followed
+by the pk/xi/bk measurements of `prep_ref`. Results are cached on disk under a
+hash of (parameters, seed, Lbox, Ngrid, ntracer, fnl, rsd_fac) and the effective
+measurement settings of fitEZ.yaml, so re-running a sweep only computes the new
+points, and a change of binning or backend does not return stale tables.
+
+Example
+-------
+>>> cache = SweepCache('out/sweep')
+>>> res = run_sweep(params, ez=ez, ntracer=ntracer, rsd_fac=rsd_fac, seed=seed,
+...                 Lbox=Lbox, Ngrid=Ngrid, fnl=fnl, cache=cache)
+>>> res[0]['pk']  # kcen kmin kmax kavg nmod P_0 P_2 P_4
+
+With several workers, give `setup` (a module-level function or a
+`functools.partial` of one, so that spawned workers can unpickle it) instead of
+an instance built with OpenMP threads:
+
+>>> setup = partial(setup_ez, redshift=0.95, Omega_m=0.3138, Omega_nu=0.00142, fnl=600, nthread=16)
+>>> res = run_sweep(params, setup=setup, setup_kwargs=dict(Lbox=Lbox, Ngrid=Ngrid, seed=seed), nworkers=4, ...)
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from ez_pipeline import STATS, tracer_positions, measure_catalog, measure_settings
+from disp_store import DISP_ROOT, DispStore
+
+
+def sweep_key(param, seed, Lbox, Ngrid, ntracer, fnl, rsd_fac, settings):
+    """
+    Hash of an EZmock run: parameters (rho_c, rho_exp, pdf_base, sigma_v), the
+    mock setup and `settings`, the measurement settings of
+    `ez_pipeline.measure_settings`.
+    """
+    rec = {
+        'param': [float(p) for p in param],
+        'seed': str(seed),
+        'Lbox': float(Lbox),
+        'Ngrid': int(Ngrid),
+        'ntracer': int(ntracer),
+        'fnl': float(fnl),
+        'rsd_fac': float(rsd_fac),
+        'settings': settings,
+    }
+    return hashlib.sha1(json.dumps(rec, sort_keys=True, default=float).encode()).hexdigest()
+
+
+class SweepCache:
+    """
+    Sweep results on disk, one ``{key}.npz`` per evaluated point.
+
+    Each file holds the measured tables (``pk``, ``xi``, ``bk``) and a JSON
+    record of the run in ``meta``.
+    """
+
+    def __init__(self, root):
+        self.root = str(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, f'{key}.npz')
+
+    def get(self, key, stats=STATS):
+        """Cached result with all `stats`, or None."""
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as f:
+            if not all(s in f.files for s in stats):
+                return None
+            res = {s: f[s] for s in f.files if s != 'meta'}
+            res['meta'] = json.loads(str(f['meta']))
+        return res
+
+    def put(self, key, result, meta):
+        path = self._path(key)
+        tmp = path + f'.tmp{os.getpid()}.npz'
+        arrays = {s: v for s, v in result.items() if s in STATS}
+        np.savez(tmp, meta=json.dumps(meta, default=float), **arrays)
+        os.replace(tmp, path)
+
+    def list(self):
+        """Meta records of all cached points."""
+        out = []
+        for fn in sorted(os.listdir(self.root)):
+            if fn.endswith('.npz') and '.tmp' not in fn:
+                with np.load(os.path.join(self.root, fn)) as f:
+                    out.append(json.loads(str(f['meta'])))
+        return out
+
+
+def evaluate(ez, param, ntracer, rsd_fac, Lbox, Ngrid, stats=STATS, clus_cache=None, xi_pool=None):
+    """
+    Populate tracers for one parameter set and measure the requested statistics.
+    With `clus_cache` (a `clus_cache.ClusCache`), measurements of an identical
+    catalog are reused. With `xi_pool` (a `xi_pool.XiPool`), xi is submitted to
+    the pool and returned as a Future.
+
+    Returns
+    -------
+    dict
+        stat -> table as written by `prep_ref.measure_*`.
+    """
+    rho_c, rho_exp, pdf_base, sigma_v = param
+    tracers = ez.populate_tracer(rho_c, rho_exp, pdf_base, sigma_v, ntracer, rsd_fac=rsd_fac)
+    x, y, z = tracer_positions(tracers)
+    return measure_catalog(x, y, z, Lbox, Ngrid, stats=stats, clus_cache=clus_cache, xi_pool=xi_pool)
+
+
+def setup_ez(Lbox, Ngrid, seed, redshift, Omega_m, Omega_nu, fnl, disp_root=DISP_ROOT, fix_amp=1, nthread=1,
+             ez_seed=42):
+    """
+    EZmock instance with the density field built from the stored 2LPT displacements of `seed`.
+
+    Parameters
+    ----------
+    redshift, Omega_m, Omega_nu : float
+        Output redshift and cosmology of the growth parameters.
+    fnl, fix_amp : float, int
+        Initial conditions of the displacement field (see `disp_store.DispStore.load`).
+    disp_root : str
+        Root of the displacement store.
+    nthread : int
+        OpenMP threads of the instance.
+    ez_seed : int
+        Seed of the tracer population.
+    """
+    from EZmock import EZmock
+    ez = EZmock(Lbox=Lbox, Ngrid=Ngrid, seed=ez_seed, nthread=nthread)
+    ez.eval_growth_params(z_out=redshift, z_pk=1, Omega_m=Omega_m, Omega_nu=Omega_nu)
+    # float32 memory maps of the store; EZmock copies them once into its own buffer
+    dx, dy, dz = DispStore(disp_root).load(seed=seed, redshift=redshift, Lbox=Lbox, Ngrid=Ngrid, fnl=fnl,
+                                           fix_amp=fix_amp)
+    ez.create_dens_field_from_disp(dx, dy, dz, deepcopy=True)
+    return ez
+
+
+## worker processes ------------------------------------------------------------
+
+_worker_ez = None
+
+def _init_worker(setup, setup_kwargs):
+    global _worker_ez
+    if setup is not None:
+        _worker_ez = setup(**setup_kwargs)
+
+def _run_worker(param, ntracer, rsd_fac, Lbox, Ngrid, stats, clus_cache):
+    return evaluate(_worker_ez, param, ntracer, rsd_fac, Lbox, Ngrid, stats=stats, clus_cache=clus_cache)
+
+
+def run_sweep(params, ntracer, rsd_fac, seed, Lbox, Ngrid, fnl, cache=None, ez=None, setup=None, setup_kwargs=None,
+              nworkers=1, stats=STATS, clus_cache=None, xi_pool=None):
+    """
+    Evaluate a grid of EZmock parameter sets.
+
+    Parameters
+    ----------
+    params : list of (rho_c, rho_exp, pdf_base, sigma_v)
+        Parameter sets.
+    ez : EZmock, optional
+        Instance with the density field already built, used with one worker.
+        With ``nworkers > 1`` and no `setup`, the workers are forked from the
+        current process and share its density field copy-on-write. This is
+        only safe if the instance was created with ``nthread=1``: libgomp does
+        not support OpenMP in a child forked after the parent ran OpenMP
+        regions, and the workers may deadlock.
+    setup : callable, optional
+        ``setup(**setup_kwargs)`` returns an EZmock instance (e.g. a
+        `functools.partial` of `setup_ez`). With ``nworkers > 1`` the workers
+        are spawned and each calls it once, even if `ez` is given; with one
+        worker it is called only if `ez` is None.
+    nworkers : int
+        Number of concurrent worker processes. Each EZmock instance uses its own
+        ``nthread``, so choose ``nthread * nworkers`` <= available cores.
+    cache : SweepCache, optional
+        Points found in the cache are not recomputed; new points are added.
+    clus_cache : clus_cache.ClusCache, optional
+        Measurement cache passed on to the `prep_ref` measurements.
+    xi_pool : xi_pool.XiPool, optional
+        With ``nworkers=1``, xi is measured by the pool while the next parameter
+        set is populated.
+
+    Returns
+    -------
+    list of dict
+        Measurements (stat -> table) for each parameter set, in order.
+    """
+    if ez is None and setup is None:
+        raise ValueError("provide either an EZmock instance `ez` or a `setup` function")
+    setup_kwargs = setup_kwargs or {}
+    settings = measure_settings(Lbox, Ngrid)
+    keys = [sweep_key(p, seed, Lbox, Ngrid, ntracer, fnl, rsd_fac, settings) for p in params]
+    results = [None] * len(params)
+    todo = []
+    for i, key in enumerate(keys):
+        hit = cache.get(key, stats) if cache is not None else None
+        if hit is not None:
+            results[i] = hit
+        else:
+            todo.append(i)
+    print(f"{len(params) - len(todo)} of {len(params)} parameter sets found in cache, {len(todo)} to run.")
+
+    def _done(i, res):
+        results[i] = res
+        if cache is not None:
+            meta = {'param': [float(p) for p in params[i]], 'seed': str(seed), 'Lbox': float(Lbox),
+                    'Ngrid': int(Ngrid), 'ntracer': int(ntracer), 'fnl': float(fnl), 'rsd_fac': float(rsd_fac),
+                    'settings': settings, 'key': keys[i]}
+            cache.put(keys[i], res, meta)
+
+    if nworkers <= 1 or len(todo) <= 1:
+        if ez is None:
+            ez = setup(**setup_kwargs)
+        pending = []
+        for i in todo:
+            print(f'Running EZmock with parameters: {params[i]}')
+            res = evaluate(ez, params[i], ntracer, rsd_fac, Lbox, Ngrid, stats=stats, clus_cache=clus_cache, xi_pool=xi_pool)
+            if 'xi' in res and hasattr(res['xi'], 'result'):
+                pending.append((i, res))
+            else:
+                _done(i, res)
+        for i, res in pending:
+            res['xi'] = res['xi'].result()
+            _done(i, res)
+        return results
+
+    global _worker_ez
+    if setup is not None:
+        ctx = mp.get_context('spawn')
+        initargs = (setup, setup_kwargs)
+    else:
+        # forked workers inherit the density field; safe only without OpenMP threads in this process
+        print("Warning: forking sweep workers from an EZmock instance, which may deadlock unless it was created "
+              "with nthread=1; pass `setup` to spawn the workers instead.")
+        _worker_ez = ez
+        ctx = mp.get_context('fork')
+        initargs = (None, None)
+    try:
+        with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx, initializer=_init_worker, initargs=initargs) as pool:
+            futures = {pool.submit(_run_worker, params[i], ntracer, rsd_fac, Lbox, Ngrid, stats, clus_cache): i for i in todo}
+            for fut in as_completed(futures):
+                i = futures[fut]
+                _done(i, fut.result())
+                print(f'Finished EZmock with parameters: {params[i]}')
+    finally:
+        _worker_ez = None
+    return results
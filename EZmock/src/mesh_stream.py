@@ -0,0 +1,242 @@
+"""
+Out-of-core mesh painting: catalogs read and painted in fixed-size chunks.
+
+`powspec.powspec_box` and `bispec.bispec_box` need the whole x, y, z arrays in
+memory. Here a catalog is streamed instead: `iter_chunks` yields at most
+`chunk_rows` positions at a time from a text catalog, a column directory
+(`catalog_io`), an ``.npy`` file of shape (N, >=3), in-memory
+arrays, or any iterable of chunks (e.g. a generator of `populate_tracer`
+outputs, one per tracer or realisation). `MeshPainter` accumulates every chunk
+into the CIC/TSC mesh and, with interlacing, the mesh shifted by H/2, so peak
+memory is the meshes plus one chunk. `density_k` then gives the same field as
+`mesh.density_k`, which goes to the existing P(k) and B(k) steps
+(`powspec.multipoles_from_field`, `bispec.bispec_from_field`).
+
+Example
+-------
+>>> pk, bk = measure_stream('subsample.cols', ngrid=512, lbox=2000, pk=pk_settings, bk=bk_settings, nthread=16)
+>>> painter = MeshPainter(512, 2000, assign='TSC')
+>>> for cat in (ez.populate_tracer(*param, ntracer, rsd_fac=rsd_fac) for ez in tracers):
+...     painter.paint_from([cat])
+>>> delta_k, npart = painter.density_k()
+"""
+import itertools
+import os
+import numpy as np
+from catalog_io import CHUNK_ROWS, is_column_dir, cache_dir_for, cache_is_valid, read_columns, _data_offset
+from mesh import ORDER, paint, rfftn, finish_density_k
+from powspec import PowspecResult, multipoles_from_field
+from bispec import bispec_from_field
+from perftrace import span
+
+
+def _xyz(cat):
+    """x, y, z of a chunk: tuple/list of columns, dict with x, y, z, or an (N, >=3) array."""
+    if isinstance(cat, dict):
+        return cat['x'], cat['y'], cat['z']
+    if isinstance(cat, np.ndarray) and cat.ndim == 2:
+        return cat[:, 0], cat[:, 1], cat[:, 2]
+    return cat[0], cat[1], cat[2]
+
+
+def _slices(x, y, z, chunk_rows):
+    for start in range(0, len(x), chunk_rows):
+        stop = start + chunk_rows
+        yield np.asarray(x[start:stop]), np.asarray(y[start:stop]), np.asarray(z[start:stop])
+
+
+class _NpyReader:
+    """Sequential reads of a C-ordered ``.npy`` file, without a memory map (pages read once are not kept)."""
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        version = np.lib.format.read_magic(self.f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran, self.dtype = read_header(self.f)
+        if fortran:
+            raise ValueError(f"{path}: Fortran-ordered arrays are not supported")
+        self.nrows = shape[0]
+        self.rowshape = shape[1:]
+
+    def read(self, nrows):
+        count = nrows * int(np.prod(self.rowshape, dtype=np.int64))
+        return np.fromfile(self.f, dtype=self.dtype, count=count).reshape((-1,) + self.rowshape)
+
+    def close(self):
+        self.f.close()
+
+
+def _npy_chunks(paths, chunk_rows):
+    """Chunks of x, y, z from three column files, or from one (N, >=3) file."""
+    readers = [_NpyReader(p) for p in paths]
+    try:
+        nrows = readers[0].nrows
+        for start in range(0, nrows, chunk_rows):
+            n = min(chunk_rows, nrows - start)
+            blocks = [r.read(n) for r in readers]
+            yield _xyz(blocks[0]) if len(blocks) == 1 else tuple(blocks)
+    finally:
+        for r in readers:
+            r.close()
+
+
+def _text_chunks(path, usecols, chunk_rows):
+    with open(path, 'rb') as f:
+        offset = _data_offset(f)
+    with open(path, 'r') as f:
+        f.seek(offset)
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                return
+            lines = [line for line in lines if line.strip()]
+            if lines:
+                chunk = np.loadtxt(lines, usecols=usecols, ndmin=2)
+                yield chunk[:, 0], chunk[:, 1], chunk[:, 2]
+
+
+def iter_chunks(source, chunk_rows=CHUNK_ROWS, usecols=(0, 1, 2), names=('x', 'y', 'z')):
+    """
+    Positions of a catalog in chunks of at most `chunk_rows` rows.
+
+    Parameters
+    ----------
+    source : str, tuple of arrays, ndarray or iterable
+        Text catalog (a valid binary cache next to it is used instead), column
+        directory, ``.npy`` file of shape (N, >=3) (files are read
+        sequentially, not memory-mapped); x, y, z arrays (memory maps are read
+        chunk by chunk); or an iterable of chunks in any of the array
+        forms (each is split further if longer than `chunk_rows`).
+    usecols, names : sequence
+        Position columns of a text catalog, and of a column directory.
+
+    Yields
+    ------
+    x, y, z : ndarray
+    """
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        if not is_column_dir(path) and cache_is_valid(path, cache_dir_for(path), names):
+            path = cache_dir_for(path)
+        if is_column_dir(path):
+            read_columns(path, names)  # checks that the columns exist
+            yield from _npy_chunks([os.path.join(path, f'{n}.npy') for n in names], chunk_rows)
+        elif path.endswith('.npy'):
+            yield from _npy_chunks([path], chunk_rows)
+        else:
+            yield from _text_chunks(path, usecols, chunk_rows)
+        return
+    if isinstance(source, (dict, np.ndarray)) or (isinstance(source, (tuple, list)) and len(source) == 3
+                                                  and all(np.ndim(c) == 1 for c in source)):
+        yield from _slices(*_xyz(source), chunk_rows)
+        return
+    for cat in source:
+        yield from _slices(*_xyz(cat), chunk_rows)
+
+
+class MeshPainter:
+    """
+    Incremental CIC/TSC painting of a catalog onto a periodic mesh.
+
+    Parameters
+    ----------
+    ngrid, lbox : int, float
+        Mesh size and box size.
+    assign : str
+        'NGP', 'CIC' or 'TSC'.
+    intlace : bool
+        Also paint the mesh shifted by half a cell (two meshes are kept).
+    dtype : dtype
+        Mesh precision, float32 by default.
+    nthread : int
+        Threads computing the assignment weights of a chunk.
+    """
+
+    def __init__(self, ngrid, lbox, assign='CIC', intlace=True, dtype=np.float32, nthread=1):
+        self.ngrid = int(ngrid)
+        self.lbox = float(lbox)
+        self.assign = assign
+        self.order = ORDER[assign.upper()]
+        self.intlace = intlace
+        self.dtype = dtype
+        self.nthread = nthread
+        self.npart = 0
+        self.mesh = np.zeros((self.ngrid,) * 3, dtype=dtype)
+        self.mesh2 = np.zeros((self.ngrid,) * 3, dtype=dtype) if intlace else None
+
+    def add(self, x, y, z, weights=None):
+        """Paint one chunk of positions."""
+        kw = dict(assign=self.assign, weights=weights, dtype=self.dtype, nthread=self.nthread)
+        paint(x, y, z, self.ngrid, self.lbox, mesh=self.mesh, **kw)
+        if self.intlace:
+            paint(x, y, z, self.ngrid, self.lbox, shift=0.5, mesh=self.mesh2, **kw)
+        self.npart += len(x)
+        return self
+
+    def paint_from(self, source, chunk_rows=CHUNK_ROWS, **kwargs):
+        """Paint every chunk of `source` (see `iter_chunks`)."""
+        with span('paint_stream', ngrid=self.ngrid, nthread=self.nthread):
+            for x, y, z in iter_chunks(source, chunk_rows=chunk_rows, **kwargs):
+                self.add(x, y, z)
+        return self
+
+    def density_k(self, compensate=True):
+        """
+        Fourier-space density contrast, as `mesh.density_k`; the meshes are released.
+
+        Returns
+        -------
+        delta_k : ndarray
+            Complex field of shape (ngrid, ngrid, ngrid//2+1).
+        npart : int
+            Number of painted particles.
+        """
+        if self.mesh is None:
+            raise RuntimeError("density_k was already taken from this painter")
+        if self.npart == 0:
+            raise ValueError("no particles painted")
+        delta_k = rfftn(self.mesh, nthread=self.nthread)
+        self.mesh = None
+        delta2_k = None
+        if self.intlace:
+            delta2_k = rfftn(self.mesh2, nthread=self.nthread)
+            self.mesh2 = None
+        finish_density_k(delta_k, self.npart, self.ngrid, self.lbox, self.order, delta2_k, compensate)
+        return delta_k, self.npart
+
+
+def density_k_stream(source, ngrid, lbox, assign='CIC', intlace=True, dtype=np.float32, nthread=1,
+                     chunk_rows=CHUNK_ROWS, **kwargs):
+    """`mesh.density_k` of a streamed catalog (see `iter_chunks` for `source`)."""
+    painter = MeshPainter(ngrid, lbox, assign=assign, intlace=intlace, dtype=dtype, nthread=nthread)
+    return painter.paint_from(source, chunk_rows=chunk_rows, **kwargs).density_k()
+
+
+def measure_stream(source, ngrid, lbox, pk=None, bk=None, assign='CIC', intlace=True, dtype=np.float32, nthread=1,
+                   chunk_rows=CHUNK_ROWS, **kwargs):
+    """
+    P(k) multipoles and B(k1, k2, theta) of a streamed catalog from one painted field.
+
+    Parameters
+    ----------
+    pk : dict, optional
+        kmin, kmax, nbin of the power spectrum (skipped if None).
+    bk : dict, optional
+        k1, dk1, k2, dk2, nbin of the bispectrum (skipped if None).
+
+    Returns
+    -------
+    PowspecResult or None, BispecResult or None
+    """
+    delta_k, npart = density_k_stream(source, ngrid, lbox, assign=assign, intlace=intlace, dtype=dtype,
+                                      nthread=nthread, chunk_rows=chunk_rows, **kwargs)
+    pkres = bkres = None
+    if pk is not None:
+        kedge = np.linspace(pk['kmin'], pk['kmax'], pk['nbin'] + 1)
+        kmean, nmode, p0, p2, p4 = multipoles_from_field(delta_k, ngrid, lbox, kedge, shot=lbox ** 3 / npart,
+                                                         nthread=nthread)
+        pkres = PowspecResult(kedge, kmean, nmode, p0, p2, p4)
+    if bk is not None:
+        bkres = bispec_from_field(delta_k, npart, ngrid, lbox, bk['k1'], bk['dk1'], bk['k2'], bk['dk2'], bk['nbin'],
+                                  nthread=nthread, dtype=dtype)
+    return pkres, bkres
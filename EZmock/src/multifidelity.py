@@ -0,0 +1,204 @@
+"""
+Multi-fidelity calibration: screen parameter sets on small, low-resolution
+boxes and promote only the best ones to the full setup.
+
+The levels are read from the ``calibration: levels`` section of
+``conf/fitEZ.yaml`` (cheapest first), e.g. Lbox=1000/Ngrid=256 followed by
+Lbox=2000/Ngrid=512. The number of tracers of a level follows its volume, so
+the number density matches the last (full) level: ``ntracer // 8`` for half
+the box size, as in the manual calibration. ``keep`` of a level is the number
+(or fraction, if < 1) of its best points promoted to the next level.
+
+All levels are recorded in the same `calibrate.ResultStore` table, with the
+level index in the ``level`` column; points already recorded at a level are
+not rerun. The EZmock instance of each level (its displacement field and
+density field) is built once by the `setup` function and reused for every
+batch of that level; with several workers, each spawned worker builds its own
+for every batch (forking from an instance that ran OpenMP is not safe).
+
+Example
+-------
+>>> setup = partial(setup_ez, redshift=redshift, Omega_m=Omega_m0, Omega_nu=Omega_nu, fnl=fnl_ic, nthread=16)
+>>> mf = MultiFidelity(setup, ResultStore(f'{odir}/calibration.sqlite'), refs, ntracer=num,
+...                    rsd_fac=rsd_fac, fnl=fnl_ic, nworkers=4)
+>>> best = mf.search(start=[[0.9, 1.3, 0.51, 160]], max_evals=60)  # surrogate search on level 0, then promotion
+>>> mf.report()
+"""
+import numpy as np
+from calibrate import PARAMS, load_calibration_config, evaluate_batch, calibrate, setup_tag, point_key
+
+
+class MultiFidelity:
+    """
+    Scheduler of calibration runs over fidelity levels.
+
+    Parameters
+    ----------
+    setup : callable
+        ``setup(Lbox=..., Ngrid=..., seed=...)`` returns an EZmock instance
+        with the density field built (e.g. a `functools.partial` of
+        `ez_sweep.setup_ez`). With ``nworkers > 1`` it is called in each
+        spawned worker instead, so it must be picklable (not defined in a
+        notebook).
+    store : calibrate.ResultStore
+        Table of all evaluated points.
+    refs : dict
+        Reference tables, see `calibrate.load_refs`.
+    ntracer : int
+        Number of tracers of the last (full) level.
+    levels : list of dict, optional
+        Lbox, Ngrid, seed and keep of each level; default from the config.
+    """
+
+    def __init__(self, setup, store, refs, ntracer, rsd_fac, fnl, levels=None, cfg=None, nworkers=1,
+                 sweep_cache=None, clus_cache=None):
+        self.cfg = cfg or load_calibration_config()
+        self.levels = levels or self.cfg['levels']
+        self.setup = setup
+        self.store = store
+        self.refs = refs
+        self.ntracer = int(ntracer)
+        self.rsd_fac = rsd_fac
+        self.fnl = fnl
+        self.nworkers = nworkers
+        self.sweep_cache = sweep_cache
+        self.clus_cache = clus_cache
+        self._ez = {}
+
+    def level(self, i):
+        """Mock setup of level `i`: Lbox, Ngrid, seed, ntracer."""
+        lv = self.levels[i]
+        scale = (float(lv['Lbox']) / float(self.levels[-1]['Lbox'])) ** 3
+        return {'Lbox': lv['Lbox'], 'Ngrid': int(lv['Ngrid']), 'seed': lv['seed'],
+                'ntracer': int(round(self.ntracer * scale))}
+
+    def setup_tag(self, i):
+        lv = self.level(i)
+        return setup_tag(lv['Lbox'], lv['Ngrid'], lv['ntracer'], lv['seed'], self.fnl, self.rsd_fac, self.cfg)
+
+    def ez(self, i):
+        """EZmock instance of level `i`, built on first use and then reused."""
+        lv = self.level(i)
+        key = (lv['Lbox'], lv['Ngrid'], lv['seed'])
+        if key not in self._ez:
+            print(f"Setting up EZmock for level {i}: Lbox={lv['Lbox']}, Ngrid={lv['Ngrid']}, seed={lv['seed']}")
+            self._ez[key] = self.setup(Lbox=lv['Lbox'], Ngrid=lv['Ngrid'], seed=lv['seed'])
+        return self._ez[key]
+
+    def release(self, i):
+        """Free the EZmock instance of level `i`."""
+        lv = self.level(i)
+        self._ez.pop((lv['Lbox'], lv['Ngrid'], lv['seed']), None)
+
+    def _key(self, i, param):
+        return point_key(param, self.setup_tag(i))
+
+    def _sweep_args(self, i):
+        """EZmock of level `i` for the sweeps: the resident instance, or the setup of spawned workers."""
+        if self.nworkers <= 1:
+            return {'ez': self.ez(i)}
+        lv = self.level(i)
+        return {'ez': None, 'setup': self.setup,
+                'setup_kwargs': {'Lbox': lv['Lbox'], 'Ngrid': lv['Ngrid'], 'seed': lv['seed']}}
+
+    def evaluate(self, i, params):
+        """Losses of `params` at level `i`; only points not yet recorded are run."""
+        params = [list(map(float, p)) for p in params]
+        todo = [p for p in params if self.store.get(self._key(i, p)) is None]
+        if todo:
+            lv = self.level(i)
+            print(f"Level {i}: {len(todo)} of {len(params)} parameter sets to run")
+            args = self._sweep_args(i)
+            evaluate_batch(args.pop('ez'), todo, self.store, self.refs, self.cfg, ntracer=lv['ntracer'],
+                           rsd_fac=self.rsd_fac, seed=lv['seed'], Lbox=lv['Lbox'], Ngrid=lv['Ngrid'], fnl=self.fnl,
+                           nworkers=self.nworkers, sweep_cache=self.sweep_cache, clus_cache=self.clus_cache, level=i,
+                           **args)
+        return np.array([self.store.get(self._key(i, p))['loss'] for p in params])
+
+    def _nkeep(self, i, n):
+        keep = self.levels[i].get('keep', n)
+        if keep < 1:
+            keep = int(np.ceil(keep * n))
+        return max(1, min(int(keep), n))
+
+    def screen(self, candidates, start_level=0, release=True):
+        """
+        Evaluate `candidates` level by level, promoting the best `keep` of each level.
+
+        With `release`, the EZmock instance of a level is freed once its
+        survivors are promoted (the full-resolution field is usually the one
+        that does not fit next to the others).
+
+        Returns
+        -------
+        list of dict
+            Points of the last level, best first (``param``, ``loss``, ...).
+        """
+        survivors = [list(map(float, p)) for p in candidates]
+        last = len(self.levels) - 1
+        for i in range(start_level, last + 1):
+            loss = self.evaluate(i, survivors)
+            order = np.argsort(loss)
+            if i < last:
+                n = self._nkeep(i, len(survivors))
+                print(f"Level {i}: promote {n} of {len(survivors)}, losses {np.round(loss[order[:n]], 4).tolist()}")
+                survivors = [survivors[j] for j in order[:n]]
+                if release:
+                    self.release(i)
+            else:
+                survivors = [survivors[j] for j in order]
+        return [self.store.get(self._key(last, p)) for p in survivors]
+
+    def search(self, start=(), ncandidates=None, **kwargs):
+        """
+        Surrogate search (`calibrate.calibrate`) on level 0, then promotion of its best points.
+
+        Parameters
+        ----------
+        ncandidates : int, optional
+            Number of level-0 points entering the promotion, default ``keep`` of level 0
+            (a count, or a fraction of the level-0 points if < 1).
+        kwargs
+            Passed on to `calibrate.calibrate` (nbatch, max_evals, surrogate, ...).
+        """
+        lv = self.level(0)
+        args = self._sweep_args(0)
+        calibrate(args.pop('ez'), self.store, self.refs, lv['ntracer'], self.rsd_fac, lv['seed'], lv['Lbox'], lv['Ngrid'],
+                  self.fnl, cfg=self.cfg, start=start, nworkers=self.nworkers, sweep_cache=self.sweep_cache,
+                  clus_cache=self.clus_cache, level=0, **args, **kwargs)
+        tag = self.setup_tag(0)
+        n = int(ncandidates) if ncandidates else self._nkeep(0, len(self.store.points(tag)[1]))
+        best = self.store.best(tag, n=n)
+        # the level-0 points are recorded already, screening starts with the promotion
+        if len(self.levels) > 1:
+            self.release(0)
+        return self.screen([b['param'] for b in best], start_level=1 if len(self.levels) > 1 else 0)
+
+    def table(self):
+        """
+        Losses of every recorded parameter set at every level.
+
+        Returns
+        -------
+        list of dict
+            ``param`` and ``loss`` (level -> loss), sorted by the loss at the
+            highest level reached, then by the loss below it.
+        """
+        tags = [self.setup_tag(i) for i in range(len(self.levels))]
+        rows = {}
+        for i, tag in enumerate(tags):
+            cur = self.store.db.execute(f"SELECT {', '.join(PARAMS)}, loss FROM runs WHERE setup = ?", (tag,))
+            for row in cur.fetchall():
+                rows.setdefault(tuple(row[:-1]), {})[i] = row[-1]
+        out = [{'param': list(p), 'loss': loss} for p, loss in rows.items()]
+        out.sort(key=lambda r: [(-i, r['loss'][i]) for i in sorted(r['loss'], reverse=True)])
+        return out
+
+    def report(self, n=10):
+        """Print the best `n` rows of `table`."""
+        nlev = len(self.levels)
+        print(f"{'rho_c':>8} {'rho_exp':>8} {'pdf_base':>9} {'sigma_v':>8} " +
+              ' '.join(f"{'loss L' + str(i):>10}" for i in range(nlev)))
+        for r in self.table()[:n]:
+            losses = ' '.join(f"{r['loss'][i]:>10.4g}" if i in r['loss'] else f"{'-':>10}" for i in range(nlev))
+            print(f"{r['param'][0]:>8g} {r['param'][1]:>8g} {r['param'][2]:>9g} {r['param'][3]:>8g} {losses}")
@@ -0,0 +1,196 @@
+"""
+Lightweight timing and memory instrumentation for the mock pipeline.
+
+Tracing is off unless the environment variable ``LEARNCOSM_TRACE`` names an
+output file (or `enable` is called); while off, `span` returns a shared no-op
+context manager and `traced` functions call straight through.
+
+Each finished span is appended to the trace as one JSON line with its name,
+parent span, wall time, CPU time of the process and of waited-for child
+processes (e.g. ``2LPTnonlocal``), and the peak RSS of both. Spans nest per
+thread. Summarise a trace with::
+
+    python src/perftrace.py trace.jsonl
+
+Example
+-------
+>>> with span('measure_pk', ngrid=512):
+...     ...
+>>> @traced('run_hod')
+... def run(...): ...
+"""
+import argparse
+import functools
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ENV = 'LEARNCOSM_TRACE'
+
+_path = os.environ.get(ENV) or None
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOSPAN = _NoSpan()
+
+
+def enable(path):
+    """Write spans to `path` (JSON lines, appended)."""
+    global _path
+    _path = str(path)
+
+
+def disable():
+    global _path
+    _path = None
+
+
+def enabled():
+    return _path is not None
+
+
+def _usage():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    ch = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (me.ru_utime + me.ru_stime, ch.ru_utime + ch.ru_stime, me.ru_maxrss * scale, ch.ru_maxrss * scale)
+
+
+def _emit(rec):
+    line = json.dumps(rec, default=str) + '\n'
+    with _lock:
+        with open(_path, 'a') as f:
+            f.write(line)
+
+
+class _Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.id = f'{os.getpid()}-{next(_ids)}'
+        self.parent = stack[-1].id if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.t0 = time.time()
+        self.u0 = _usage()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.time() - self.t0
+        cpu, cpu_ch, rss, rss_ch = _usage()
+        _local.stack.pop()
+        rec = {
+            'name': self.name,
+            'id': self.id,
+            'parent': self.parent,
+            'depth': self.depth,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'start': self.t0,
+            'wall': wall,
+            'cpu': cpu - self.u0[0],
+            'cpu_children': cpu_ch - self.u0[1],
+            'maxrss': rss,
+            'maxrss_growth': rss - self.u0[2],
+            'maxrss_children': rss_ch,
+            'ok': exc_type is None,
+        }
+        if self.attrs:
+            rec['attrs'] = self.attrs
+        _emit(rec)
+        return False
+
+
+def span(name, **attrs):
+    """Context manager timing a block; a no-op when tracing is off."""
+    if _path is None:
+        return _NOSPAN
+    return _Span(name, attrs)
+
+
+def traced(name=None):
+    """Decorator wrapping every call of a function in a `span` (named after the function by default)."""
+    def deco(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _path is None:
+                return func(*args, **kwargs)
+            with _Span(label, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+## report ----------------------------------------------------------------------
+
+def read_trace(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records):
+    """
+    Aggregate spans by name.
+
+    Returns
+    -------
+    list of dict
+        name, calls, wall (total), self (wall minus child spans), cpu, cpu_children,
+        maxrss and maxrss_children (peaks, bytes), sorted by total wall time.
+    """
+    child_wall = defaultdict(float)
+    for r in records:
+        if r['parent'] is not None:
+            child_wall[r['parent']] += r['wall']
+    rows = {}
+    for r in records:
+        row = rows.setdefault(r['name'], {'name': r['name'], 'calls': 0, 'wall': 0.0, 'self': 0.0, 'cpu': 0.0,
+                                          'cpu_children': 0.0, 'maxrss': 0, 'maxrss_children': 0, 'failed': 0})
+        row['calls'] += 1
+        row['wall'] += r['wall']
+        row['self'] += r['wall'] - child_wall.get(r['id'], 0.0)
+        row['cpu'] += r['cpu']
+        row['cpu_children'] += r['cpu_children']
+        row['maxrss'] = max(row['maxrss'], r['maxrss'])
+        row['maxrss_children'] = max(row['maxrss_children'], r['maxrss_children'])
+        row['failed'] += not r.get('ok', True)
+    return sorted(rows.values(), key=lambda row: -row['wall'])
+
+
+def report(path, file=sys.stdout):
+    rows = summarize(read_trace(path))
+    head = f"{'span':<32} {'calls':>6} {'wall[s]':>10} {'self[s]':>10} {'cpu[s]':>10} {'child cpu[s]':>12} {'peak RSS':>10} {'child RSS':>10}"
+    print(head, file=file)
+    print('-' * len(head), file=file)
+    for r in rows:
+        name = r['name'] + (f" ({r['failed']} failed)" if r['failed'] else '')
+        print(f"{name:<32} {r['calls']:>6d} {r['wall']:>10.2f} {r['self']:>10.2f} {r['cpu']:>10.2f} {r['cpu_children']:>12.2f} "
+              f"{r['maxrss'] / 2**30:>8.2f}GB {r['maxrss_children'] / 2**30:>8.2f}GB", file=file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarise a perftrace JSON-lines file.')
+    parser.add_argument('trace', help=f'trace file (as set by ${ENV})')
+    report(parser.parse_args().trace)
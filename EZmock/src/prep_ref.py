@@ -1,44 +1,96 @@
 
+import copy
 import numpy as np
 import os
 import yaml
-import catinbox as cb
-import sys; sys.path.append("/global/homes/s/siyizhao/lib/pyfcfc")
-from pyfcfc.boxes import py_compute_cf
+from catalog_io import load_catalog, is_column_dir
+from clus_cache import catalog_fingerprint
+from perftrace import span, traced
+import clus_backends
+from clus_backends import HEADERS, xi_table, fcfc_conf, pyfcfc_cf
 
 LBOX = 2000.0
 NGRID = 512
 ncpu = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
 
+_config_cache = {}
 def load_config(path='conf/fitEZ.yaml'):
-    with open(path, 'r') as f:
-        config = yaml.safe_load(f)
-    return config
+    # parsed once per file version, callers get their own copy
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _config_cache:
+        with open(path, 'r') as f:
+            _config_cache[key] = yaml.safe_load(f)
+    return copy.deepcopy(_config_cache[key])
 
 
-def read_Abacus_mock(dir = 'mocks', sim = 'AbacusSummit_base_c000_ph000', z = 2.000, hod = '_dv', tracer = 'QSO'):
-    MOCK_IN = f"/pscratch/sd/s/siyizhao/desi-dr2-hod/{dir}/{sim}/z{z:.3f}/galaxies_rsd{hod}/{tracer}s.dat"
+def read_Abacus_mock(dir = 'mocks', sim = 'AbacusSummit_base_c000_ph000', z = 2.000, hod = '_dv', tracer = 'QSO', cache_dir=None):
+    """
+    Read x, y, z (with RSD) of an AbacusHOD mock.
+    Binary mocks ({tracer}s.cols, written by Abacus/src/mock_io.py) are memory-mapped directly.
+    A text catalog is converted to a binary column cache on first read (see `catalog_io`),
+    later reads return memory-mapped float32 columns.
+    """
+    MOCK_DIR = f"/pscratch/sd/s/siyizhao/desi-dr2-hod/{dir}/{sim}/z{z:.3f}/galaxies_rsd{hod}"
+    MOCK_IN = f"{MOCK_DIR}/{tracer}s.cols"
+    if not is_column_dir(MOCK_IN):
+        MOCK_IN = f"{MOCK_DIR}/{tracer}s.dat"
     print(f"Loading mock from {MOCK_IN}")
-    with open(MOCK_IN, 'r') as f:
-        it = iter(f)
-        for line in it:
-            if not line.lstrip().startswith('#'):
-                break
-        data = np.loadtxt(it)
-    x = data[:,0]
-    y = data[:,1]
-    z_rsd = data[:,2]
+    with span('read_Abacus_mock', path=MOCK_IN):
+        cols = load_catalog(MOCK_IN, cache_dir=cache_dir)
+    x = cols['x']
+    y = cols['y']
+    z_rsd = cols['z']
     num = x.shape[0]
     return num, x, y, z_rsd
 
 ## measure and save reference clustering ---------------------------------------
 
-def measure_pk(xref, yref, zref, path=None):
-    CONFIG = load_config()
-    item = CONFIG['clustering']['pk']
+def _cached(cache, kind, settings, xyz, fingerprint, compute):
+    """Look up a measurement in `cache` (a `clus_cache.ClusCache`), computing and storing it on a miss."""
+    if cache is None:
+        return compute()
+    fp = fingerprint or catalog_fingerprint(*xyz)
+    key = cache.key(kind, fp, settings)
+    table = cache.get(key)
+    if table is None:
+        table = compute()
+        cache.put(key, table, kind, fp, settings)
+    return table
+
+
+def _backend(stat, clustering, backend=None):
+    """Backend of `stat` (argument, else ``backend:`` in fitEZ.yaml, else the default) and its options."""
+    name = clus_backends.select(stat, backend or clustering[stat].get('backend'))
+    return name, clus_backends.options(stat, name, clustering)
+
+
+def _settings(cfg, backend, opts):
+    """Key of the measurement cache: the settings that change the result, and the backend."""
+    settings = {k: v for k, v in cfg.items() if k not in ('ncpu', 'verbose')}
+    settings['backend'] = backend
+    if opts:
+        settings['options'] = {k: v for k, v in opts.items()}
+    return settings
+
+
+def pk_setup(lbox=LBOX, ngrid=NGRID, backend=None):
+    """
+    Settings of the pk measurement from fitEZ.yaml.
+
+    Returns
+    -------
+    backend : str
+        Name in `clus_backends` ('catinbox' by default when installed, else 'native').
+    pkcfg : dict
+        Arguments of the backend (those of `catinbox.powspec_box`).
+    settings : dict
+        Effective settings, the key of the measurement cache.
+    """
+    clustering = load_config()['clustering']
+    item = clustering['pk']
     pkcfg = {
-        'ngrid': NGRID,
-        'lbox': LBOX,
+        'ngrid': ngrid,
+        'lbox': lbox,
         'kmin': item['kmin'],
         'kmax': item['kmax'],
         'nbin': item['nbin'],
@@ -50,78 +102,69 @@ def measure_pk(xref, yref, zref, path=None):
         'ncpu': ncpu,
         'verbose': False,
     }
-    pkref = cb.powspec_box(xref, yref, zref, **pkcfg)
+    backend, opts = _backend('pk', clustering, backend)
+    return backend, dict(pkcfg, **opts), _settings(pkcfg, backend, opts)
+
+
+@traced('measure_pk')
+def measure_pk(xref, yref, zref, path=None, lbox=LBOX, ngrid=NGRID, cache=None, fingerprint=None, backend=None):
+    backend, pkcfg, settings = pk_setup(lbox, ngrid, backend)
+    compute = lambda: clus_backends.measure('pk', xref, yref, zref, backend=backend, **pkcfg)
+    table = _cached(cache, 'pk', settings, (xref, yref, zref), fingerprint, compute)
     if path is not None:
-        kcen = pkref.k
-        kmin = pkref.kedge[:-1]
-        kmax = pkref.kedge[1:]
-        kavg = pkref.kmean
-        nmod = pkref.nmode
-        P_0 = pkref.p0
-        P_2 = pkref.p2
-        P_4 = pkref.p4
-        if P_4 is None:
-            P_4 = np.zeros_like(P_0)
-            print("Warning: P_4 is None, set to zero.")
-        np.savetxt(path, np.column_stack((kcen, kmin, kmax, kavg, nmod, P_0, P_2, P_4)), header='kcen kmin kmax kavg nmod P_0 P_2 P_4')
-
-
-fcfccfg = 'conf/fcfc_ref.conf'
-devnull = os.open(os.devnull, os.O_WRONLY)
+        np.savetxt(path, table, header=HEADERS['pk'])
+    return table
+
+
+fcfccfg = clus_backends.FCFC_CONF
+
+@traced('get_xi')
 def get_xi(xs, ys, zs, smin, smax, nbin, nmu=100, conf=fcfccfg):
-    # 同步实现：直接在当前进程调用 py_compute_cf
-    # 在需要静默底层 C 扩展输出时，临时重定向底层 stdout/stderr 到 devnull
-    old_stdout_fd = None
-    old_stderr_fd = None
-    try:
-        # 备份 stdout/stderr
-        old_stdout_fd = os.dup(1)
-        old_stderr_fd = os.dup(2)
-        os.dup2(devnull, 1)
-        os.dup2(devnull, 2)
-
-        data = np.column_stack((xs, ys, zs)).astype(np.float32)
-        w = np.ones(data.shape[0], dtype=np.float32)
-        sedgs = np.linspace(smin, smax, nbin + 1)
-        result = py_compute_cf([data, data], [w, w], sedgs, None, nmu, conf=conf)
-        return result
-    finally:
-        # 恢复 stdout/stderr
-        try:
-            if old_stdout_fd is not None:
-                os.dup2(old_stdout_fd, 1)
-                os.close(old_stdout_fd)
-            if old_stderr_fd is not None:
-                os.dup2(old_stderr_fd, 2)
-                os.close(old_stderr_fd)
-        except Exception:
-            pass
-
-def measure_xi(xref, yref, zref, path=None):
-    CONFIG = load_config()
-    item = CONFIG['clustering']['xi']
+    # 同步实现：直接在当前进程调用 py_compute_cf，底层 C 扩展的输出重定向到 devnull
+    return pyfcfc_cf(xs, ys, zs, np.linspace(smin, smax, nbin + 1), nmu, conf=conf)
+
+def xi_setup(lbox=LBOX, backend=None):
+    """
+    Settings of the xi measurement from fitEZ.yaml.
+
+    Returns
+    -------
+    backend : str
+        'pyfcfc' (default when installed), 'native' or another backend of `clus_backends`.
+    xicfg : dict
+        smin, smax, nbin (and the options of the backend).
+    settings : dict
+        Effective settings, the key of the measurement cache.
+    """
+    clustering = load_config()['clustering']
+    item = clustering['xi']
     xicfg = {
         'smin': item['smin'],
         'smax': item['smax'],
         'nbin': item['nbin'],
     }
-    xiref = get_xi(xref, yref, zref, **xicfg)
+    backend, opts = _backend('xi', clustering, backend)
+    settings = _settings(dict(xicfg, nmu=100, lbox=lbox), backend, opts)
+    return backend, dict(xicfg, **opts), settings
+
+@traced('measure_xi')
+def measure_xi(xref, yref, zref, path=None, lbox=LBOX, cache=None, fingerprint=None, backend=None):
+    backend, xicfg, settings = xi_setup(lbox, backend)
+    compute = lambda: clus_backends.measure('xi', xref, yref, zref, backend=backend, lbox=lbox, nmu=100, ncpu=ncpu,
+                                            **xicfg)
+    table = _cached(cache, 'xi', settings, (xref, yref, zref), fingerprint, compute)
     if path is not None:
-        s = xiref['s']
-        smin = xiref['pairs']['smin'][:,0]
-        smax = xiref['pairs']['smax'][:,0]
-        xi0 = xiref['multipoles'][0][0]
-        xi2 = xiref['multipoles'][0][1]
-        np.savetxt(path, np.column_stack((s, smin, smax, xi0, xi2)), header='s smin smax xi0 xi2')
-    return xiref
-
-
-def measure_bk(xref, yref, zref, path=None):
-    CONFIG = load_config()
-    item = CONFIG['clustering']['bk']
+        np.savetxt(path, table, header=HEADERS['xi'])
+    return table
+
+
+def bk_setup(lbox=LBOX, ngrid=NGRID, backend=None):
+    """Settings of the bk measurement from fitEZ.yaml, as `pk_setup`."""
+    clustering = load_config()['clustering']
+    item = clustering['bk']
     bkcfg = {
-        'ngrid': NGRID,
-        'lbox': LBOX,
+        'ngrid': ngrid,
+        'lbox': lbox,
         'k1': item['k1'],
         'dk1': item['dk1'],
         'k2': item['k2'],
@@ -132,17 +175,54 @@ def measure_bk(xref, yref, zref, path=None):
         'ncpu': ncpu,
         'verbose': False,
     }
-    bkref = cb.bispec_box(xref, yref, zref, **bkcfg)
+    backend, opts = _backend('bk', clustering, backend)
+    return backend, dict(bkcfg, **opts), _settings(bkcfg, backend, opts)
+
+
+@traced('measure_bk')
+def measure_bk(xref, yref, zref, path=None, lbox=LBOX, ngrid=NGRID, cache=None, fingerprint=None, backend=None):
+    backend, bkcfg, settings = bk_setup(lbox, ngrid, backend)
+    compute = lambda: clus_backends.measure('bk', xref, yref, zref, backend=backend, **bkcfg)
+    table = _cached(cache, 'bk', settings, (xref, yref, zref), fingerprint, compute)
     if path is not None:
-        theta = bkref.a
-        theta_mean = bkref.amean
-        k3 = bkref.k3
-        modes = bkref.nmode
-        B = bkref.b
-        Q = bkref.q
-        np.savetxt(path, np.column_stack((theta, theta_mean, k3, modes, B, Q)), header='theta theta_mean k3 modes B Q')
-
-def save_ref_clus(xref, yref, zref, path2pk, path2xi, path2bk):
-    measure_pk(xref, yref, zref, path=path2pk)
-    measure_xi(xref, yref, zref, path=path2xi)
-    measure_bk(xref, yref, zref, path=path2bk)
\ No newline at end of file
+        np.savetxt(path, table, header=HEADERS['bk'])
+    return table
+
+@traced('measure_stream')
+def measure_stream(source, path2pk=None, path2bk=None, lbox=LBOX, ngrid=NGRID, stats=('pk', 'bk'), chunk_rows=None):
+    """
+    pk and bk of a catalog larger than memory, painted chunk by chunk (see `mesh_stream`).
+
+    `source` is a text catalog, a column directory, an ``.npy`` file or an
+    iterable of chunks. The settings are those of fitEZ.yaml; the measurement
+    uses the native estimators, whatever backend is configured.
+
+    Returns
+    -------
+    dict
+        stat -> table, as `measure_pk` and `measure_bk`.
+    """
+    import mesh_stream
+    CONFIG = load_config()['clustering']
+    kwargs = {} if chunk_rows is None else {'chunk_rows': chunk_rows}
+    pk = {k: CONFIG['pk'][k] for k in ('kmin', 'kmax', 'nbin')} if 'pk' in stats else None
+    bk = {k: CONFIG['bk'][k] for k in ('k1', 'dk1', 'k2', 'dk2', 'nbin')} if 'bk' in stats else None
+    pkres, bkres = mesh_stream.measure_stream(source, ngrid, lbox, pk=pk, bk=bk, assign='CIC', intlace=True,
+                                              nthread=ncpu, **kwargs)
+    res = {}
+    if pkres is not None:
+        res['pk'] = clus_backends.pk_table(pkres)
+        if path2pk is not None:
+            np.savetxt(path2pk, res['pk'], header=HEADERS['pk'])
+    if bkres is not None:
+        res['bk'] = clus_backends.bk_table(bkres)
+        if path2bk is not None:
+            np.savetxt(path2bk, res['bk'], header=HEADERS['bk'])
+    return res
+
+def save_ref_clus(xref, yref, zref, path2pk, path2xi, path2bk, cache=None):
+    """Measure and save pk, xi and bk of the reference; with a `clus_cache.ClusCache`, known results are reused."""
+    fingerprint = catalog_fingerprint(xref, yref, zref) if cache is not None else None
+    measure_pk(xref, yref, zref, path=path2pk, cache=cache, fingerprint=fingerprint)
+    measure_xi(xref, yref, zref, path=path2xi, cache=cache, fingerprint=fingerprint)
+    measure_bk(xref, yref, zref, path=path2bk, cache=cache, fingerprint=fingerprint)
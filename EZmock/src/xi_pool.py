@@ -0,0 +1,205 @@
+"""
+Persistent pool of xi (pair-counting) workers fed through shared memory.
+
+`prep_ref.get_xi` silences stdout/stderr, copies the positions into a new
+float32 array and counts pairs synchronously for every call. `XiPool` keeps a
+set of worker processes instead: each one redirects its stdout/stderr to
+/dev/null once at startup, and catalogs reach it as float32 (N, 3) blocks of
+shared memory that the worker wraps without copying. `submit` returns a
+`concurrent.futures.Future`, so the caller can go on with the next mock while
+the previous one is being measured.
+
+Example
+-------
+>>> with XiPool(nworkers=2) as pool:
+...     futures = []
+...     for param in params:
+...         x, y, z = tracer_positions(ez.populate_tracer(*param, ntracer, rsd_fac=rsd_fac))
+...         futures.append(pool.submit(x, y, z, lbox=Lbox))   # returns at once
+...     tables = [f.result() for f in futures]                # s smin smax xi0 xi2
+
+A producer can also fill a `SharedCatalog` directly (``cat.pos[:, 0] = ...``)
+and submit it, which avoids even the single copy into shared memory.
+"""
+import multiprocessing as mp
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from prep_ref import LBOX, xi_setup, xi_table, fcfc_conf
+import clus_backends
+from clus_cache import catalog_fingerprint
+
+
+class SharedCatalog:
+    """
+    Float32 positions of `n` points, shape (n, 3), in a shared memory block.
+
+    The creator owns the block and frees it with `unlink` (done by `XiPool` when
+    the measurement has finished).
+    """
+
+    def __init__(self, n, name=None):
+        self.n = int(n)
+        nbytes = max(1, self.n * 3 * 4)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.owner = True
+        else:
+            self.shm = _attach(name)
+            self.owner = False
+        self.pos = np.ndarray((self.n, 3), dtype=np.float32, buffer=self.shm.buf)
+
+    @classmethod
+    def from_arrays(cls, x, y, z):
+        cat = cls(len(x))
+        for i, c in enumerate((x, y, z)):
+            cat.pos[:, i] = c
+        return cat
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.pos = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _attach(name):
+    """Attach to an existing block; the creator stays responsible for unlinking it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers the block again, with the resource tracker the
+        # workers share with their parent, so the parent's unlink still clears it
+        return shared_memory.SharedMemory(name=name)
+
+
+## worker processes ------------------------------------------------------------
+
+_weights = {}
+
+def _init_worker(silence):
+    if silence:
+        # once per worker instead of around every call
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        os.close(devnull)
+
+
+def _count(name, n, lbox, backend, xicfg, conf, nthread, path):
+    cat = SharedCatalog(n, name=name)
+    try:
+        pos = cat.pos
+        if backend == 'pyfcfc':
+            # the shared float32 block goes to pyfcfc as it is
+            py_compute_cf = clus_backends.lazy_import('pyfcfc.boxes').py_compute_cf
+            sedges = np.linspace(xicfg['smin'], xicfg['smax'], xicfg['nbin'] + 1)
+            if n not in _weights:
+                _weights.clear()
+                _weights[n] = np.ones(n, dtype=np.float32)
+            w = _weights[n]
+            table = xi_table(py_compute_cf([pos, pos], [w, w], sedges, None, 100, conf=conf))
+        else:
+            table = clus_backends.measure('xi', pos[:, 0], pos[:, 1], pos[:, 2], backend=backend, lbox=lbox, nmu=100,
+                                          ncpu=nthread, **xicfg)
+        del pos
+    finally:
+        cat.close()
+    if path is not None:
+        np.savetxt(path, table, header=clus_backends.HEADERS['xi'])
+    return table
+
+
+class XiPool:
+    """
+    Long-lived xi measurement workers.
+
+    Parameters
+    ----------
+    nworkers : int
+        Number of worker processes (concurrent measurements).
+    nthread : int
+        Threads per measurement (native backend).
+    silence : bool
+        Redirect the workers' stdout/stderr to /dev/null (the C extension is verbose).
+    mp_context : str
+        Start method of the workers; 'spawn' does not inherit the caller's threads or
+        large arrays.
+    cache : clus_cache.ClusCache, optional
+        Measurement cache: hits resolve immediately, new results are stored.
+    """
+
+    def __init__(self, nworkers=1, nthread=1, silence=True, mp_context='spawn', cache=None):
+        self.nthread = nthread
+        self.cache = cache
+        self.pool = ProcessPoolExecutor(max_workers=nworkers, mp_context=mp.get_context(mp_context),
+                                        initializer=_init_worker, initargs=(silence,))
+
+    def submit(self, x, y=None, z=None, lbox=LBOX, path=None, fingerprint=None):
+        """
+        Measure xi of a catalog asynchronously.
+
+        Parameters
+        ----------
+        x, y, z : array_like
+            Positions; or pass a `SharedCatalog` as `x` alone (it is unlinked when done).
+        path : str, optional
+            Also write the table there (as `measure_xi`).
+
+        Returns
+        -------
+        Future
+            Resolves to the table s smin smax xi0 xi2.
+        """
+        backend, xicfg, settings = xi_setup(lbox)
+        if isinstance(x, SharedCatalog):
+            cat = x
+        else:
+            cat = None
+        if self.cache is not None:
+            if fingerprint is None:
+                fingerprint = catalog_fingerprint(*((cat.pos[:, 0], cat.pos[:, 1], cat.pos[:, 2]) if cat else (x, y, z)))
+            key = self.cache.key('xi', fingerprint, settings)
+            table = self.cache.get(key)
+            if table is not None:
+                if cat is not None:
+                    cat.unlink()
+                if path is not None:
+                    np.savetxt(path, table, header=clus_backends.HEADERS['xi'])
+                fut = Future()
+                fut.set_result(table)
+                return fut
+        if cat is None:
+            cat = SharedCatalog.from_arrays(x, y, z)
+        conf = os.path.abspath(fcfc_conf(lbox)) if backend == 'pyfcfc' else None
+        fut = self.pool.submit(_count, cat.name, cat.n, lbox, backend, xicfg, conf, self.nthread, path)
+
+        def _done(f):
+            cat.unlink()
+            if self.cache is not None and f.exception() is None:
+                self.cache.put(key, f.result(), 'xi', fingerprint, settings)
+        fut.add_done_callback(_done)
+        return fut
+
+    def map(self, catalogs, lbox=LBOX):
+        """Measure a list of (x, y, z) catalogs; tables in order."""
+        futures = [self.submit(*c, lbox=lbox) for c in catalogs]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
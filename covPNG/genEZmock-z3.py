@@ -1,7 +1,10 @@
 # %%
-import os
 import numpy as np
 from EZmock import EZmock
+import sys; sys.path.append('../EZmock/src')
+from disp_store import DispStore
+from ez_pipeline import run_pipeline
+from covariance import CovAccumulator, data_vector
 
 # %% [markdown]
 # ## Read Reference Mock
@@ -27,14 +30,15 @@ rsd_fac = (1 + redshift) / (100 * np.sqrt(Omega_m0 * (1 + redshift)**3 + (1 - Om
 odir = 'out'
 
 # %%
+store = DispStore('2LPTdisp')
+
 def setup_ez(Lbox=1000, Ngrid=256, seed=42):
     # Initialize EZmock instance
     ez = EZmock(Lbox=Lbox, Ngrid=Ngrid, seed=42, nthread=ncpu)
     ez.eval_growth_params(z_out=redshift, z_pk=1, Omega_m=Omega_m0, Omega_nu=Omega_nu)
 
-    mydx=np.loadtxt(f'/pscratch/sd/s/siyizhao/2LPTdisp/dx_{seed}.txt')
-    mydy=np.loadtxt(f'/pscratch/sd/s/siyizhao/2LPTdisp/dy_{seed}.txt')
-    mydz=np.loadtxt(f'/pscratch/sd/s/siyizhao/2LPTdisp/dz_{seed}.txt')
+    # float32 memory maps of the store; EZmock copies them once into its own buffer
+    mydx, mydy, mydz = store.load(seed=seed, redshift=redshift, Lbox=Lbox, Ngrid=Ngrid, fnl=fnl, fix_amp=1)
     ez.create_dens_field_from_disp(mydx,mydy,mydz, deepcopy=True)
     return ez
 
@@ -46,42 +50,27 @@ def setup_ez(Lbox=1000, Ngrid=256, seed=42):
 ## to speed up the process during calibration, you can use smaller box and lower grid resolution first, and then go back to the right setting for final check
 Lbox = 1000
 Ngrid = 256
-seed = '42_z3L1000N256fnl500'  # seed can be a string
+seed = 42
 ntracer = num//8
 
 ez = setup_ez(Lbox=Lbox, Ngrid=Ngrid, seed=seed)
 
 
 # %% [markdown]
-# ### run and plot EZmock
+# ### run EZmock
 
 # %%
-def run_and_plot_EZmock(ez, pyc, params):
+def run_EZmock(ez, params):
     """
-    Run EZmock with the given parameters and plot the clustering statistics.
+    Run EZmock with the given parameters and save the catalogs.
     
     Parameters:
     ez (EZmock): The EZmock instance.
-    pyc (pyclustering): The pyclustering instance.
-    params (dict): List of EZmock parameters to be run.
+    params (list): List of EZmock parameters to be run.
     """
-    fnames = []
-    for param in params:
-        rho_c, rho_exp, pdf_base, sigma_v = param
-        fname = f'{odir}/EZmock_L{Lbox:g}_N{Ngrid:d}_fnl{fnl:g}_c{rho_c:g}_e{rho_exp:g}_b{pdf_base:g}_v{sigma_v:g}.dat'
-
-        if not os.path.exists(fname):
-            print(f'Running EZmock with parameters: {param}')
-            # Run EZmock
-            ez.populate_tracer_to_file(rho_c, rho_exp, pdf_base, sigma_v, ntracer, fname, rsd_fac=rsd_fac)
-
-        fnames.append(fname)
-            
-        # Measure clustering statistics
-        # pyc.run(fname, Lbox)
-
-    # Plot clustering statistics
-    # pyc.plot(fnames)
+    # catalogs are populated in memory and written in binary (out/EZmock_..._v{sigma_v}.cols),
+    # existing ones of the same run (ntracer, rsd_fac, seed) are skipped
+    list(run_pipeline(ez, params, ntracer, rsd_fac, Lbox, Ngrid, fnl, odir=odir, stats=(), save_catalog=True, seed=seed))
 
 # %%
 params = [
@@ -89,10 +78,29 @@ params = [
     [1.2, 8, 0.35, 480],
 ]
 
-pyc = None
-run_and_plot_EZmock(ez, pyc, params)
-
-# %%
+run_EZmock(ez, params)
 
+# %% [markdown]
+# ## Covariance
+#
+# P0/P2 of each realisation go straight into a streaming accumulator, checkpointed after every seed;
+# rerunning skips the seeds already included. The displacements of the seeds must be in the store
+# (`../EZmock/scripts/run_disp.py`).
 
+# %%
+def accumulate_cov(seeds, param, path2ckpt, kmax=0.3):
+    acc = CovAccumulator.open(path2ckpt)
+    for seed in seeds:
+        if seed in acc:
+            continue
+        ez = setup_ez(Lbox=Lbox, Ngrid=Ngrid, seed=seed)
+        for _, res in run_pipeline(ez, [param], ntracer, rsd_fac, Lbox, Ngrid, fnl, stats=('pk',)):
+            acc.update(data_vector(res, stats=('pk',), ells=(0, 2), kmax=kmax), mock_id=seed)
+        acc.save()
+        del ez
+    return acc
+
+# acc = accumulate_cov(range(100, 400), params[0], f'{odir}/cov_pk_fnl{fnl:g}.npz')
+# acc.write(f'{odir}/cov_pk_fnl{fnl:g}.txt', hartlap=True)  # path2cov of data_object
 
+# %%
@@ -2,12 +2,15 @@
 # !source /global/common/software/desi/users/adematti/cosmodesi_environment.sh main 
 from pypower import CatalogFFTPower, mpi
 import numpy as np
+import sys; sys.path.append('../EZmock/src')
+from catalog_io import is_column_dir
+from catalog_mpi import catalog_power
 
 
 # %%
 ## settings for pypower
 mpicomm = mpi.COMM_WORLD
-mpiroot = None # input positions/weights scattered on all processes
+mpiroot = None # input positions/weights scattered on all processes: each rank reads its own slice (catalog_mpi)
 Lbox = 2000
 Nmesh = 256
 kmax = Nmesh*np.pi/Lbox
@@ -27,6 +30,14 @@ def run_pypower_redshift(x, y, z, Lbox=Lbox, Nmesh=Nmesh, edges=edges, ells=ells
     poles = result.poles
     return poles
 
+def run_pypower_catalog(path, Lbox=Lbox, Nmesh=Nmesh, edges=edges, ells=ells, mpicomm=mpicomm):
+    """P(k) poles of a catalog file, every rank reading only its own rows (run with srun -n N)."""
+    return catalog_power(path, boxsize=Lbox, nmesh=Nmesh, edges=edges, ells=ells, mpicomm=mpicomm)
+
+def ezmock_path(stem):
+    """Binary catalog `{stem}.cols` written by the EZmock pipeline, else the text catalog `{stem}.dat`."""
+    return f'{stem}.cols' if is_column_dir(f'{stem}.cols') else f'{stem}.dat'
+
 # %%
 # path2ez='out/EZmock_L1000_N256_fnl1500_c0_e3_b0.48_v400.dat'
 # data2ez = np.loadtxt(path2ez)
@@ -42,28 +53,24 @@ def run_pypower_redshift(x, y, z, Lbox=Lbox, Nmesh=Nmesh, edges=edges, ells=ells
 # data2ez500 = np.loadtxt(path2ez500)
 # x_ez500, y_ez500, z_ez500 = data2ez500[:,0], data2ez500[:,1], data2ez500[:,2]
 # poles_ez500 = run_pypower_redshift(x_ez500, y_ez500, z_ez500, Lbox=1000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm, mpiroot=mpiroot)
-path2ez500='out/EZmock_L1000_N256_fnl500_c1.2_e8_b0.35_v480.dat'
-data2ez500 = np.loadtxt(path2ez500)
-x_ez500, y_ez500, z_ez500 = data2ez500[:,0], data2ez500[:,1], data2ez500[:,2]
-poles_ez500 = run_pypower_redshift(x_ez500, y_ez500, z_ez500, Lbox=1000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm, mpiroot=mpiroot)
+path2ez500='out/EZmock_L1000_N256_fnl500_c1.2_e8_b0.35_v480'
+poles_ez500 = run_pypower_catalog(ezmock_path(path2ez500), Lbox=1000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm)
 
 # path2ez600='out/EZmock_L1000_N256_fnl600_c0_e3_b0.48_v400.dat'
 # data2ez600 = np.loadtxt(path2ez600)
 # x_ez600, y_ez600, z_ez600 = data2ez600[:,0], data2ez600[:,1], data2ez600[:,2]
 # poles_ez600 = run_pypower_redshift(x_ez600, y_ez600, z_ez600, Lbox=1000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm, mpiroot=mpiroot)
-path2ez600='out/EZmock_L1000_N256_fnl600_c1.2_e8_b0.35_v480.dat'
-data2ez600 = np.loadtxt(path2ez600)
-x_ez600, y_ez600, z_ez600 = data2ez600[:,0], data2ez600[:,1], data2ez600[:,2]
-poles_ez600 = run_pypower_redshift(x_ez600, y_ez600, z_ez600, Lbox=1000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm, mpiroot=mpiroot)
+path2ez600='out/EZmock_L1000_N256_fnl600_c1.2_e8_b0.35_v480'
+poles_ez600 = run_pypower_catalog(ezmock_path(path2ez600), Lbox=1000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm)
 
 # %%
 sim='Abacus_pngbase_c302_ph000'
 redshift = 3.0
 hod='_dv'
-path2ab=f"/pscratch/sd/s/siyizhao/desi-dr2-hod/mocks/{sim}/z{redshift:.3f}/galaxies_rsd{hod}/QSOs.dat"
-data2ab = np.loadtxt(path2ab, skiprows=15)
-x_ab, y_ab, z_ab = data2ab[:,0], data2ab[:,1], data2ab[:,2]
-poles_ab = run_pypower_redshift(x_ab, y_ab, z_ab, Lbox=2000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm, mpiroot=mpiroot)
+path2ab=f"/pscratch/sd/s/siyizhao/desi-dr2-hod/mocks/{sim}/z{redshift:.3f}/galaxies_rsd{hod}/QSOs.cols"
+if not is_column_dir(path2ab): # text mock
+    path2ab = path2ab.replace('.cols', '.dat')
+poles_ab = run_pypower_catalog(path2ab, Lbox=2000, Nmesh=256, edges=edges, ells=ells, mpicomm=mpicomm)
 
 
 # %%
@@ -80,7 +87,8 @@ plt.yscale('log')
 plt.xlabel('k [h/Mpc]')
 plt.ylabel('P0(k) [(Mpc/h)$^3$]')
 plt.legend()
-plt.savefig('poles_comparison_ezmock_abacus.png')
+if mpicomm.rank == 0:
+    plt.savefig('poles_comparison_ezmock_abacus.png')
 
 # %%
 
@@ -1,14 +1,10 @@
 #!/bin/bash
 
-cd 2LPTdisp
-mv dispx_42.txt dx_42_z3L1000N256fnl400.txt
-mv dispy_42.txt dy_42_z3L1000N256fnl400.txt
-mv dispz_42.txt dz_42_z3L1000N256fnl400.txt
+python ../EZmock/scripts/store_disp.py --src-dir 2LPTdisp --store 2LPTdisp --seed 42 --redshift 3 --Lbox 1000 --Ngrid 256 --fnl 400 --fix_amp 1
 
-cd ..
 # modeified fnl in the script
 python genEZmock-z3.py 
 
 source /global/common/software/desi/users/adematti/cosmodesi_environment.sh main
 # add the new case in the script
-python plot-ezmock-z3.py 
+srun -n 4 python plot-ezmock-z3.py